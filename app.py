@@ -1,29 +1,123 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for
+from flask import Flask, Response, render_template, request, jsonify, redirect, url_for
 import os
 import json
 import shutil
 from query_parser import parse_raw_query, parse_batch_queries
 from transaction_manager import TransactionManager, LockType, TransactionState, IsolationLevel
-from indexing import IndexManager
+from indexing import IndexManager, PrimaryIndex
 from document_validator import DocumentValidator
+from write_set import WriteSet, query_plan
+from collection_file import (
+    MAX_PARTITIONS, collection_exists, create_collection_file, open_snapshot, read_documents
+)
+from batch_planner import READ_OPERATIONS, ScanPool, plan_batch
+from write_queue import WriteQueue
+from document_codec import DEFAULT_CODEC, get_codec
+from block_compression import Compression
+from query_cache import QueryCache
+from catalog import SYSTEM_DIRS, Catalog
+from ndjson import iter_documents, iter_lines
+from collection_dump import DUMP_FORMATS, dump_chunks, read_dump
+from slow_query_log import SlowQueryLog
+from change_stream import DEFAULT_TIMEOUT, HEARTBEAT_INTERVAL, MAX_EVENTS, ChangeStreams, watch_options
+from log_tail import LogGap
+from recovery import DATA_OPERATIONS
+from replication import Follower, ReplicationServer
+from wal import apply_delta
+import profiling
+import metrics
 import uuid
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from multiprocessing import current_process
 app = Flask(__name__)
 
+OPERATION_SECONDS = metrics.histogram(
+    "mangodb_operation_seconds", "Statement latency by operation, database and collection "
+    "(operation batch: a whole batch, with an empty collection)", ("operation", "database", "collection")
+)
+OPERATION_ERRORS = metrics.counter(
+    "mangodb_operation_errors_total", "Statements that returned an error", ("operation", "database", "collection")
+)
+DOCUMENTS_RETURNED = metrics.counter(
+    "mangodb_documents_returned_total", "Documents returned by find", ("database", "collection")
+)
+
+
+READ_ONLY_ERROR = "This server is a read-only replica; send writes to the primary"
+
+
+UNKNOWN_LABEL = "unknown"
+
+
+def metric_labels(catalog, db_name, collection):
+    """Database and collection labels of a statement.
+
+    Names come from the request: those not in the catalog are labelled
+    "unknown", or every made-up name would add a series. An empty
+    collection (a whole batch) stays empty.
+    """
+    if not catalog.has_database(db_name):
+        return UNKNOWN_LABEL, UNKNOWN_LABEL if collection else collection
+    if collection and not catalog.has_collection(db_name, collection):
+        return db_name, UNKNOWN_LABEL
+    return db_name, collection
+
+
+def record_operation(catalog, operation, db_name, collection, seconds, result):
+    labels = (operation,) + metric_labels(catalog, db_name, collection)
+    OPERATION_SECONDS.labels(*labels).observe(seconds)
+    if isinstance(result, dict) and "error" in result:
+        OPERATION_ERRORS.labels(*labels).inc()
+
+
 class DocumentDB:
-    def __init__(self):
-        self.databases_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "databases")
+    def __init__(self, databases_dir=None):
+        self.databases_dir = databases_dir or os.path.join(os.path.dirname(os.path.abspath(__file__)), "databases")
         # Create all required directories first
         self._ensure_databases_dir()
         # Initialize transaction manager after directories are created
         self.transaction_manager = TransactionManager(self.databases_dir)
         # Initialize index manager
         self.index_managers = {}  # db_name -> IndexManager
+        # Dirty index pages are written back by the checkpointer
+        self.transaction_manager.register_flusher("index", self._flush_index_page)
         # Initialize document validator
         self.document_validators = {}  # db_name -> DocumentValidator
         self._recover_from_crash()
+        # Databases, collections and indexes, kept in memory and saved by the checkpointer
+        self.catalog = Catalog(self.databases_dir, on_dirty=self._catalog_changed)
+        self.transaction_manager.register_flusher("catalog", lambda db_name, name: self.catalog.save())
+        self.catalog.load()
         self.max_batch_size = 100  # Maximum number of queries in a batch
+        self.bulk_batch_size = 1000  # Documents per transaction in bulk inserts
+        self.max_bulk_errors = 1000  # Line errors reported per bulk insert (all are counted)
         self.batch_timeout = 30  # Maximum time (seconds) for batch execution
+        # Independent statements of a batch run on these threads; scans of
+        # large partitioned collections can run on worker processes (off
+        # unless a threshold is set, see ScanPool)
+        self.max_batch_workers = 4
+        self.batch_executor = ThreadPoolExecutor(max_workers=self.max_batch_workers)
+        self.scan_pool = ScanPool()
+        # Concurrent single-statement writes are coalesced per collection
+        self.write_queues = {}  # (db_name, collection) -> WriteQueue
+        self.write_queues_lock = threading.Lock()
+        # Results of find queries, invalidated by every committed write
+        self.query_cache = QueryCache()
+        # Requests profiled on demand or sampled (see profiling)
+        self.profiler = profiling.Profiler()
+        # Statements slower than the threshold (ms), in a rotating file and by shape
+        self.slow_queries = SlowQueryLog(os.path.join(self.databases_dir, "slow_queries.log"))
+        # Committed changes read back from the logs (see change_stream)
+        self.change_streams = ChangeStreams(self.transaction_manager)
+        # ReplicationServer on a primary, Follower on a replica (see replication)
+        self.replication = None
+        # Replicas refuse writes from clients; only the thread applying the
+        # primary's changes gets past the checks
+        self.read_only = False
+        self.applying_replication = threading.local()
 
     def _ensure_databases_dir(self):
         # Create all required directories with exist_ok=True
@@ -31,7 +125,7 @@ class DocumentDB:
         os.makedirs(os.path.join(self.databases_dir, "transaction_logs"), exist_ok=True)
         os.makedirs(os.path.join(self.databases_dir, "checkpoints"), exist_ok=True)
         # Create indexes directory for each existing database
-        for db_name in self.list_databases():
+        for db_name in self._scan_databases():
             db_path = os.path.join(self.databases_dir, db_name)
             os.makedirs(os.path.join(db_path, "indexes"), exist_ok=True)
 
@@ -46,15 +140,28 @@ class DocumentDB:
             print(f"Recovery failed: {message}")
             # Just ensure directories exist, don't delete anything
             self._ensure_databases_dir()
+        else:
+            print(message)
 
-    def list_databases(self):
+    def _scan_databases(self):
         if not os.path.exists(self.databases_dir):
             return []
         # Exclude system directories from the list
-        system_dirs = {'transaction_logs', 'checkpoints'}
         return [d for d in os.listdir(self.databases_dir) 
                 if os.path.isdir(os.path.join(self.databases_dir, d)) 
-                and d not in system_dirs]
+                and d not in SYSTEM_DIRS]
+
+    def list_databases(self):
+        return self.catalog.database_names()
+
+    def _catalog_changed(self):
+        self.transaction_manager.mark_dirty("*", "catalog", "manifest")
+
+    def _read_only_error(self):
+        """Error for a write on a read-only replica, None when writes are allowed"""
+        if self.read_only and not getattr(self.applying_replication, "active", False):
+            return READ_ONLY_ERROR
+        return None
 
     def validate_name(self, name, type_name):
         """Validate database or collection name"""
@@ -71,14 +178,26 @@ class DocumentDB:
         
         return True, ""
 
+    def _new_index_manager(self, db_name, db_path):
+        def on_dirty(collection_name, field_name):
+            self.transaction_manager.mark_dirty(db_name, "index", f"{collection_name}.{field_name}")
+        return IndexManager(db_path, on_dirty=on_dirty)
+
     def _get_index_manager(self, db_name):
         """Get or create an index manager for a database"""
         if db_name not in self.index_managers:
             db_path = os.path.join(self.databases_dir, db_name)
             if os.path.exists(db_path):
-                self.index_managers[db_name] = IndexManager(db_path)
+                self.index_managers[db_name] = self._new_index_manager(db_name, db_path)
         return self.index_managers.get(db_name)
 
+    def _flush_index_page(self, db_name, page_name):
+        """Write back one dirty index (page name is "<collection>.<field>")"""
+        index_manager = self.index_managers.get(db_name)
+        if index_manager:
+            collection_name, field_name = page_name.split(".", 1)
+            index_manager.flush_index(collection_name, field_name)
+
     def _get_document_validator(self, db_name):
         """Get or create a document validator for a database"""
         if db_name not in self.document_validators:
@@ -92,6 +211,9 @@ class DocumentDB:
 
     def create_index(self, db_name, collection_name, field_name):
         """Create an index on a collection field"""
+        error = self._read_only_error()
+        if error:
+            return False, error
         transaction_id = self.transaction_manager.begin_transaction(IsolationLevel.SERIALIZABLE)
         
         try:
@@ -113,17 +235,16 @@ class DocumentDB:
                     None, {"field": field_name}
                 )
                 
-                # Build the index with existing documents
-                collection_path = os.path.join(self.databases_dir, db_name, f"{collection_name}.json")
-                if os.path.exists(collection_path):
-                    with open(collection_path, 'r') as f:
-                        documents = json.load(f)
-                        for doc in documents:
-                            if field_name in doc:
-                                index_manager.update_index(
-                                    collection_name, field_name,
-                                    doc[field_name], str(doc.get('_id', ''))
-                                )
+                # Build the index from the existing documents in one pass
+                db_path = os.path.join(self.databases_dir, db_name)
+                if collection_exists(db_path, collection_name):
+                    index_manager.build_index(collection_name, field_name, (
+                        (doc[field_name], str(doc.get('_id', '')))
+                        for doc in read_documents(db_path, collection_name) if field_name in doc
+                    ))
+                # Persist the freshly built index once instead of per document
+                index_manager.flush_index(collection_name, field_name)
+                self.catalog.set_indexes(db_name, collection_name, index_manager.list_indexes(collection_name))
                 
                 # Commit transaction
                 success, msg = self.transaction_manager.commit_transaction(transaction_id)
@@ -141,6 +262,9 @@ class DocumentDB:
 
     def drop_index(self, db_name, collection_name, field_name):
         """Drop an index from a collection field"""
+        error = self._read_only_error()
+        if error:
+            return False, error
         transaction_id = self.transaction_manager.begin_transaction(IsolationLevel.SERIALIZABLE)
         
         try:
@@ -150,6 +274,7 @@ class DocumentDB:
                 return False, f"Database '{db_name}' does not exist"
 
             if index_manager.drop_index(collection_name, field_name):
+                self.catalog.set_indexes(db_name, collection_name, index_manager.list_indexes(collection_name))
                 # Log the operation
                 self.transaction_manager.log_operation(
                     transaction_id, 'drop_index', db_name, collection_name, None,
@@ -172,13 +297,13 @@ class DocumentDB:
 
     def list_indexes(self, db_name, collection_name):
         """List all indexes for a collection"""
-        index_manager = self._get_index_manager(db_name)
-        if not index_manager:
-            return []
-        return index_manager.list_indexes(collection_name)
+        return self.catalog.indexes(db_name, collection_name)
 
     def create_database(self, db_name):
         """Create a new database"""
+        error = self._read_only_error()
+        if error:
+            return False, error
         # Start transaction
         transaction_id = self.transaction_manager.begin_transaction(IsolationLevel.SERIALIZABLE)
         
@@ -198,7 +323,8 @@ class DocumentDB:
                 os.makedirs(db_path)
                 os.makedirs(os.path.join(db_path, "indexes"), exist_ok=True)
                 # Initialize index manager for new database
-                self.index_managers[db_name] = IndexManager(db_path)
+                self.index_managers[db_name] = self._new_index_manager(db_name, db_path)
+                self.catalog.add_database(db_name)
                 # Log the operation
                 self.transaction_manager.log_operation(
                     transaction_id, 'create_database', db_name, None, None,
@@ -219,6 +345,9 @@ class DocumentDB:
             return False, str(e)
 
     def delete_database(self, db_name):
+        error = self._read_only_error()
+        if error:
+            return False, error
         # Start transaction
         transaction_id = self.transaction_manager.begin_transaction(IsolationLevel.SERIALIZABLE)
         
@@ -240,6 +369,8 @@ class DocumentDB:
                     del self.index_managers[db_name]
                 
                 shutil.rmtree(db_path)
+                self.query_cache.drop_database(db_name)
+                self.catalog.remove_database(db_name)
                 
                 # Commit transaction
                 success, msg = self.transaction_manager.commit_transaction(transaction_id)
@@ -255,27 +386,21 @@ class DocumentDB:
             return False, str(e)
 
     def list_collections(self, db_name):
-        # Start transaction
-        transaction_id = self.transaction_manager.begin_transaction(IsolationLevel.READ_COMMITTED)
-        
-        try:
-            db_path = os.path.join(self.databases_dir, db_name)
-            if not os.path.exists(db_path):
-                self.transaction_manager.abort_transaction(transaction_id)
-                return []
-            
-            collections = [f.replace('.json', '') for f in os.listdir(db_path) 
-                         if f.endswith('.json')]
-            
-            # Commit transaction
-            self.transaction_manager.commit_transaction(transaction_id)
-            return collections
-        except Exception as e:
-            self.transaction_manager.abort_transaction(transaction_id)
-            return []
+        return self.catalog.collection_names(db_name)
+
+    def collection_info(self, db_name, collection_name):
+        """Catalog entry of a collection (documents, bytes, modified, storage settings) plus its indexes"""
+        stats = self.catalog.collection(db_name, collection_name)
+        if stats is None:
+            return None
+        return {**stats, "indexes": self.catalog.indexes(db_name, collection_name)}
 
-    def create_collection(self, db_name, collection_name):
+    def create_collection(self, db_name, collection_name, codec=None, compression=None, compression_level=None,
+                          partitions=None):
         """Create a new collection in the specified database"""
+        error = self._read_only_error()
+        if error:
+            return False, error
         # Start transaction
         transaction_id = self.transaction_manager.begin_transaction(IsolationLevel.SERIALIZABLE)
         
@@ -291,14 +416,17 @@ class DocumentDB:
                 self.transaction_manager.abort_transaction(transaction_id)
                 return False, "Database does not exist"
             
-            collection_path = os.path.join(db_path, f"{collection_name}.json")
-            if os.path.exists(collection_path):
+            if collection_exists(db_path, collection_name):
                 self.transaction_manager.abort_transaction(transaction_id)
                 return False, "Collection already exists"
             
             try:
-                with open(collection_path, 'w') as f:
-                    json.dump([], f)
+                create_collection_file(
+                    db_path, collection_name, codec or DEFAULT_CODEC,
+                    Compression(compression or "none", compression_level), int(partitions or 0)
+                )
+                
+                self.catalog.refresh_collection(db_name, collection_name)
                 
                 # Initialize document validator and create _id index
                 validator = self._get_document_validator(db_name)
@@ -306,9 +434,12 @@ class DocumentDB:
                     validator.create_unique_index(collection_name, '_id')
                 
                 # Log the operation
+                # Storage settings are logged so replicas create the collection alike
+                stats = self.catalog.collection(db_name, collection_name) or {}
                 self.transaction_manager.log_operation(
                     transaction_id, 'create_collection', db_name, collection_name, None,
-                    None, {"name": collection_name}
+                    None, {"name": collection_name, "codec": stats.get("codec"),
+                           "compression": stats.get("compression"), "partitions": stats.get("partitions")}
                 )
                 
                 # Commit transaction
@@ -324,117 +455,142 @@ class DocumentDB:
             self.transaction_manager.abort_transaction(transaction_id)
             return False, str(e)
 
-    def execute_query(self, db_name, query):
-        """Execute a single query"""
+    def set_collection_codec(self, db_name, collection_name, codec):
+        """Rewrite a collection with another document codec (json or binary)"""
+        error = self._read_only_error()
+        if error:
+            return False, error
+        try:
+            get_codec(codec)
+        except ValueError as e:
+            return False, str(e)
+        if not self.catalog.has_collection(db_name, collection_name):
+            return False, "Collection does not exist"
+        
+        # The rewrite is queued like a write so it cannot race coalesced writers
+        transaction_id = self.transaction_manager.begin_transaction(IsolationLevel.SERIALIZABLE)
+        result = self._get_write_queue(db_name, collection_name).submit(
+            (transaction_id, 'set_codec', {"codec": codec})
+        )
+        if "error" in result:
+            return False, result["error"]
+        return True, result["message"]
+
+    def set_collection_compression(self, db_name, collection_name, compression, level=None):
+        """Rewrite a collection (and later its index files) with block compression: none, zlib or lzma"""
+        error = self._read_only_error()
+        if error:
+            return False, error
+        try:
+            compression = Compression(compression, level)
+        except ValueError as e:
+            return False, str(e)
+        if not self.catalog.has_collection(db_name, collection_name):
+            return False, "Collection does not exist"
+        
+        transaction_id = self.transaction_manager.begin_transaction(IsolationLevel.SERIALIZABLE)
+        result = self._get_write_queue(db_name, collection_name).submit(
+            (transaction_id, 'set_compression', {"compression": compression})
+        )
+        if "error" in result:
+            return False, result["error"]
+        # Index files follow the collection's compression the next time they are written
+        index_manager = self._get_index_manager(db_name)
+        if index_manager:
+            index_manager.mark_collection_dirty(collection_name)
+        return True, result["message"]
+
+    def set_collection_partitions(self, db_name, collection_name, partitions):
+        """Split a collection into N files by hash of _id (1 merges it back into one file)"""
+        error = self._read_only_error()
+        if error:
+            return False, error
+        try:
+            partitions = int(partitions)
+        except (TypeError, ValueError):
+            return False, "Partitions must be a number"
+        if not 1 <= partitions <= MAX_PARTITIONS:
+            return False, f"Partitions must be between 1 and {MAX_PARTITIONS}"
+        if not self.catalog.has_collection(db_name, collection_name):
+            return False, "Collection does not exist"
+        
+        transaction_id = self.transaction_manager.begin_transaction(IsolationLevel.SERIALIZABLE)
+        result = self._get_write_queue(db_name, collection_name).submit(
+            (transaction_id, 'set_partitions', {"partitions": partitions})
+        )
+        if "error" in result:
+            return False, result["error"]
+        return True, result["message"]
+
+    def execute_query(self, db_name, query, profile=False, read_preference=None):
+        """Execute a single query; with `profile` the result carries a profile of it (see profiling).
+
+        On a primary, read_preference "secondary" or "secondary_preferred"
+        sends a find to a follower (see replication).
+        """
+        if read_preference and self.replication is not None:
+            result = self.replication.route_read(db_name, query, read_preference, profile)
+            if result is not None:
+                return result
+        return self.profiler.run("query", profile, self._execute_query, db_name, query)
+
+    def _execute_query(self, db_name, query):
+        start = time.perf_counter()
+        try:
+            with profiling.span("parse"):
+                operation, collection, params = parse_raw_query(query)
+        except Exception as e:
+            return {"error": str(e)}
+        if operation is None:
+            return {"error": "Invalid query format"}
+        parse_ms = (time.perf_counter() - start) * 1000
+        stats = {}
+        result = self._execute_statement(db_name, operation, collection, params, stats)
+        seconds = time.perf_counter() - start
+        record_operation(self.catalog, operation, db_name, collection, seconds, result)
+        if self.slow_queries.is_slow(seconds * 1000):
+            self._log_slow_query(db_name, operation, collection, params, seconds * 1000, stats, parse_ms)
+        return result
+
+    def _execute_statement(self, db_name, operation, collection, params, stats=None):
+        if operation not in READ_OPERATIONS and self._read_only_error():
+            return {"error": READ_ONLY_ERROR}
         transaction_id = self.transaction_manager.begin_transaction(IsolationLevel.REPEATABLE_READ)
         
         try:
-            operation, collection, params = parse_raw_query(query)
-            if operation is None:
-                self.transaction_manager.abort_transaction(transaction_id)
-                return {"error": "Invalid query format"}
-            
             # Get document validator
             validator = self._get_document_validator(db_name)
             if not validator:
                 self.transaction_manager.abort_transaction(transaction_id)
                 return {"error": f"Database '{db_name}' does not exist"}
             
-            # Handle insert operations
-            if operation in ['insert', 'insert_many']:
-                collection_path = os.path.join(self.databases_dir, db_name, f"{collection}.json")
-                if not os.path.exists(collection_path):
+            # Inserts and updates go through the collection's write queue, which
+            # applies concurrent writes to a collection as one group
+            if operation in ['insert', 'insert_many', 'update']:
+                if not self.catalog.has_collection(db_name, collection):
                     self.transaction_manager.abort_transaction(transaction_id)
                     return {"error": f"Collection '{collection}' does not exist"}
                 
-                try:
-                    with open(collection_path, 'r') as f:
-                        data = json.load(f)
-                    
-                    documents = params if operation == 'insert_many' else [params]
-                    for doc in documents:
-                        # Validate document
-                        is_valid, message = validator.validate_document(collection, doc)
-                        if not is_valid:
-                            self.transaction_manager.abort_transaction(transaction_id)
-                            return {"error": message}
-                        
-                        doc_id = doc['_id']
-                        success, msg = self.transaction_manager.acquire_document_lock(
-                            db_name, collection, doc_id, LockType.WRITE, transaction_id
-                        )
-                        if not success:
-                            self.transaction_manager.abort_transaction(transaction_id)
-                            return {"error": f"Failed to acquire write lock: {msg}"}
-                        
-                        self.transaction_manager.log_operation(
-                            transaction_id, 'insert', db_name, collection, doc_id,
-                            None, doc
-                        )
-                        data.append(doc)
-                    
-                    with open(collection_path, 'w') as f:
-                        json.dump(data, f, indent=2)
-                    
-                    success, msg = self.transaction_manager.commit_transaction(transaction_id)
-                    if not success:
-                        return {"error": f"Failed to commit transaction: {msg}"}
-                    
-                    return {"message": f"Inserted {len(documents)} document(s) successfully!"}
-                except Exception as e:
-                    self.transaction_manager.abort_transaction(transaction_id)
-                    return {"error": str(e)}
+                with profiling.span("write_queue"):
+                    return self._get_write_queue(db_name, collection).submit((transaction_id, operation, params))
             
-            # Handle update operations
-            if operation == 'update':
-                collection_path = os.path.join(self.databases_dir, db_name, f"{collection}.json")
-                if not os.path.exists(collection_path):
+            if operation in ['find', 'explain']:
+                if not self.catalog.has_collection(db_name, collection):
                     self.transaction_manager.abort_transaction(transaction_id)
                     return {"error": f"Collection '{collection}' does not exist"}
-                
+                write_set = self._new_write_set(db_name)
                 try:
-                    with open(collection_path, 'r') as f:
-                        data = json.load(f)
-                    
-                    docs_to_update = []
-                    for doc in data:
-                        if all(doc.get(k) == v for k, v in params['query'].items()):
-                            # Validate updated document
-                            updated_doc = {**doc, **params['update'].get('$set', {})}
-                            is_valid, message = validator.validate_document(
-                                collection, updated_doc, is_update=True, old_doc=doc
-                            )
-                            if not is_valid:
-                                self.transaction_manager.abort_transaction(transaction_id)
-                                return {"error": message}
-                            
-                            doc_id = doc['_id']
-                            success, msg = self.transaction_manager.acquire_document_lock(
-                                db_name, collection, doc_id, LockType.WRITE, transaction_id
-                            )
-                            if not success:
-                                self.transaction_manager.abort_transaction(transaction_id)
-                                return {"error": f"Failed to acquire write lock: {msg}"}
-                            
-                            self.transaction_manager.log_operation(
-                                transaction_id, 'update', db_name, collection, doc_id,
-                                doc, updated_doc
-                            )
-                            if '$set' in params['update']:
-                                doc.update(params['update']['$set'])
-                            docs_to_update.append(doc)
-                    
-                    with open(collection_path, 'w') as f:
-                        json.dump(data, f, indent=2)
-                    
-                    success, msg = self.transaction_manager.commit_transaction(transaction_id)
-                    if not success:
-                        return {"error": f"Failed to commit transaction: {msg}"}
-                    
-                    return {"message": f"Updated {len(docs_to_update)} document(s)"}
-                except Exception as e:
+                    if operation == 'explain':
+                        result, error = self._explain(db_name, collection, params, transaction_id, write_set)
+                    else:
+                        result, error = self._find(db_name, collection, params, transaction_id, write_set, stats)
+                finally:
+                    write_set.discard()
+                if error:
                     self.transaction_manager.abort_transaction(transaction_id)
-                    return {"error": str(e)}
+                    return {"error": error}
+                self.transaction_manager.commit_transaction(transaction_id)
+                return result
             
             # Handle other operations...
             # ... existing code for other operations ...
@@ -443,13 +599,451 @@ class DocumentDB:
             self.transaction_manager.abort_transaction(transaction_id)
             return {"error": str(e)}
 
-    def execute_batch_query(self, db_name, queries_str):
-        """Execute multiple queries in a single transaction (atomic, summary result)"""
+    def bulk_insert(self, db_name, collection_name, lines, batch_size=None):
+        """Insert NDJSON documents, `batch_size` of them per transaction.
+
+        `lines` is consumed as it is read (see ndjson.iter_lines), so only
+        one sub-batch is held in memory. Each sub-batch goes through the
+        collection's write queue as one transaction, with one log flush and
+        one collection write. Lines that are not JSON objects and documents
+        that fail validation are reported by line number and skipped; the
+        rest of their sub-batch is still inserted.
+        """
+        error = self._read_only_error()
+        if error:
+            return {"error": error}
+        if not self.catalog.has_database(db_name):
+            return {"error": f"Database '{db_name}' does not exist"}
+        if not self.catalog.has_collection(db_name, collection_name):
+            return {"error": f"Collection '{collection_name}' does not exist"}
+        start = time.perf_counter()
+        result = self._insert_entries(db_name, collection_name, iter_documents(lines), batch_size)
+        record_operation(self.catalog, 'bulk_insert', db_name, collection_name, time.perf_counter() - start, result)
+        return result
+
+    def _insert_entries(self, db_name, collection_name, entries, batch_size=None):
+        """Insert (number, document, error) entries in sub-batches (see bulk_insert)"""
+        batch_size = max(int(batch_size or self.bulk_batch_size), 1)
+        result = {"inserted": 0, "failed": 0, "batches": 0, "lines": 0, "errors": []}
+
+        def fail(number, message):
+            result["failed"] += 1
+            if len(result["errors"]) < self.max_bulk_errors:
+                result["errors"].append({"line": number, "error": message})
+
+        def insert(batch):
+            transaction_id = self.transaction_manager.begin_transaction(IsolationLevel.REPEATABLE_READ)
+            outcome = self._get_write_queue(db_name, collection_name).submit(
+                (transaction_id, 'bulk_insert', batch)
+            )
+            result["batches"] += 1
+            if "error" in outcome:
+                for number, _ in batch:
+                    fail(number, outcome["error"])
+                return
+            result["inserted"] += outcome["inserted"]
+            for error in outcome["errors"]:
+                fail(error["line"], error["error"])
+
+        batch = []
+        for number, doc, error in entries:
+            result["lines"] = number
+            if error:
+                fail(number, error)
+                continue
+            batch.append((number, doc))
+            if len(batch) >= batch_size:
+                insert(batch)
+                batch = []
+        if batch:
+            insert(batch)
+        return result
+
+    def export_collection(self, db_name, collection_name, export_format="ndjson", compress=False):
+        """Stream a collection as a dump (see collection_dump); returns (chunks, error).
+
+        The collection's files are opened before returning, all from the
+        same write. Later writes rename new files over them while the dump
+        reads the old ones, so an export is a consistent snapshot and never
+        holds up writers.
+        """
+        if export_format not in DUMP_FORMATS:
+            return None, f"Unknown export format '{export_format}', expected one of: {', '.join(DUMP_FORMATS)}"
+        if not self.catalog.has_collection(db_name, collection_name):
+            return None, f"Collection '{collection_name}' does not exist"
+        db_path = os.path.join(self.databases_dir, db_name)
+        stats = self.catalog.collection(db_name, collection_name) or {}
+        sources = open_snapshot(db_path, collection_name)
+        if sources is None:
+            sources = [read_documents(db_path, collection_name)]
+            codec_name, compression = DEFAULT_CODEC, "none"
+        else:
+            codec_name, compression = sources[0].codec.name, repr(sources[0].compression)
+        header = {
+            "collection": collection_name,
+            "codec": codec_name,
+            "compression": compression,
+            "partitions": stats.get("partitions", 0),
+            "indexes": self.list_indexes(db_name, collection_name),
+        }
+        return dump_chunks(sources, export_format, header, compress), None
+
+    def watch(self, db_name, collections=None, operations=None, resume_after=None, max_events=MAX_EVENTS,
+              timeout=0):
+        """Committed inserts, updates and deletes of a database after a resume token (see change_stream).
+
+        Waits up to `timeout` seconds for a change; returns {"events",
+        "resume_token"}, the token to pass as `resume_after` next time.
+        """
+        error = self._change_stream_error(db_name, operations, max_events)
+        if error:
+            return {"error": error}
+        try:
+            return self.change_streams.watch(db_name, collections, operations, resume_after, max_events, timeout)
+        except LogGap as e:
+            return {"error": f"Cannot resume the change stream: {str(e)}"}
+
+    def open_change_stream(self, db_name, collections=None, operations=None, resume_after=None):
+        """A ChangeStream to follow a database with; returns (stream, error).
+
+        The log is kept back to the stream's position until it is closed.
+        """
+        error = self._change_stream_error(db_name, operations)
+        if error:
+            return None, error
+        try:
+            return self.change_streams.open(db_name, collections, operations, resume_after, retain=True), None
+        except LogGap as e:
+            return None, f"Cannot resume the change stream: {str(e)}"
+
+    def _change_stream_error(self, db_name, operations, max_events=1):
+        if db_name not in self.list_databases():
+            return f"Database '{db_name}' does not exist"
+        unknown = sorted(set(operations or ()) - DATA_OPERATIONS)
+        if unknown:
+            return f"Unknown operation(s) {', '.join(unknown)}, expected insert, update or delete"
+        if max_events < 1:
+            return "max_events must be at least 1"
+        return None
+
+    def restore_collection(self, db_name, collection_name, chunks, batch_size=None):
+        """Load a dump into a collection, creating the database and collection if needed.
+
+        A new collection gets the storage settings of a binary dump's header.
+        Documents go in through the bulk insert path, then the dump's
+        indexes are built, each in one pass over the loaded collection.
+        """
+        error = self._read_only_error()
+        if error:
+            return {"error": error}
+        try:
+            header, entries = read_dump(chunks)
+        except ValueError as e:
+            return {"error": str(e)}
+        header = header or {}
+        collection_name = collection_name or header.get("collection")
+        if not collection_name:
+            return {"error": "Collection name is required"}
+        if not self.catalog.has_database(db_name):
+            success, message = self.create_database(db_name)
+            if not success:
+                return {"error": message}
+        if not self.catalog.has_collection(db_name, collection_name):
+            compression, _, level = header.get("compression", "none").partition(":")
+            success, message = self.create_collection(
+                db_name, collection_name, header.get("codec"), compression, level or None,
+                header.get("partitions") or None
+            )
+            if not success:
+                return {"error": message}
+        result = self._insert_entries(db_name, collection_name, entries, batch_size)
+        result["indexes"] = []
+        for field_name in header.get("indexes", []):
+            success, message = self.create_index(db_name, collection_name, field_name)
+            if success:
+                result["indexes"].append(field_name)
+            else:
+                result["errors"].append({"index": field_name, "error": message})
+        return result
+
+    def _get_write_queue(self, db_name, collection):
+        """Get or create the write queue of a collection"""
+        with self.write_queues_lock:
+            queue = self.write_queues.get((db_name, collection))
+            if queue is None:
+                queue = WriteQueue(lambda requests: self._apply_write_group(db_name, collection, requests))
+                self.write_queues[(db_name, collection)] = queue
+            return queue
+
+    def _lock_collections(self, db_name, collections):
+        """Hold the write queue apply locks of collections written outside their queues.
+
+        Taken in name order, so writers of several collections cannot
+        deadlock; closing the returned ExitStack releases them.
+        """
+        locks = ExitStack()
+        for collection in sorted(collections):
+            locks.enter_context(self._get_write_queue(db_name, collection).apply_lock)
+        return locks
+
+    def _new_write_set(self, db_name):
+        return WriteSet(
+            os.path.join(self.databases_dir, db_name),
+            version_of=lambda collection: self.query_cache.version(db_name, collection)
+        )
+
+    def _find(self, db_name, collection, query, transaction_id, write_set, stats=None, use_cache=True):
+        """Run a find against the write set, answering it from the query cache when possible.
+
+        Results are cached under the version the write set opened the
+        collection at, and never for collections the transaction has written.
+        `stats` is filled as by WriteSet.match, with plan "query_cache" for
+        a cached result, plus the time taking read locks.
+        """
+        cacheable = use_cache and collection not in write_set.changed
+        matches = None
+        if cacheable:
+            query_key = QueryCache.query_key('find', query)
+            version = write_set.opened_version(collection) or self.query_cache.version(db_name, collection)
+            matches = self.query_cache.get(db_name, collection, version, query_key)
+            if matches is not None and stats is not None:
+                stats.update(plan="query_cache", index=None, documents_examined=0, documents_matched=len(matches))
+        if matches is None:
+            matches = write_set.match(collection, query, self.scan_pool, stats)
+            if cacheable:
+                self.query_cache.put(db_name, collection, write_set.opened_version(collection), query_key, matches)
+        DOCUMENTS_RETURNED.labels(db_name, collection).inc(len(matches))
+        start = time.perf_counter()
+        for doc in matches:
+            doc_id = str(doc.get('_id', id(doc)))
+            success, msg = self.transaction_manager.acquire_document_lock(
+                db_name, collection, doc_id, LockType.READ, transaction_id
+            )
+            if not success:
+                return None, f"Failed to acquire read lock: {msg}"
+        if stats is not None:
+            stats["lock_ms"] = (time.perf_counter() - start) * 1000
+        return {"documents": matches}, None
+
+    def _explain(self, db_name, collection, query, transaction_id, write_set):
+        """Run a find without the query cache and describe how it was executed"""
+        stats = {}
+        start = time.perf_counter()
+        result, error = self._find(db_name, collection, query, transaction_id, write_set, stats, use_cache=False)
+        if error:
+            return None, error
+        stages = [
+            {"stage": "open", "ms": round(stats["open_ms"], 3)},
+            {"stage": stats["plan"], "ms": round(stats["match_ms"], 3)},
+            {"stage": "lock", "ms": round(stats["lock_ms"], 3)},
+        ]
+        return {"explain": {
+            "collection": collection,
+            "filter": query,
+            "plan": stats["plan"],
+            "index": stats["index"],
+            "partitions": stats["partitions"],
+            "keys_examined": stats["keys_examined"],
+            "documents_examined": stats["documents_examined"],
+            "documents_returned": len(result["documents"]),
+            "stages": stages,
+            "total_ms": round((time.perf_counter() - start) * 1000, 3),
+        }}, None
+
+    def _log_slow_query(self, db_name, operation, collection, params, ms, stats=None, parse_ms=None):
+        """Add a statement to the slow query log; `stats` as filled by _find, if it ran one"""
+        if stats:
+            plan = stats["plan"]
+            details = {key: round(value, 3) if isinstance(value, float) else value
+                       for key, value in stats.items() if key != "plan"}
+        elif operation in ['find', 'explain', 'update', 'delete']:
+            plan, index = query_plan(params['query'] if operation == 'update' else params)
+            details = {"index": index}
+        else:
+            plan, details = None, {}
+        if parse_ms is not None:
+            details["parse_ms"] = round(parse_ms, 3)
+        self.slow_queries.record(db_name, operation, collection, params, ms, plan, details)
+
+    def _apply_write_group(self, db_name, collection, requests):
+        """Apply queued single-statement writes to a collection together.
+
+        Each request keeps its own transaction and result; the collection is
+        loaded and persisted once and the log is flushed once before the data
+        is written and once after the commit records.
+        """
+        write_set = self._new_write_set(db_name)
+        try:
+            return self._apply_write_set_group(db_name, collection, requests, write_set)
+        finally:
+            write_set.discard()
+
+    def _apply_write_set_group(self, db_name, collection, requests, write_set):
+        validator = self._get_document_validator(db_name)
+        results = [None] * len(requests)
+        staged = []
+        for position, (transaction_id, operation, params) in enumerate(requests):
+            try:
+                results[position] = self._stage_write(
+                    db_name, collection, write_set, validator, transaction_id, operation, params
+                )
+            except Exception as e:
+                results[position] = {"error": str(e)}
+            if "error" in results[position]:
+                self.transaction_manager.abort_transaction(transaction_id)
+            else:
+                staged.append(position)
+        
+        try:
+            if write_set.changed:
+                # Log records reach the OS before the collection file changes
+                self.transaction_manager.flush_log(db_name)
+                write_set.persist()
+                self.query_cache.bump(db_name, collection)
+                self.catalog.refresh_collection(db_name, collection)
+        except Exception as e:
+            for position in staged:
+                self.transaction_manager.abort_transaction(requests[position][0])
+                results[position] = {"error": str(e)}
+            self.transaction_manager.flush_log(db_name)
+            return results
+        
+        for position in staged:
+            success, msg = self.transaction_manager.commit_transaction(requests[position][0], flush=False)
+            if not success:
+                results[position] = {"error": f"Failed to commit transaction: {msg}"}
+        self.transaction_manager.flush_log(db_name)
+        return results
+
+    def _stage_write(self, db_name, collection, write_set, validator, transaction_id, operation, params):
+        """Validate, lock and log one insert or update, then apply it to the write set.
+
+        Nothing is applied or logged unless every document of the statement
+        passes validation and gets its lock, so a failed statement can simply
+        be aborted.
+        """
+        if operation in ['insert', 'insert_many']:
+            documents = params if operation == 'insert_many' else [params]
+            new_ids = set()
+            for doc in documents:
+                # Validate document
+                is_valid, message = validator.validate_document(collection, doc)
+                if not is_valid:
+                    return {"error": message}
+                if write_set.contains(collection, doc['_id']) or PrimaryIndex.key(doc['_id']) in new_ids:
+                    return {"error": "Duplicate value for unique field '_id'"}
+                new_ids.add(PrimaryIndex.key(doc['_id']))
+                
+                success, msg = self.transaction_manager.acquire_document_lock(
+                    db_name, collection, doc['_id'], LockType.WRITE, transaction_id
+                )
+                if not success:
+                    return {"error": f"Failed to acquire write lock: {msg}"}
+            
+            for doc in documents:
+                self.transaction_manager.log_operation(
+                    transaction_id, 'insert', db_name, collection, doc['_id'],
+                    None, doc, flush=False
+                )
+                write_set.insert(collection, doc)
+            return {"message": f"Inserted {len(documents)} document(s) successfully!"}
+        
+        if operation == 'bulk_insert':
+            # (line number, document) pairs; invalid documents are reported and skipped
+            errors = []
+            accepted = []
+            new_ids = set()
+            for line_number, doc in params:
+                is_valid, message = validator.validate_document(collection, doc)
+                if is_valid and (write_set.contains(collection, doc['_id'])
+                                 or PrimaryIndex.key(doc['_id']) in new_ids):
+                    is_valid, message = False, "Duplicate value for unique field '_id'"
+                if is_valid:
+                    success, msg = self.transaction_manager.acquire_document_lock(
+                        db_name, collection, doc['_id'], LockType.WRITE, transaction_id
+                    )
+                    if not success:
+                        is_valid, message = False, f"Failed to acquire write lock: {msg}"
+                if not is_valid:
+                    errors.append({"line": line_number, "error": message})
+                    continue
+                new_ids.add(PrimaryIndex.key(doc['_id']))
+                accepted.append(doc)
+            
+            for doc in accepted:
+                self.transaction_manager.log_operation(
+                    transaction_id, 'insert', db_name, collection, doc['_id'],
+                    None, doc, flush=False
+                )
+                write_set.insert(collection, doc)
+            return {"inserted": len(accepted), "errors": errors}
+        
+        if operation == 'set_codec':
+            # Only the encoding changes, so there is nothing to log
+            write_set.set_codec(collection, params['codec'])
+            return {"message": f"Collection stored with the {params['codec']} codec"}
+        if operation == 'set_compression':
+            write_set.set_compression(collection, params['compression'])
+            return {"message": f"Collection stored with {params['compression']!r} compression"}
+        if operation == 'set_partitions':
+            write_set.set_partitions(collection, params['partitions'])
+            return {"message": f"Collection stored in {params['partitions']} partition(s)"}
+        
+        # update
+        docs_to_update = []
+        for doc in write_set.match(collection, params['query'], self.scan_pool):
+            # Validate updated document
+            updated_doc = {**doc, **params['update'].get('$set', {})}
+            if updated_doc.get('_id') != doc.get('_id'):
+                # The primary index locates documents by _id
+                return {"error": "Cannot modify the immutable field '_id'"}
+            is_valid, message = validator.validate_document(
+                collection, updated_doc, is_update=True, old_doc=doc
+            )
+            if not is_valid:
+                return {"error": message}
+            
+            success, msg = self.transaction_manager.acquire_document_lock(
+                db_name, collection, doc['_id'], LockType.WRITE, transaction_id
+            )
+            if not success:
+                return {"error": f"Failed to acquire write lock: {msg}"}
+            docs_to_update.append((doc, updated_doc))
+        
+        for doc, updated_doc in docs_to_update:
+            self.transaction_manager.log_operation(
+                transaction_id, 'update', db_name, collection, doc['_id'],
+                doc, updated_doc, flush=False
+            )
+            if '$set' in params['update']:
+                doc.update(params['update']['$set'])
+        if docs_to_update:
+            write_set.mark_changed(collection, [doc for doc, _ in docs_to_update])
+        return {"message": f"Updated {len(docs_to_update)} document(s)"}
+
+    def execute_batch_query(self, db_name, queries_str, profile=False):
+        """Execute multiple queries in a single transaction (atomic, summary result)
+
+        Statements run against a write set: each collection is loaded once,
+        changes stay in memory and are written once at commit. Statements
+        that do not conflict (see plan_batch) run concurrently; results are
+        returned in statement order. With `profile` the result carries a
+        profile of the batch (see profiling).
+        """
+        start = time.perf_counter()
+        result = self.profiler.run("batch", profile, self._execute_batch, db_name, queries_str)
+        record_operation(self.catalog, 'batch', db_name, '', time.perf_counter() - start, result)
+        return result
+
+    def _execute_batch(self, db_name, queries_str):
         transaction_id = self.transaction_manager.begin_transaction(IsolationLevel.SERIALIZABLE)
+        write_set = self._new_write_set(db_name)
+        collection_locks = ExitStack()
         start_time = time.time()
         
         try:
-            parsed_queries, error_info = parse_batch_queries(queries_str)
+            with profiling.span("parse"):
+                parsed_queries, error_info = parse_batch_queries(queries_str)
             if error_info is not None:
                 self.transaction_manager.abort_transaction(transaction_id)
                 return {"error": f"Query {error_info['index']} failed: {repr(error_info['query'])}\nsyntax error"}
@@ -461,162 +1055,396 @@ class DocumentDB:
                 self.transaction_manager.abort_transaction(transaction_id)
                 return {"error": f"Batch size exceeds maximum limit of {self.max_batch_size}"}
             
-            for idx, (operation, collection, params) in enumerate(parsed_queries):
-                if time.time() - start_time > self.batch_timeout:
-                    self.transaction_manager.abort_transaction(transaction_id)
-                    return {"error": f"Batch execution timeout at query {idx+1}"}
-                
-                # Handle create_collection in batch
-                if operation == 'create_collection':
-                    success, message = self.create_collection(db_name, collection)
-                    if not success:
-                        self.transaction_manager.abort_transaction(transaction_id)
-                        return {"error": f"Query {idx+1} failed: {message}"}
-                    continue
-                
-                # Handle insert_many in batch
-                if operation == 'insert_many':
-                    collection_path = os.path.join(self.databases_dir, db_name, f"{collection}.json")
-                    if not os.path.exists(collection_path):
-                        self.transaction_manager.abort_transaction(transaction_id)
-                        return {"error": f"Query {idx+1} failed: Collection '{collection}' does not exist"}
-                    try:
-                        with open(collection_path, 'r') as f:
-                            data = json.load(f)
-                        
-                        # Get document validator
-                        validator = self._get_document_validator(db_name)
-                        if not validator:
-                            self.transaction_manager.abort_transaction(transaction_id)
-                            return {"error": f"Query {idx+1} failed: Database '{db_name}' does not exist"}
-                        
-                        for doc in params:
-                            # Validate document and ensure _id field
-                            is_valid, message = validator.validate_document(collection, doc)
-                            if not is_valid:
-                                self.transaction_manager.abort_transaction(transaction_id)
-                                return {"error": f"Query {idx+1} failed: {message}"}
-                            
-                            doc_id = doc['_id']
-                            success, msg = self.transaction_manager.acquire_document_lock(
-                                db_name, collection, doc_id, LockType.WRITE, transaction_id
-                            )
-                            if not success:
-                                self.transaction_manager.abort_transaction(transaction_id)
-                                return {"error": f"Query {idx+1} failed: Failed to acquire write lock: {msg}"}
-                            
-                            self.transaction_manager.log_operation(
-                                transaction_id, 'insert', db_name, collection, doc_id,
-                                None, doc
-                            )
-                            data.append(doc)
-                        
-                        with open(collection_path, 'w') as f:
-                            json.dump(data, f, indent=2)
-                    except Exception as e:
-                        self.transaction_manager.abort_transaction(transaction_id)
-                        return {"error": f"Query {idx+1} failed: {str(e)}"}
-                    continue
+            if self._read_only_error() and any(operation not in READ_OPERATIONS for operation, _, _ in parsed_queries):
+                self.transaction_manager.abort_transaction(transaction_id)
+                return {"error": READ_ONLY_ERROR}
+            
+            # Get document validator
+            if not self._get_document_validator(db_name):
+                self.transaction_manager.abort_transaction(transaction_id)
+                return {"error": f"Database '{db_name}' does not exist"}
+            
+            # Collections the batch writes are loaded and persisted under their
+            # write queues' locks, or single writes in between would be lost
+            collection_locks = self._lock_collections(db_name, {
+                collection for operation, collection, _ in parsed_queries
+                if operation not in READ_OPERATIONS
+                and (operation == 'create_collection' or self.catalog.has_collection(db_name, collection))
+            })
+            
+            results = [None] * len(parsed_queries)
+            failed = threading.Event()
+            
+            def run_group(group):
+                for idx in group:
+                    if failed.is_set():
+                        return None
+                    if time.time() - start_time > self.batch_timeout:
+                        failed.set()
+                        return idx, f"Batch execution timeout at query {idx+1}"
+                    statement_start = time.perf_counter()
+                    with profiling.span(f"statement {idx + 1}: {parsed_queries[idx][0]}"):
+                        results[idx], error = self._execute_batch_statement(
+                            db_name, parsed_queries[idx], transaction_id, write_set
+                        )
+                    operation, collection, params = parsed_queries[idx]
+                    seconds = time.perf_counter() - statement_start
+                    labels = (operation,) + metric_labels(self.catalog, db_name, collection)
+                    OPERATION_SECONDS.labels(*labels).observe(seconds)
+                    if error:
+                        OPERATION_ERRORS.labels(*labels).inc()
+                    if self.slow_queries.is_slow(seconds * 1000):
+                        self._log_slow_query(db_name, operation, collection, params, seconds * 1000)
+                    if error:
+                        failed.set()
+                        return idx, f"Query {idx+1} failed: {error}"
+                return None
+            
+            groups = plan_batch(parsed_queries)
+            if len(groups) > 1 and self.max_batch_workers > 1:
+                profile, parent = profiling.current(), profiling.current_span()
                 
-                collection_path = os.path.join(self.databases_dir, db_name, f"{collection}.json")
-                if not os.path.exists(collection_path):
-                    self.transaction_manager.abort_transaction(transaction_id)
-                    return {"error": f"Query {idx+1} failed: Collection '{collection}' does not exist"}
+                def run_group_profiled(group):
+                    # Statements run on the pool add their spans to this request's profile
+                    with profiling.activate(profile, parent):
+                        return run_group(group)
                 
-                try:
-                    with open(collection_path, 'r') as f:
-                        data = json.load(f)
-                    
-                    if operation == 'find':
-                        for doc in data:
-                            if all(doc.get(k) == v for k, v in params.items()):
-                                doc_id = str(doc.get('_id', id(doc)))
-                                success, msg = self.transaction_manager.acquire_document_lock(
-                                    db_name, collection, doc_id, LockType.READ, transaction_id
-                                )
-                                if not success:
-                                    self.transaction_manager.abort_transaction(transaction_id)
-                                    return {"error": f"Query {idx+1} failed: Failed to acquire read lock: {msg}"}
-                    
-                    elif operation == 'insert':
-                        # Get document validator
-                        validator = self._get_document_validator(db_name)
-                        if not validator:
-                            self.transaction_manager.abort_transaction(transaction_id)
-                            return {"error": f"Query {idx+1} failed: Database '{db_name}' does not exist"}
-                        
-                        # Validate document and ensure _id field
-                        is_valid, message = validator.validate_document(collection, params)
-                        if not is_valid:
-                            self.transaction_manager.abort_transaction(transaction_id)
-                            return {"error": f"Query {idx+1} failed: {message}"}
-                        
-                        doc_id = params['_id']
-                        success, msg = self.transaction_manager.acquire_document_lock(
-                            db_name, collection, doc_id, LockType.WRITE, transaction_id
-                        )
-                        if not success:
-                            self.transaction_manager.abort_transaction(transaction_id)
-                            return {"error": f"Query {idx+1} failed: Failed to acquire write lock: {msg}"}
-                        
-                        self.transaction_manager.log_operation(
-                            transaction_id, 'insert', db_name, collection, doc_id,
-                            None, params
-                        )
-                        data.append(params)
-                        with open(collection_path, 'w') as f:
-                            json.dump(data, f, indent=2)
-                    
-                    elif operation == 'update':
-                        for doc in data:
-                            if all(doc.get(k) == v for k, v in params['query'].items()):
-                                doc_id = str(doc.get('_id', id(doc)))
-                                success, msg = self.transaction_manager.acquire_document_lock(
-                                    db_name, collection, doc_id, LockType.WRITE, transaction_id
-                                )
-                                if not success:
-                                    self.transaction_manager.abort_transaction(transaction_id)
-                                    return {"error": f"Query {idx+1} failed: Failed to acquire write lock: {msg}"}
-                                self.transaction_manager.log_operation(
-                                    transaction_id, 'update', db_name, collection, doc_id,
-                                    doc, {**doc, **params['update']}
-                                )
-                                if '$set' in params['update']:
-                                    doc.update(params['update']['$set'])
-                        with open(collection_path, 'w') as f:
-                            json.dump(data, f, indent=2)
-                    
-                    elif operation == 'delete':
-                        docs_to_delete = []
-                        for doc in data:
-                            if all(doc.get(k) == v for k, v in params.items()):
-                                doc_id = str(doc.get('_id', id(doc)))
-                                success, msg = self.transaction_manager.acquire_document_lock(
-                                    db_name, collection, doc_id, LockType.WRITE, transaction_id
-                                )
-                                if not success:
-                                    self.transaction_manager.abort_transaction(transaction_id)
-                                    return {"error": f"Query {idx+1} failed: Failed to acquire write lock: {msg}"}
-                                self.transaction_manager.log_operation(
-                                    transaction_id, 'delete', db_name, collection, doc_id,
-                                    doc, None
-                                )
-                                docs_to_delete.append(doc)
-                        data = [doc for doc in data if doc not in docs_to_delete]
-                        with open(collection_path, 'w') as f:
-                            json.dump(data, f, indent=2)
-                except Exception as e:
-                    self.transaction_manager.abort_transaction(transaction_id)
-                    return {"error": f"Query {idx+1} failed: {str(e)}"}
+                outcomes = list(self.batch_executor.map(run_group_profiled if profile else run_group, groups))
+            else:
+                outcomes = [run_group(group) for group in groups]
+            
+            errors = sorted(outcome for outcome in outcomes if outcome)
+            if errors:
+                self.transaction_manager.abort_transaction(transaction_id)
+                return {"error": errors[0][1]}
+            
+            # Statements leave their log records buffered: they are written
+            # in one flush before the collection files change, which are
+            # forced before the commit record is written
+            changed = sorted(write_set.changed)
+            if changed:
+                self.transaction_manager.flush_log(db_name)
+            write_set.persist()
+            for collection in changed:
+                self.query_cache.bump(db_name, collection)
+                self.catalog.refresh_collection(db_name, collection)
             success, msg = self.transaction_manager.commit_transaction(transaction_id)
             if not success:
                 return {"error": f"Failed to commit transaction: {msg}"}
-            return {"message": f"All {len(parsed_queries)} queries executed successfully!"}
+            return {
+                "message": f"All {len(parsed_queries)} queries executed successfully!",
+                "results": results
+            }
         except Exception as e:
             self.transaction_manager.abort_transaction(transaction_id)
             return {"error": str(e)}
+        finally:
+            write_set.discard()
+            collection_locks.close()
 
-db = DocumentDB()
+    def _execute_batch_statement(self, db_name, statement, transaction_id, write_set):
+        """Run one batch statement against the write set; returns (result, error)"""
+        operation, collection, params = statement
+        
+        # Handle create_collection in batch
+        if operation == 'create_collection':
+            success, message = self.create_collection(db_name, collection)
+            if not success:
+                return None, message
+            return {"created": collection}, None
+        
+        # Index DDL runs in its own transaction, as when issued on its own
+        if operation in ['create_index', 'drop_index']:
+            if operation == 'create_index':
+                success, message = self.create_index(db_name, collection, params['field'])
+            else:
+                success, message = self.drop_index(db_name, collection, params['field'])
+            if not success:
+                return None, message
+            return {"message": message}, None
+        
+        if not write_set.exists(collection):
+            return None, f"Collection '{collection}' does not exist"
+        
+        try:
+            if operation in ['insert', 'insert_many']:
+                validator = self._get_document_validator(db_name)
+                documents = params if operation == 'insert_many' else [params]
+                for doc in documents:
+                    # Validate document and ensure _id field
+                    is_valid, message = validator.validate_document(collection, doc)
+                    if not is_valid:
+                        return None, message
+                    if write_set.contains(collection, doc['_id']):
+                        return None, "Duplicate value for unique field '_id'"
+                    
+                    doc_id = doc['_id']
+                    success, msg = self.transaction_manager.acquire_document_lock(
+                        db_name, collection, doc_id, LockType.WRITE, transaction_id
+                    )
+                    if not success:
+                        return None, f"Failed to acquire write lock: {msg}"
+                    
+                    self.transaction_manager.log_operation(
+                        transaction_id, 'insert', db_name, collection, doc_id,
+                        None, doc, flush=False
+                    )
+                    write_set.insert(collection, doc)
+                return {"inserted": len(documents)}, None
+            
+            if operation == 'find':
+                return self._find(db_name, collection, params, transaction_id, write_set)
+            
+            if operation == 'explain':
+                return self._explain(db_name, collection, params, transaction_id, write_set)
+            
+            if operation == 'update':
+                updated = 0
+                for doc in write_set.match(collection, params['query'], self.scan_pool):
+                    if '_id' in params['update'].get('$set', {}) and params['update']['$set']['_id'] != doc.get('_id'):
+                        # The primary index locates documents by _id
+                        return None, "Cannot modify the immutable field '_id'"
+                    doc_id = str(doc.get('_id', id(doc)))
+                    success, msg = self.transaction_manager.acquire_document_lock(
+                        db_name, collection, doc_id, LockType.WRITE, transaction_id
+                    )
+                    if not success:
+                        return None, f"Failed to acquire write lock: {msg}"
+                    self.transaction_manager.log_operation(
+                        transaction_id, 'update', db_name, collection, doc.get('_id', doc_id),
+                        doc, {**doc, **params['update'].get('$set', {})}, flush=False
+                    )
+                    if '$set' in params['update']:
+                        doc.update(params['update']['$set'])
+                    write_set.mark_changed(collection, [doc])
+                    updated += 1
+                return {"updated": updated}, None
+            
+            if operation == 'delete':
+                docs_to_delete = write_set.match(collection, params, self.scan_pool)
+                for doc in docs_to_delete:
+                    doc_id = str(doc.get('_id', id(doc)))
+                    success, msg = self.transaction_manager.acquire_document_lock(
+                        db_name, collection, doc_id, LockType.WRITE, transaction_id
+                    )
+                    if not success:
+                        return None, f"Failed to acquire write lock: {msg}"
+                    self.transaction_manager.log_operation(
+                        transaction_id, 'delete', db_name, collection, doc.get('_id', doc_id),
+                        doc, None, flush=False
+                    )
+                write_set.delete(collection, docs_to_delete)
+                return {"deleted": len(docs_to_delete)}, None
+            
+            return None, f"Unsupported operation '{operation}'"
+        except Exception as e:
+            return None, str(e)
+
+    def apply_replicated(self, db_name, transactions):
+        """Apply transactions committed on the primary, oldest first (see replication).
+
+        `transactions` are lists of log records. The data changes of
+        consecutive transactions are applied as one local transaction with
+        one write per collection, so readers see all of them or none; DDL
+        runs as it did on the primary. Applying is idempotent (inserts
+        replace, changes to missing documents are skipped), so transactions
+        applied again after a crash or reconnect leave the same state.
+        """
+        self.applying_replication.active = True
+        try:
+            changes = []
+            for records in transactions:
+                for record in records:
+                    if record["operation"] in DATA_OPERATIONS:
+                        changes.append(record)
+                        continue
+                    self._apply_replicated_changes(db_name, changes)
+                    changes = []
+                    self._apply_replicated_ddl(db_name, record)
+            self._apply_replicated_changes(db_name, changes)
+        finally:
+            self.applying_replication.active = False
+
+    def load_replicated_snapshot(self, db_name, collections):
+        """Replace a database with an empty copy of the primary's before its documents arrive.
+
+        `collections` lists {name, codec, compression, partitions}; None
+        means the database no longer exists on the primary.
+        """
+        self.applying_replication.active = True
+        try:
+            if os.path.exists(os.path.join(self.databases_dir, db_name)):
+                success, message = self.delete_database(db_name)
+                if not success:
+                    raise RuntimeError(message)
+            if collections is None:
+                return
+            success, message = self.create_database(db_name)
+            if not success:
+                raise RuntimeError(message)
+            for collection in collections:
+                compression, _, level = collection["compression"].partition(":")
+                success, message = self.create_collection(
+                    db_name, collection["name"], collection["codec"], compression, level or None,
+                    collection["partitions"] or None
+                )
+                if not success:
+                    raise RuntimeError(message)
+        finally:
+            self.applying_replication.active = False
+
+    def _apply_replicated_ddl(self, db_name, record):
+        operation, collection = record["operation"], record["collection"]
+        success = True
+        if operation == 'create_database':
+            if not os.path.exists(os.path.join(self.databases_dir, db_name)):
+                success, message = self.create_database(db_name)
+        elif operation == 'delete_database':
+            if os.path.exists(os.path.join(self.databases_dir, db_name)):
+                success, message = self.delete_database(db_name)
+        elif operation == 'create_collection':
+            if not self.catalog.has_collection(db_name, collection):
+                settings = record["after_state"] or {}
+                compression, _, level = (settings.get("compression") or "none").partition(":")
+                success, message = self.create_collection(
+                    db_name, collection, settings.get("codec"), compression, level or None,
+                    settings.get("partitions") or None
+                )
+        elif operation == 'create_index':
+            if record["after_state"]["field"] not in self.list_indexes(db_name, collection):
+                success, message = self.create_index(db_name, collection, record["after_state"]["field"])
+        elif operation == 'drop_index':
+            if record["before_state"]["field"] in self.list_indexes(db_name, collection):
+                success, message = self.drop_index(db_name, collection, record["before_state"]["field"])
+        if not success:
+            raise RuntimeError(f"Replaying {operation} on {db_name}: {message}")
+
+    def _apply_replicated_changes(self, db_name, records):
+        """Apply inserts, updates and deletes in one transaction, logged as this server's own.
+
+        No document locks are taken: clients cannot write to a replica, and
+        readers see collection files that persist() replaces atomically.
+        """
+        if not records:
+            return
+        transaction_id = self.transaction_manager.begin_transaction(IsolationLevel.SERIALIZABLE)
+        write_set = self._new_write_set(db_name)
+        # Held from load to persist, as by a batch (see _execute_batch)
+        collection_locks = self._lock_collections(db_name, {
+            record["collection"] for record in records if self.catalog.has_collection(db_name, record["collection"])
+        })
+        try:
+            for record in records:
+                collection = record["collection"]
+                if not write_set.exists(collection):
+                    continue
+                change = self._redo_replicated(write_set, collection, record)
+                if change:
+                    operation, doc_id, before_state, after_state = change
+                    self.transaction_manager.log_operation(
+                        transaction_id, operation, db_name, collection, doc_id,
+                        before_state, after_state, flush=False
+                    )
+            changed = sorted(write_set.changed)
+            if changed:
+                self.transaction_manager.flush_log(db_name)
+                write_set.persist()
+                for collection in changed:
+                    self.query_cache.bump(db_name, collection)
+                    self.catalog.refresh_collection(db_name, collection)
+            success, msg = self.transaction_manager.commit_transaction(transaction_id)
+            if not success:
+                raise RuntimeError(f"Failed to commit transaction: {msg}")
+        except Exception:
+            self.transaction_manager.abort_transaction(transaction_id)
+            raise
+        finally:
+            write_set.discard()
+            collection_locks.close()
+
+    @staticmethod
+    def _redo_replicated(write_set, collection, record):
+        """Apply one data record to the write set; returns what to log, or None if nothing changed"""
+        operation = record["operation"]
+        if operation == 'insert':
+            after_state = record["after_state"]
+            doc_id = after_state.get('_id', record["document_id"])
+            doc = write_set.get(collection, doc_id)
+            if doc is None:
+                doc = dict(after_state)
+                write_set.insert(collection, doc)
+                return 'insert', doc_id, None, doc
+            if doc == after_state:
+                return None
+            before_state = dict(doc)
+            doc.clear()
+            doc.update(after_state)
+            write_set.mark_changed(collection, [doc])
+            return 'update', doc_id, before_state, doc
+
+        doc_id = (record["before_state"] or {}).get('_id', record["document_id"])
+        doc = write_set.get(collection, doc_id)
+        if doc is None and isinstance(doc_id, str):
+            # Batch updates and deletes log the _id as a string
+            try:
+                number = json.loads(doc_id)
+            except ValueError:
+                number = None
+            if isinstance(number, (int, float)) and not isinstance(number, bool):
+                doc = write_set.get(collection, number)
+        if doc is None:
+            return None
+        if operation == 'delete':
+            write_set.delete(collection, [doc])
+            return 'delete', doc['_id'], doc, None
+        before_state = dict(doc)
+        if record["delta"] is not None:
+            apply_delta(doc, record["delta"])
+        elif record["after_state"] is not None:
+            doc.clear()
+            doc.update(record["after_state"])
+        if doc == before_state:
+            return None
+        write_set.mark_changed(collection, [doc])
+        return 'update', doc['_id'], before_state, doc
+
+EXPORT_MIMETYPES = {"ndjson": "application/x-ndjson", "binary": "application/octet-stream"}
+
+def open_database():
+    """The server's DocumentDB, configured from the environment"""
+    # MANGODB_DATABASES_DIR points the server at another data directory
+    db = DocumentDB(os.environ.get("MANGODB_DATABASES_DIR"))
+    # MANGODB_SCAN_PROCESS_THRESHOLD enables process scans of partitioned
+    # collections from that many documents (see ScanPool)
+    if os.environ.get("MANGODB_SCAN_PROCESS_THRESHOLD"):
+        db.scan_pool.threshold = int(os.environ["MANGODB_SCAN_PROCESS_THRESHOLD"])
+        db.scan_pool.start()
+    # MANGODB_SLOW_QUERY_MS sets the slow query threshold ("off" disables the log)
+    if os.environ.get("MANGODB_SLOW_QUERY_MS"):
+        threshold = os.environ["MANGODB_SLOW_QUERY_MS"]
+        db.slow_queries.threshold_ms = None if threshold == "off" else float(threshold)
+    # MANGODB_PROFILE_SAMPLE_RATE profiles that fraction of queries (e.g. 0.01)
+    if os.environ.get("MANGODB_PROFILE_SAMPLE_RATE"):
+        db.profiler.sample_rate = float(os.environ["MANGODB_PROFILE_SAMPLE_RATE"])
+    # MANGODB_REPLICATE_FROM=host:port makes this server a read-only follower of that
+    # primary, taking routed reads at MANGODB_ADVERTISE_URL; MANGODB_REPLICATION_PORT
+    # makes it a primary that followers connect to (see replication)
+    if os.environ.get("MANGODB_REPLICATE_FROM"):
+        db.replication = Follower(db, os.environ["MANGODB_REPLICATE_FROM"], os.environ.get("MANGODB_REPLICA_NAME"),
+                                  os.environ.get("MANGODB_ADVERTISE_URL"))
+        db.replication.start()
+    elif os.environ.get("MANGODB_REPLICATION_PORT"):
+        db.replication = ReplicationServer(db, os.environ.get("MANGODB_REPLICATION_HOST", "127.0.0.1"),
+                                           int(os.environ["MANGODB_REPLICATION_PORT"]),
+                                           float(os.environ.get("MANGODB_REPLICA_MAX_LAG", 10)))
+        db.replication.start()
+    return db
+
+# Scan workers start a new interpreter that imports the main module again;
+# only the server process opens the databases
+db = open_database() if current_process().name == "MainProcess" else None
+# MANGODB_READ_PREFERENCE: where finds go by default (primary, secondary_preferred or secondary)
+READ_PREFERENCE = os.environ.get("MANGODB_READ_PREFERENCE", "primary")
 
 @app.route('/')
 def index():
@@ -646,9 +1474,78 @@ def create_collection(db_name):
     if not collection_name:
         return jsonify({"success": False, "message": "Collection name is required"})
     
-    success, message = db.create_collection(db_name, collection_name)
+    success, message = db.create_collection(
+        db_name, collection_name, request.form.get('codec'),
+        request.form.get('compression'), request.form.get('compression_level') or None,
+        request.form.get('partitions') or None
+    )
     return jsonify({"success": success, "message": message})
 
+@app.route('/set_codec/<db_name>/<collection_name>', methods=['POST'])
+def set_codec(db_name, collection_name):
+    codec = request.form.get('codec')
+    if not codec:
+        return jsonify({"success": False, "message": "Codec is required"})
+    
+    success, message = db.set_collection_codec(db_name, collection_name, codec)
+    return jsonify({"success": success, "message": message})
+
+@app.route('/set_compression/<db_name>/<collection_name>', methods=['POST'])
+def set_compression(db_name, collection_name):
+    compression = request.form.get('compression')
+    if not compression:
+        return jsonify({"success": False, "message": "Compression is required"})
+    
+    success, message = db.set_collection_compression(
+        db_name, collection_name, compression, request.form.get('level') or None
+    )
+    return jsonify({"success": success, "message": message})
+
+@app.route('/set_partitions/<db_name>/<collection_name>', methods=['POST'])
+def set_partitions(db_name, collection_name):
+    success, message = db.set_collection_partitions(db_name, collection_name, request.form.get('partitions'))
+    return jsonify({"success": success, "message": message})
+
+@app.route('/catalog')
+@app.route('/catalog/<db_name>')
+def catalog(db_name=None):
+    if db_name is not None and db_name not in db.list_databases():
+        return jsonify({"error": f"Database '{db_name}' does not exist"}), 404
+    return jsonify(db.catalog.describe(db_name))
+
+@app.route('/catalog/<db_name>/<collection_name>')
+def collection_info(db_name, collection_name):
+    info = db.collection_info(db_name, collection_name)
+    if info is None:
+        return jsonify({"error": f"Collection '{collection_name}' does not exist"}), 404
+    return jsonify(info)
+
+@app.route('/query_cache/stats')
+def query_cache_stats():
+    return jsonify(db.query_cache.stats())
+
+@app.route('/slow_queries')
+def slow_queries():
+    return jsonify(db.slow_queries.stats(request.args.get('limit', 10, type=int)))
+
+@app.route('/profiles')
+def profiles():
+    return jsonify({
+        "sample_rate": db.profiler.sample_rate,
+        "profiles": db.profiler.recent(request.args.get('limit', 20, type=int))
+    })
+
+@app.route('/replication')
+def replication_status():
+    if db.replication is None:
+        return jsonify({"role": "standalone"})
+    return jsonify(db.replication.status())
+
+@app.route('/metrics')
+def metrics_endpoint():
+    # Prometheus text exposition format
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 @app.route('/query_editor')
 @app.route('/query_editor/<db_name>')
 def query_editor(db_name):
@@ -659,12 +1556,16 @@ def query_editor(db_name):
 def execute_query():
     db_name = request.form.get('db_name')
     query = request.form.get('query')
+    # Profile this request: X-Profile: 1 header or profile=1
+    profile = profiling.is_requested(request.headers.get('X-Profile')) or \
+        profiling.is_requested(request.values.get('profile'))
     
     # Check if query contains semicolons (batch query)
     if ';' in query:
-        result = db.execute_batch_query(db_name, query)
+        result = db.execute_batch_query(db_name, query, profile)
     else:
-        result = db.execute_query(db_name, query)
+        result = db.execute_query(db_name, query, profile,
+                                  request.values.get('read_preference') or READ_PREFERENCE)
     
     return jsonify(result)
 
@@ -683,6 +1584,43 @@ def drop_index(db_name, collection_name):
     success, message = db.drop_index(db_name, collection_name, field_name)
     return jsonify({"success": success, "message": message})
 
+@app.route('/bulk_insert/<db_name>/<collection_name>', methods=['POST'])
+def bulk_insert(db_name, collection_name):
+    # NDJSON body, plain or chunked, read as it arrives
+    chunks = iter(lambda: request.stream.read(64 * 1024), b"")
+    result = db.bulk_insert(db_name, collection_name, iter_lines(chunks), request.args.get('batch_size', type=int))
+    return jsonify(result)
+
+@app.route('/export/<db_name>/<collection_name>')
+def export_collection(db_name, collection_name):
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in EXPORT_MIMETYPES:
+        return jsonify({"error": f"Unknown export format '{export_format}'"}), 400
+    compress = request.args.get('gzip', '').lower() in ('1', 'true', 'yes')
+    chunks, error = db.export_collection(db_name, collection_name, export_format, compress)
+    if error:
+        return jsonify({"error": error}), 404
+    file_name = f"{collection_name}.{export_format}" + (".gz" if compress else "")
+    mimetype = "application/gzip" if compress else EXPORT_MIMETYPES[export_format]
+    return Response(chunks, mimetype=mimetype,
+                    headers={"Content-Disposition": f'attachment; filename="{file_name}"'})
+
+@app.route('/watch/<db_name>')
+def watch(db_name):
+    # Long poll for changes after resume_after, or with stream=1 NDJSON events as they commit
+    try:
+        options = watch_options(request.args)
+        timeout = float(request.args.get('timeout', DEFAULT_TIMEOUT))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if request.args.get('stream', '').lower() in ('1', 'true', 'yes'):
+        options.pop('max_events', None)
+        stream, error = db.open_change_stream(db_name, **options)
+        if error:
+            return jsonify({"error": error}), 404
+        return Response(db.change_streams.follow(stream, HEARTBEAT_INTERVAL), mimetype="application/x-ndjson")
+    return jsonify(db.watch(db_name, timeout=timeout, **options))
+
 @app.route('/list_indexes/<db_name>/<collection_name>')
 def list_indexes(db_name, collection_name):
     indexes = db.list_indexes(db_name, collection_name)
@@ -0,0 +1,666 @@
+"""Asyncio serving mode: an ASGI application over the same DocumentDB.
+
+Request handling runs on the event loop; every DocumentDB call is
+offloaded to a bounded thread pool, reads and writes to separate pools so
+a slow collection rewrite cannot hold up unrelated finds. Each database
+has a concurrency limit, and once too many requests are waiting for it
+new ones are rejected with 503 and Retry-After instead of queueing
+without bound.
+
+The JSON endpoints mirror app.py (HTML pages stay with the Flask app):
+
+    python asgi.py [--host 127.0.0.1] [--port 5001]   uvicorn if installed, else the built-in server
+    uvicorn asgi:app                                   any ASGI server
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, unquote
+
+from app import EXPORT_MIMETYPES, READ_PREFERENCE, db
+from batch_planner import READ_OPERATIONS
+from change_stream import DEFAULT_TIMEOUT, HEARTBEAT_INTERVAL, MAX_EVENTS, event_lines, heartbeat_line, watch_options
+from log_tail import LogGap
+import metrics
+import profiling
+from ndjson import iter_lines
+from query_parser import parse_batch_queries, parse_raw_query
+
+
+class Overloaded(Exception):
+    """Too many requests are waiting for a database"""
+
+
+class DatabaseLimiter:
+    """Per-database concurrency limit with bounded waiting.
+
+    At most `max_concurrency` requests of a database run at once; at most
+    `max_pending` (running plus waiting) are admitted, the rest raise
+    Overloaded. Only databases `known(db_name)` accepts get a limit of
+    their own; requests naming any other share one, so names made up by
+    clients do not add entries.
+    """
+
+    UNKNOWN = ""  # key of the limit shared by requests for unknown databases
+
+    def __init__(self, max_concurrency=8, max_pending=64, known=None):
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        self.known = known or (lambda db_name: True)
+        self.semaphores = {}  # db_name -> asyncio.Semaphore
+        self.pending = {}  # db_name -> admitted requests
+        self.rejected = 0
+
+    def slot(self, db_name):
+        if db_name and self.known(db_name):
+            return _Slot(self, db_name)
+        if db_name and db_name in self.semaphores and not self.pending[db_name]:
+            # Deleted since it was last used: forget its limit
+            del self.semaphores[db_name], self.pending[db_name]
+        return _Slot(self, self.UNKNOWN)
+
+
+class _Slot:
+    def __init__(self, limiter, db_name):
+        self.limiter = limiter
+        self.db_name = db_name
+
+    async def __aenter__(self):
+        limiter = self.limiter
+        if limiter.pending.get(self.db_name, 0) >= limiter.max_pending:
+            limiter.rejected += 1
+            raise Overloaded(self.db_name)
+        limiter.pending[self.db_name] = limiter.pending.get(self.db_name, 0) + 1
+        semaphore = limiter.semaphores.get(self.db_name)
+        if semaphore is None:
+            semaphore = limiter.semaphores[self.db_name] = asyncio.Semaphore(limiter.max_concurrency)
+        try:
+            await semaphore.acquire()
+        except BaseException:
+            limiter.pending[self.db_name] -= 1
+            raise
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.limiter.semaphores[self.db_name].release()
+        self.limiter.pending[self.db_name] -= 1
+
+
+class Request:
+    def __init__(self, scope, receive, params):
+        self.scope = scope
+        self.receive = receive
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.params = params
+        self.query = {k: v[-1] for k, v in parse_qs(scope.get("query_string", b"").decode("latin-1")).items()}
+        self.headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope.get("headers", [])}
+        self._body = None
+
+    async def stream(self):
+        """Request body chunks as they arrive"""
+        while True:
+            message = await self.receive()
+            if message["type"] == "http.disconnect":
+                return
+            if message.get("body"):
+                yield message["body"]
+            if not message.get("more_body"):
+                return
+
+    async def body(self, limit):
+        if self._body is None:
+            chunks, size = [], 0
+            async for chunk in self.stream():
+                size += len(chunk)
+                if size > limit:
+                    raise ValueError("Request body too large")
+                chunks.append(chunk)
+            self._body = b"".join(chunks)
+        return self._body
+
+    async def form(self, limit):
+        """Form fields (urlencoded or JSON object body)"""
+        body = await self.body(limit)
+        if self.headers.get("content-type", "").startswith("application/json"):
+            return json.loads(body or b"{}")
+        return {k: v[-1] for k, v in parse_qs(body.decode("utf-8")).items()}
+
+
+class AsyncServer:
+    """ASGI application dispatching to DocumentDB through bounded executors"""
+
+    def __init__(self, database=None, read_workers=8, write_workers=4, max_concurrency=8, max_pending=64,
+                 max_body_bytes=16 * 1024 * 1024):
+        self.db = database or db
+        self.read_executor = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix="read")
+        self.write_executor = ThreadPoolExecutor(max_workers=write_workers, thread_name_prefix="write")
+        self.limiter = DatabaseLimiter(max_concurrency, max_pending,
+                                       known=lambda name: self.db.catalog.has_database(name))
+        self.max_body_bytes = max_body_bytes
+        # Change stream requests wait on the event loop for log flushes,
+        # which one thread reports (see _wait_for_log)
+        self.log_waiters = []
+        self.log_watcher = None
+        self.closed = False
+        self.routes = []
+        self.route("POST", "/execute_query", self.execute_query)
+        self.route("POST", "/create_database", self.create_database)
+        self.route("POST", "/delete_database", self.delete_database)
+        self.route("POST", "/create_collection/<db_name>", self.create_collection)
+        self.route("POST", "/create_index/<db_name>/<collection_name>", self.create_index)
+        self.route("POST", "/drop_index/<db_name>/<collection_name>", self.drop_index)
+        self.route("POST", "/bulk_insert/<db_name>/<collection_name>", self.bulk_insert)
+        self.route("GET", "/export/<db_name>/<collection_name>", self.export_collection)
+        self.route("GET", "/list_indexes/<db_name>/<collection_name>", self.list_indexes)
+        self.route("GET", "/catalog", self.catalog)
+        self.route("GET", "/catalog/<db_name>", self.catalog)
+        self.route("GET", "/query_cache/stats", self.query_cache_stats)
+        self.route("GET", "/server/stats", self.server_stats)
+        self.route("GET", "/slow_queries", self.slow_queries)
+        self.route("GET", "/profiles", self.profiles)
+        self.route("GET", "/metrics", self.prometheus_metrics)
+        self.route("GET", "/replication", self.replication)
+        self.route("GET", "/watch/<db_name>", self.watch)
+
+    def route(self, method, pattern, handler):
+        regex = re.sub(r"<(\w+)>", r"(?P<\1>[^/]+)", pattern)
+        self.routes.append((method, re.compile(f"^{regex}$"), handler))
+
+    async def run(self, executor, db_name, function, *args):
+        """Run a blocking DocumentDB call in an executor, within the database's limit"""
+        async with self.limiter.slot(db_name):
+            return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+        for method, regex, handler in self.routes:
+            match = regex.match(scope["path"])
+            if match and method == scope["method"]:
+                request = Request(scope, receive, {k: unquote(v) for k, v in match.groupdict().items()})
+                try:
+                    response = await handler(request)
+                except Overloaded as e:
+                    overloaded = f"Database '{e}'" if str(e) else "Server"
+                    response = (503, {"error": f"{overloaded} is overloaded, retry later"}, [(b"retry-after", b"1")])
+                except ValueError as e:
+                    response = (400, {"error": str(e)})
+                except Exception as e:
+                    print(f"Error handling {scope['method']} {scope['path']}: {str(e)}")
+                    response = (500, {"error": str(e)})
+                await self._send(send, *response)
+                return
+        await self._send(send, 404, {"error": "Not found"})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    @staticmethod
+    async def _send(send, status, payload, headers=()):
+        if hasattr(payload, "__aiter__"):
+            # Streamed body: without a length the server sends it chunked
+            try:
+                await send({"type": "http.response.start", "status": status, "headers": list(headers)})
+                async for chunk in payload:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                await send({"type": "http.response.body", "body": b""})
+            finally:
+                await payload.aclose()
+            return
+        if isinstance(payload, bytes):
+            # Raw body; headers give its content type
+            body, content_type = payload, []
+        else:
+            body, content_type = json.dumps(payload).encode("utf-8"), [(b"content-type", b"application/json")]
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": content_type + [(b"content-length", str(len(body)).encode())] + list(headers),
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def _wait_for_log(self, seen, timeout):
+        """Wait until the logs were flushed since flush count `seen`, without holding a thread"""
+        transaction_manager = self.db.transaction_manager
+        if transaction_manager.log_flushes != seen:
+            return
+        loop = asyncio.get_running_loop()
+        if self.log_watcher is None:
+            self.log_watcher = threading.Thread(target=self._watch_log, args=(loop,), daemon=True)
+            self.log_watcher.start()
+        waiter = loop.create_future()
+        self.log_waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            if waiter in self.log_waiters:
+                self.log_waiters.remove(waiter)
+
+    def _watch_log(self, loop):
+        flushes = self.db.transaction_manager.log_flushes
+        while not self.closed:
+            count = self.db.transaction_manager.wait_for_log(flushes, 1.0)
+            if count != flushes:
+                flushes = count
+                loop.call_soon_threadsafe(self._wake_log_waiters)
+
+    def _wake_log_waiters(self):
+        waiters, self.log_waiters = self.log_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def close(self):
+        self.closed = True
+        self.read_executor.shutdown(wait=False)
+        self.write_executor.shutdown(wait=False)
+
+    # Endpoints
+
+    async def execute_query(self, request):
+        form = await request.form(self.max_body_bytes)
+        db_name, query = form.get("db_name"), form.get("query") or ""
+        profile = profiling.is_requested(request.headers.get("x-profile")) or \
+            profiling.is_requested(form.get("profile") or request.query.get("profile"))
+        if ';' in query:
+            statements, _ = parse_batch_queries(query)
+            read_only = bool(statements) and all(op in READ_OPERATIONS for op, _, _ in statements)
+            call = (self.db.execute_batch_query, db_name, query, profile)
+        else:
+            read_only = parse_raw_query(query)[0] in READ_OPERATIONS
+            read_preference = form.get("read_preference") or request.query.get("read_preference") or READ_PREFERENCE
+            call = (self.db.execute_query, db_name, query, profile, read_preference)
+        executor = self.read_executor if read_only else self.write_executor
+        return 200, await self.run(executor, db_name, *call)
+
+    async def create_database(self, request):
+        db_name = (await request.form(self.max_body_bytes)).get("db_name")
+        success, message = await self.run(self.write_executor, db_name, self.db.create_database, db_name)
+        return 200, {"success": success, "message": message}
+
+    async def delete_database(self, request):
+        db_name = (await request.form(self.max_body_bytes)).get("db_name")
+        success, message = await self.run(self.write_executor, db_name, self.db.delete_database, db_name)
+        return 200, {"success": success, "message": message}
+
+    async def create_collection(self, request):
+        form = await request.form(self.max_body_bytes)
+        db_name = request.params["db_name"]
+        if not form.get("collection_name"):
+            return 200, {"success": False, "message": "Collection name is required"}
+        success, message = await self.run(
+            self.write_executor, db_name, self.db.create_collection, db_name, form["collection_name"],
+            form.get("codec"), form.get("compression"), form.get("compression_level") or None,
+            form.get("partitions") or None
+        )
+        return 200, {"success": success, "message": message}
+
+    async def create_index(self, request):
+        field_name = (await request.form(self.max_body_bytes)).get("field_name")
+        if not field_name:
+            return 200, {"success": False, "message": "Field name is required"}
+        db_name = request.params["db_name"]
+        success, message = await self.run(
+            self.write_executor, db_name, self.db.create_index, db_name, request.params["collection_name"], field_name
+        )
+        return 200, {"success": success, "message": message}
+
+    async def drop_index(self, request):
+        field_name = (await request.form(self.max_body_bytes)).get("field_name")
+        db_name = request.params["db_name"]
+        success, message = await self.run(
+            self.write_executor, db_name, self.db.drop_index, db_name, request.params["collection_name"], field_name
+        )
+        return 200, {"success": success, "message": message}
+
+    async def bulk_insert(self, request):
+        """NDJSON body, handed to DocumentDB.bulk_insert as the worker thread asks for it"""
+        loop = asyncio.get_running_loop()
+        stream = request.stream()
+
+        async def next_chunk():
+            # Small chunks are joined so the worker thread is not woken per chunk
+            chunks, size = [], 0
+            while size < 64 * 1024:
+                try:
+                    chunk = await stream.__anext__()
+                except StopAsyncIteration:
+                    break
+                chunks.append(chunk)
+                size += len(chunk)
+            return b"".join(chunks) if chunks else None
+
+        def chunks():
+            while True:
+                chunk = asyncio.run_coroutine_threadsafe(next_chunk(), loop).result()
+                if chunk is None:
+                    return
+                yield chunk
+
+        db_name = request.params["db_name"]
+        batch_size = request.query.get("batch_size")
+        return 200, await self.run(
+            self.write_executor, db_name, self.db.bulk_insert, db_name, request.params["collection_name"],
+            iter_lines(chunks()), int(batch_size) if batch_size else None
+        )
+
+    async def export_collection(self, request):
+        """Dump chunks are produced on a read thread one at a time, while the database's slot is held"""
+        export_format = request.query.get("format", "ndjson")
+        if export_format not in EXPORT_MIMETYPES:
+            return 400, {"error": f"Unknown export format '{export_format}'"}
+        compress = request.query.get("gzip", "").lower() in ("1", "true", "yes")
+        db_name, collection_name = request.params["db_name"], request.params["collection_name"]
+        loop = asyncio.get_running_loop()
+        slot = self.limiter.slot(db_name)
+        await slot.__aenter__()
+        try:
+            chunks, error = await loop.run_in_executor(
+                self.read_executor, self.db.export_collection, db_name, collection_name, export_format, compress
+            )
+        except BaseException:
+            await slot.__aexit__(None, None, None)
+            raise
+        if error:
+            await slot.__aexit__(None, None, None)
+            return 404, {"error": error}
+
+        async def body():
+            try:
+                while True:
+                    chunk = await loop.run_in_executor(self.read_executor, next, chunks, None)
+                    if chunk is None:
+                        return
+                    yield chunk
+            finally:
+                chunks.close()
+                await slot.__aexit__(None, None, None)
+
+        file_name = f"{collection_name}.{export_format}" + (".gz" if compress else "")
+        content_type = "application/gzip" if compress else EXPORT_MIMETYPES[export_format]
+        return 200, body(), [(b"content-type", content_type.encode()),
+                             (b"content-disposition", f'attachment; filename="{file_name}"'.encode())]
+
+    async def watch(self, request):
+        """Long poll for changes after resume_after, or with stream=1 NDJSON events as they commit.
+
+        Each poll of the log runs on a read thread within the database's
+        limit; waiting for the next change does not take a slot or a thread.
+        """
+        options = watch_options(request.query)
+        timeout = float(request.query.get("timeout", DEFAULT_TIMEOUT))
+        db_name = request.params["db_name"]
+        collections, operations = options.get("collections"), options.get("operations")
+        resume_after = options.get("resume_after")
+        if request.query.get("stream", "").lower() in ("1", "true", "yes"):
+            stream, error = await self.run(self.read_executor, db_name, self.db.open_change_stream,
+                                           db_name, collections, operations, resume_after)
+            if error:
+                return 404, {"error": error}
+            return 200, self._follow(db_name, stream), [(b"content-type", b"application/x-ndjson")]
+        deadline = time.monotonic() + timeout
+        while True:
+            flushes = self.db.transaction_manager.log_flushes
+            result = await self.run(self.read_executor, db_name, self.db.watch, db_name, collections, operations,
+                                    resume_after, options.get("max_events", MAX_EVENTS))
+            remaining = deadline - time.monotonic()
+            if "error" in result or result["events"] or remaining <= 0:
+                return 200, result
+            resume_after = result["resume_token"]
+            await self._wait_for_log(flushes, remaining)
+
+    async def _follow(self, db_name, stream):
+        try:
+            last_sent = time.monotonic()
+            while True:
+                flushes = self.db.transaction_manager.log_flushes
+                try:
+                    events = await self.run(self.read_executor, db_name, stream.poll)
+                except LogGap as e:
+                    yield json.dumps({"error": f"Change stream interrupted: {str(e)}"}).encode("utf-8") + b"\n"
+                    return
+                if events:
+                    yield event_lines(events)
+                    last_sent = time.monotonic()
+                elif time.monotonic() - last_sent >= HEARTBEAT_INTERVAL:
+                    yield heartbeat_line(stream)
+                    last_sent = time.monotonic()
+                await self._wait_for_log(flushes, HEARTBEAT_INTERVAL)
+        finally:
+            stream.close()
+
+    # Catalog reads are in memory, so they are answered on the event loop
+
+    async def list_indexes(self, request):
+        return 200, {"indexes": self.db.list_indexes(request.params["db_name"], request.params["collection_name"])}
+
+    async def catalog(self, request):
+        db_name = request.params.get("db_name")
+        if db_name is not None and db_name not in self.db.list_databases():
+            return 404, {"error": f"Database '{db_name}' does not exist"}
+        return 200, self.db.catalog.describe(db_name)
+
+    async def query_cache_stats(self, request):
+        return 200, self.db.query_cache.stats()
+
+    async def server_stats(self, request):
+        return 200, {
+            "pending": dict(self.limiter.pending),
+            "rejected": self.limiter.rejected,
+            "max_concurrency": self.limiter.max_concurrency,
+            "max_pending": self.limiter.max_pending,
+        }
+
+    async def slow_queries(self, request):
+        return 200, self.db.slow_queries.stats(int(request.query.get("limit", 10)))
+
+    async def profiles(self, request):
+        return 200, {
+            "sample_rate": self.db.profiler.sample_rate,
+            "profiles": self.db.profiler.recent(int(request.query.get("limit", 20))),
+        }
+
+    async def prometheus_metrics(self, request):
+        return 200, metrics.render().encode("utf-8"), [(b"content-type", metrics.CONTENT_TYPE.encode())]
+
+    async def replication(self, request):
+        if self.db.replication is None:
+            return 200, {"role": "standalone"}
+        return 200, self.db.replication.status()
+
+
+app = AsyncServer()
+
+
+# Built-in HTTP/1.1 server for the ASGI application (keep-alive, Content-Length
+# and chunked request bodies, chunked responses when no length is given)
+
+_MAX_HEADER_BYTES = 64 * 1024
+
+
+class _BadRequest(Exception):
+    """A request the built-in server cannot read; answered with `status` and the connection closed"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+async def _read_head(reader):
+    try:
+        # The stream's limit is _MAX_HEADER_BYTES: a longer head overruns it
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.LimitOverrunError:
+        raise _BadRequest(431, "Request header fields too large")
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, target, version = lines[0].split(" ", 2)
+    except ValueError:
+        raise _BadRequest(400, "Malformed request line")
+    headers = []
+    for line in lines[1:]:
+        if line:
+            name, _, value = line.partition(":")
+            headers.append((name.strip().lower().encode("latin-1"), value.strip().encode("latin-1")))
+    return method, target, version, headers
+
+
+async def _reject(writer, error):
+    """Answer a request that was not read and close the connection"""
+    body = json.dumps({"error": str(error)}).encode("utf-8")
+    writer.write((f"HTTP/1.1 {error.status} {_REASONS[error.status]}\r\ncontent-type: application/json\r\n"
+                  f"content-length: {len(body)}\r\nconnection: close\r\n\r\n").encode("latin-1") + body)
+    await writer.drain()
+
+
+def _body_reader(reader, headers):
+    """Coroutine function returning successive ASGI http.request messages"""
+    header_map = dict(headers)
+    chunked = header_map.get(b"transfer-encoding", b"").lower() == b"chunked"
+    try:
+        remaining = int(header_map.get(b"content-length", b"0") or 0)
+    except ValueError:
+        raise _BadRequest(400, "Malformed Content-Length")
+    done = False
+
+    async def read_line():
+        try:
+            return await reader.readuntil(b"\r\n")
+        except asyncio.LimitOverrunError:
+            raise ValueError("Malformed chunked request body")
+
+    async def receive():
+        nonlocal remaining, done
+        if done:
+            return {"type": "http.disconnect"}
+        if chunked:
+            size = int((await read_line()).split(b";")[0], 16)
+            if size == 0:
+                while await read_line() != b"\r\n":
+                    pass  # trailers
+                done = True
+                return {"type": "http.request", "body": b"", "more_body": False}
+            data = await reader.readexactly(size)
+            await reader.readexactly(2)
+            return {"type": "http.request", "body": data, "more_body": True}
+        data = await reader.read(min(remaining, 64 * 1024)) if remaining else b""
+        if remaining and not data:
+            raise ConnectionError("Client closed the connection mid-body")
+        remaining -= len(data)
+        done = remaining == 0
+        return {"type": "http.request", "body": data, "more_body": not done}
+
+    async def drain():
+        while not done:
+            await receive()
+
+    return receive, drain
+
+
+async def _handle_connection(application, reader, writer):
+    try:
+        while True:
+            try:
+                method, target, version, headers = await _read_head(reader)
+                receive, drain = _body_reader(reader, headers)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return
+            except _BadRequest as e:
+                await _reject(writer, e)
+                return
+            path, _, query_string = target.partition("?")
+            scope = {
+                "type": "http", "asgi": {"version": "3.0"}, "http_version": version.split("/")[-1],
+                "method": method, "path": unquote(path), "raw_path": path.encode("latin-1"),
+                "query_string": query_string.encode("latin-1"), "headers": headers,
+                "client": writer.get_extra_info("peername"), "server": writer.get_extra_info("sockname"),
+            }
+            response = {"chunked": False}
+
+            async def send(message):
+                if message["type"] == "http.response.start":
+                    response_headers = list(message.get("headers", []))
+                    if not any(name.lower() == b"content-length" for name, _ in response_headers):
+                        response_headers.append((b"transfer-encoding", b"chunked"))
+                        response["chunked"] = True
+                    lines = [f"HTTP/1.1 {message['status']} {_REASONS.get(message['status'], 'Status')}"]
+                    lines += [f"{name.decode('latin-1')}: {value.decode('latin-1')}" for name, value in response_headers]
+                    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+                elif message["type"] == "http.response.body":
+                    body = message.get("body", b"")
+                    if response["chunked"]:
+                        if body:
+                            writer.write(b"%x\r\n%s\r\n" % (len(body), body))
+                        if not message.get("more_body"):
+                            writer.write(b"0\r\n\r\n")
+                    else:
+                        writer.write(body)
+                    await writer.drain()
+
+            await application(scope, receive, send)
+            await drain()
+            if dict(headers).get(b"connection", b"").lower() == b"close" or version == "HTTP/1.0":
+                return
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        return
+    finally:
+        writer.close()
+
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 431: "Request Header Fields Too Large",
+            500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+async def serve(application, host="127.0.0.1", port=5001, ready=None):
+    """Serve an ASGI application with the built-in server until cancelled"""
+    server = await asyncio.start_server(
+        lambda reader, writer: _handle_connection(application, reader, writer), host, port, limit=_MAX_HEADER_BYTES
+    )
+    if ready is not None:
+        ready(server.sockets[0].getsockname()[1])
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the database API with asyncio")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 5001)))
+    parser.add_argument("--builtin", action="store_true", help="use the built-in server even if uvicorn is installed")
+    args = parser.parse_args()
+    try:
+        import uvicorn
+    except ImportError:
+        uvicorn = None
+    print(f"Serving on http://{args.host}:{args.port} ({time.strftime('%H:%M:%S')})")
+    try:
+        if uvicorn is not None and not args.builtin:
+            uvicorn.run(app, host=args.host, port=args.port)
+        else:
+            asyncio.run(serve(app, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        app.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from collection_file import CollectionFile
+from profiling import traced
+
+# Statement kinds by the access they need on their collection
+READ_OPERATIONS = {'find', 'explain'}
+WRITE_OPERATIONS = {'insert', 'insert_many', 'update', 'delete', 'create_collection',
+                    'create_index', 'drop_index'}
+
+
+def plan_batch(parsed_queries):
+    """Split a batch into groups of statement indexes that can run concurrently.
+
+    Two statements conflict when they touch the same collection and at least
+    one of them writes it; conflicting statements share a group and keep
+    their batch order. Statements on a collection that is only read are
+    independent of each other and each get a group of their own.
+    """
+    by_collection = {}
+    for idx, (operation, collection, _) in enumerate(parsed_queries):
+        by_collection.setdefault(collection, []).append(idx)
+
+    groups = []
+    for collection, indexes in by_collection.items():
+        if any(parsed_queries[idx][0] not in READ_OPERATIONS for idx in indexes):
+            groups.append(indexes)
+        else:
+            groups.extend([idx] for idx in indexes)
+    return sorted(groups, key=lambda group: group[0])
+
+
+def match(doc, query):
+    return all(doc.get(k) == v for k, v in query.items())
+
+
+def _match_file(args):
+    """Positions of the matching documents of a collection file (runs in a worker process).
+
+    Returns None if the file was replaced since the caller opened it, so
+    the positions could not refer to the caller's version.
+    """
+    path, identity, query = args
+    try:
+        collection = CollectionFile(path)
+    except (OSError, ValueError):
+        return None
+    try:
+        if collection.identity != identity:
+            return None
+        return [position for position, doc in enumerate(collection) if match(doc, query)]
+    finally:
+        collection.close()
+
+
+def scan_context():
+    """Start method of scan workers: forkserver where the platform has it, else spawn.
+
+    Never fork: the server is threaded, and a forked child inherits every
+    lock another thread held at that moment.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+class ScanPool:
+    """Worker processes for filter scans of large partitioned collections.
+
+    Workers read the partition files themselves, so only the positions of
+    the matches come back; documents are never pickled. Process scans only
+    pay off above a size that depends on the machine, so they are off
+    unless `threshold` (documents in the unchanged partitions of a scan) is
+    set, from `benchmarks/bench_partition_scan.py --crossover`. Every other
+    filter runs in the calling thread.
+    """
+
+    def __init__(self, max_workers=None, threshold=None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.threshold = threshold
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Create the worker pool, if process scans are enabled; call at startup"""
+        with self.lock:
+            if self.executor is None and self.threshold is not None and self.max_workers > 1:
+                self.executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=scan_context())
+
+    @traced("match")
+    def filter(self, documents, query):
+        if not query:
+            return list(documents)
+        return [doc for doc in documents if match(doc, query)]
+
+    @traced("match_files")
+    def scan_files(self, files, query):
+        """Matching positions in each CollectionFile, one worker per file.
+
+        An entry is None where the file was None or could not be scanned by a
+        worker, and for every file when the scan is below the threshold; the
+        caller filters those documents itself.
+        """
+        total = sum(len(collection) for collection in files if collection is not None)
+        executor = self.executor
+        if not query or executor is None or total < self.threshold:
+            return [None] * len(files)
+        futures = [
+            executor.submit(_match_file, (collection.path, collection.identity, query))
+            if collection is not None and collection.identity is not None else None
+            for collection in files
+        ]
+        return [future.result() if future is not None else None for future in futures]
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
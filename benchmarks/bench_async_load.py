@@ -0,0 +1,122 @@
+"""Mixed-traffic load test: the asyncio server (asgi.py) against the threaded Flask server.
+
+Client threads issue point reads and inserts on a small collection while
+one client keeps rewriting a large collection with a full-collection
+update. Reports p50/p99 latency per request type, throughput and 503
+(overloaded) responses for each server.
+
+    python benchmarks/bench_async_load.py [--seconds 10] [--clients 16] [--archive-docs 100000]
+"""
+import argparse
+import asyncio
+import http.client
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def client(port, kind, deadline, results, seed):
+    rng = random.Random(seed)
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+    headers = {"Content-Type": "application/x-www-form-urlencoded"}
+    counter = 0
+    while time.perf_counter() < deadline:
+        counter += 1
+        if kind == "rewrite":
+            query = f'db.archive.update({{"kind": "a"}}, {{"$set": {{"touched": {counter}}}}})'
+            label = "rewrite"
+        elif rng.random() < 0.8:
+            query = f'db.events.find({{"_id": "e{rng.randrange(1000)}"}})'
+            label = "read"
+        else:
+            query = f'db.events.insert({{"_id": "{seed}-{counter}", "kind": "view"}})'
+            label = "insert"
+        start = time.perf_counter()
+        connection.request("POST", "/execute_query", urlencode({"db_name": "bench", "query": query}), headers)
+        response = connection.getresponse()
+        response.read()
+        results.append((label, time.perf_counter() - start, response.status))
+    connection.close()
+
+
+def run_load(port, args):
+    results = []
+    deadline = time.perf_counter() + args.seconds
+    threads = [threading.Thread(target=client, args=(port, "rewrite", deadline, results, 0))]
+    threads += [threading.Thread(target=client, args=(port, "mixed", deadline, results, i + 1))
+                for i in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def report(label, results, seconds):
+    print(f"{label}: {len(results) / seconds:.1f} requests/s, "
+          f"{sum(1 for _, _, status in results if status == 503)} rejected (503)")
+    for kind in ("read", "insert", "rewrite"):
+        latencies = [latency for k, latency, status in results if k == kind and status == 200]
+        print(f"  {kind:8s} n={len(latencies):6d}  p50 {percentile(latencies, 0.5) * 1000:8.1f} ms  "
+              f"p99 {percentile(latencies, 0.99) * 1000:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--archive-docs", type=int, default=100000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as base_dir:
+        os.environ["MANGODB_DATABASES_DIR"] = base_dir
+        from werkzeug.serving import make_server
+        from app import app as flask_app, db
+        from asgi import app as asgi_app, serve
+        from collection_file import save_documents
+
+        db.create_database("bench")
+        db.create_collection("bench", "events")
+        db.create_collection("bench", "archive")
+        db_path = os.path.join(base_dir, "bench")
+        save_documents(db_path, "events", [{"_id": f"e{i}", "kind": "view"} for i in range(1000)])
+        save_documents(db_path, "archive", [{"_id": f"a{i}", "kind": "a", "payload": "x" * 64}
+                                            for i in range(args.archive_docs)])
+
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        server = make_server("127.0.0.1", 0, flask_app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        report("flask (threaded)", run_load(server.server_port, args), args.seconds)
+        server.shutdown()
+
+        ready = threading.Event()
+        port = []
+        loop = asyncio.new_event_loop()
+
+        def run_async_server():
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(serve(asgi_app, "127.0.0.1", 0,
+                                          ready=lambda p: (port.append(p), ready.set())))
+
+        threading.Thread(target=run_async_server, daemon=True).start()
+        ready.wait()
+        report("asyncio (asgi.py)", run_load(port[0], args), args.seconds)
+        asgi_app.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Compare serial and concurrent execution of batches spanning several collections.
+
+Each batch holds a find, an update and an insert per collection (mixed) or
+only finds (read-only). The same batches run with statement concurrency
+disabled and enabled.
+
+    python benchmarks/bench_batch_parallel.py [--collections 8] [--docs 20000] [--batches 5]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def build(db, collections, docs):
+    db.create_database("bench")
+    for c in range(collections):
+        db.create_collection("bench", f"coll{c}")
+        statements = "; ".join(
+            f'db.coll{c}.insertMany([' + ", ".join(
+                f'{{"_id": "c{c}d{i}", "group": {i % 100}, "value": {random.randint(0, 1000)}}}'
+                for i in range(start, min(start + 1000, docs))
+            ) + '])'
+            for start in range(0, docs, 1000)
+        )
+        result = db.execute_batch_query("bench", statements)
+        if "error" in result:
+            raise RuntimeError(result["error"])
+
+
+def mixed_batch(collections, round_no):
+    statements = []
+    for c in range(collections):
+        statements.append(f'db.coll{c}.find({{"group": {round_no % 100}}})')
+        statements.append(f'db.coll{c}.update({{"group": {round_no % 100}}}, {{"$set": {{"value": {round_no}}}}})')
+        statements.append(f'db.coll{c}.insert({{"_id": "r{round_no}c{c}", "group": 0}})')
+    return "; ".join(statements)
+
+
+def read_batch(collections, round_no):
+    return "; ".join(
+        f'db.coll{c}.find({{"group": {(round_no + q) % 100}}})'
+        for c in range(collections) for q in range(3)
+    )
+
+
+def run(db, make_batch, collections, batches, workers, first_round):
+    db.max_batch_workers = workers
+    start = time.perf_counter()
+    for round_no in range(first_round, first_round + batches):
+        result = db.execute_batch_query("bench", make_batch(collections, round_no))
+        if "error" in result:
+            raise RuntimeError(result["error"])
+    return (time.perf_counter() - start) / batches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--collections", type=int, default=8)
+    parser.add_argument("--docs", type=int, default=20000, help="documents per collection")
+    parser.add_argument("--batches", type=int, default=5)
+    args = parser.parse_args()
+
+    random.seed(42)
+    with tempfile.TemporaryDirectory() as base_dir:
+        os.environ["MANGODB_DATABASES_DIR"] = base_dir
+        from app import db
+
+        build(db, args.collections, args.docs)
+        print(f"{args.collections} collections x {args.docs} documents, "
+              f"{os.cpu_count()} CPUs, {args.batches} batches per run")
+        round_no = 1
+        for label, make_batch in (("mixed", mixed_batch), ("read-only", read_batch)):
+            serial = run(db, make_batch, args.collections, args.batches, 1, round_no)
+            round_no += args.batches
+            concurrent = run(db, make_batch, args.collections, args.batches, 4, round_no)
+            round_no += args.batches
+            print(f"{label:10s} serial {serial * 1000:8.1f} ms/batch   "
+                  f"concurrent {concurrent * 1000:8.1f} ms/batch   speedup {serial / concurrent:.2f}x")
+        db.scan_pool.shutdown()
+
+
+if __name__ == "__main__":
+    main()
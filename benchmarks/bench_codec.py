@@ -0,0 +1,68 @@
+"""Compare document codecs: encode and decode throughput and file size.
+
+Writes the same documents as the previous JSON array format (indent=2),
+as a collection file with the JSON codec and with the binary codec, then
+reads every document back.
+
+    python benchmarks/bench_codec.py [--docs 100000]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from collection_file import read_documents, save_documents  # noqa: E402
+
+
+def make_documents(count):
+    return [
+        {
+            "_id": f"user{i}",
+            "name": f"User {i}",
+            "age": 18 + i % 60,
+            "score": i * 0.25,
+            "active": i % 3 == 0,
+            "tags": ["a", "b", "c"][: i % 4],
+            "address": {"city": f"City {i % 100}", "zip": 10000 + i % 9000},
+        }
+        for i in range(count)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--docs", type=int, default=100000)
+    args = parser.parse_args()
+    documents = make_documents(args.docs)
+
+    with tempfile.TemporaryDirectory() as db_path:
+        legacy = os.path.join(db_path, "legacy.json")
+        start = time.perf_counter()
+        with open(legacy, "w") as f:
+            json.dump(documents, f, indent=2)
+        write = time.perf_counter() - start
+        start = time.perf_counter()
+        with open(legacy) as f:
+            json.load(f)
+        read = time.perf_counter() - start
+        print(f"{'json array':12s} {os.path.getsize(legacy):12d} bytes   "
+              f"encode {args.docs / write:10.0f} docs/s   decode {args.docs / read:10.0f} docs/s")
+
+        for codec in ("json", "binary"):
+            start = time.perf_counter()
+            save_documents(db_path, codec, documents, codec)
+            write = time.perf_counter() - start
+            start = time.perf_counter()
+            assert read_documents(db_path, codec) == documents
+            read = time.perf_counter() - start
+            size = os.path.getsize(os.path.join(db_path, f"{codec}.col"))
+            print(f"{codec:12s} {size:12d} bytes   "
+                  f"encode {args.docs / write:10.0f} docs/s   decode {args.docs / read:10.0f} docs/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Scan throughput vs. file size for each block compression setting.
+
+Writes the same collection with every compression method and level, then
+measures a full scan (every document decoded), random lookups by _id
+with a cold and a warm block cache, and the size of an index file over
+the collection.
+
+    python benchmarks/bench_compression.py [--docs 100000] [--codec json|binary] [--lookups 2000]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from block_compression import Compression, block_cache  # noqa: E402
+from collection_file import CollectionFile, collection_path, save_documents  # noqa: E402
+from indexing import IndexManager  # noqa: E402
+
+SETTINGS = [("none", None), ("zlib", 1), ("zlib", 6), ("zlib", 9), ("lzma", 0), ("lzma", 6)]
+
+
+def make_documents(count):
+    cities = ["Berlin", "Lisbon", "Osaka", "Quito", "Perth", "Oslo"]
+    return [
+        {
+            "_id": f"order{i:08d}",
+            "customer": f"customer{i % 5000}",
+            "status": ["new", "paid", "shipped", "delivered"][i % 4],
+            "city": cities[i % len(cities)],
+            "total": round(i * 0.37 % 500, 2),
+            "items": [{"sku": f"sku{(i + k) % 300}", "qty": 1 + k} for k in range(i % 3 + 1)],
+        }
+        for i in range(count)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--docs", type=int, default=100000)
+    parser.add_argument("--codec", default="json")
+    parser.add_argument("--lookups", type=int, default=2000)
+    args = parser.parse_args()
+    documents = make_documents(args.docs)
+    lookups = random.Random(1).sample(range(args.docs), min(args.lookups, args.docs))
+
+    with tempfile.TemporaryDirectory() as db_path:
+        print(f"{'compression':12s} {'file bytes':>12s} {'index bytes':>12s} {'scan docs/s':>12s} "
+              f"{'cold get/s':>11s} {'warm get/s':>11s}")
+        for name, level in SETTINGS:
+            compression = Compression(name, level)
+            collection = f"orders_{name}_{compression.level}"
+            save_documents(db_path, collection, documents, args.codec, compression)
+            size = os.path.getsize(collection_path(db_path, collection))
+
+            indexes = IndexManager(db_path)
+            indexes.create_index(collection, "customer")
+            # Bulk build in key order
+            for customer, doc_id in sorted((doc["customer"], doc["_id"]) for doc in documents):
+                indexes.update_index(collection, "customer", customer, doc_id)
+            indexes.flush()
+            index_size = os.path.getsize(indexes._get_index_path(collection, "customer"))
+
+            block_cache.clear()
+            file = CollectionFile(collection_path(db_path, collection))
+            start = time.perf_counter()
+            scanned = sum(1 for _ in file)
+            scan = scanned / (time.perf_counter() - start)
+
+            rates = []
+            for _ in ("cold", "warm"):
+                if not rates:
+                    block_cache.clear()
+                start = time.perf_counter()
+                for position in lookups:
+                    file.document(position)
+                rates.append(len(lookups) / (time.perf_counter() - start))
+            file.close()
+            print(f"{compression!r:12s} {size:12d} {index_size:12d} {scan:12.0f} {rates[0]:11.0f} {rates[1]:11.0f}")
+
+
+if __name__ == "__main__":
+    main()
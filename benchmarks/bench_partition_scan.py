@@ -0,0 +1,111 @@
+"""Filter scan throughput of a collection split into 1..N partitions.
+
+Each run stores the same documents with a different partition count and
+times a non-indexed find through a WriteSet, as a batch statement runs
+it. With partitions, each worker process scans one partition file and
+sends back the positions of the matches; a single file is scanned in the
+calling thread.
+
+`--crossover` instead times scans of growing collections, each split into
+one partition per worker, in the calling thread and on worker processes,
+and prints the smallest size from which the workers are faster: the
+ScanPool threshold (MANGODB_SCAN_PROCESS_THRESHOLD) for this machine.
+
+    python benchmarks/bench_partition_scan.py [--docs 1000000] [--partitions 1,2,4,8] [--workers N]
+    python benchmarks/bench_partition_scan.py --crossover [--docs 1000000] [--workers N]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from batch_planner import ScanPool  # noqa: E402
+from collection_file import save_documents  # noqa: E402
+from write_set import WriteSet  # noqa: E402
+
+
+def make_documents(count):
+    return [
+        {"_id": f"event{i}", "kind": ["click", "view", "buy", "share"][i % 4],
+         "user": f"user{i % 10007}", "region": ["eu", "us", "apac"][i % 3], "value": i % 1000}
+        for i in range(count)
+    ]
+
+
+def best_time(db_path, pool, query, expected, repeat):
+    best = None
+    for _ in range(repeat + 1):  # the first run starts the worker processes
+        write_set = WriteSet(db_path)
+        start = time.perf_counter()
+        found = len(write_set.match("events", query, pool))
+        duration = time.perf_counter() - start
+        write_set.discard()
+        assert found == expected, (found, expected)
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+def crossover(args, query):
+    threads = ScanPool(max_workers=args.workers)
+    processes = ScanPool(max_workers=args.workers, threshold=0)
+    processes.start()
+    if processes.executor is None:
+        print("one CPU: scans stay in the calling thread")
+        return
+    sizes = [size for size in (10000, 25000, 50000, 100000, 250000, 500000, 1000000, 2500000) if size <= args.docs]
+    print(f"{processes.max_workers} partitions and worker processes")
+    threshold = None
+    with tempfile.TemporaryDirectory() as db_path:
+        for size in sizes:
+            documents = make_documents(size)
+            expected = sum(1 for doc in documents if all(doc[k] == v for k, v in query.items()))
+            save_documents(db_path, "events", documents, partitions=processes.max_workers)
+            in_thread = best_time(db_path, threads, query, expected, args.repeat)
+            in_workers = best_time(db_path, processes, query, expected, args.repeat)
+            if in_workers < in_thread:
+                threshold = size if threshold is None else threshold
+            else:
+                threshold = None
+            print(f"{size:9d} documents: thread {in_thread:7.3f}s  workers {in_workers:7.3f}s  "
+                  f"speedup {in_thread / in_workers:5.2f}x")
+    processes.shutdown()
+    if threshold is None:
+        print("workers were not faster at any size: leave process scans off")
+    else:
+        print(f"threshold: MANGODB_SCAN_PROCESS_THRESHOLD={threshold}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--docs", type=int, default=1000000)
+    parser.add_argument("--partitions", default="1,2,4,8")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--crossover", action="store_true", help="measure the ScanPool threshold")
+    args = parser.parse_args()
+    query = {"kind": "buy", "region": "eu"}
+    if args.crossover:
+        crossover(args, query)
+        return
+    documents = make_documents(args.docs)
+    expected = sum(1 for doc in documents if all(doc[k] == v for k, v in query.items()))
+    pool = ScanPool(max_workers=args.workers, threshold=0)
+    pool.start()
+    print(f"{args.docs} documents, {pool.max_workers} worker processes, {expected} matches")
+
+    with tempfile.TemporaryDirectory() as db_path:
+        baseline = None
+        for partitions in (int(n) for n in args.partitions.split(",")):
+            save_documents(db_path, "events", documents, partitions=partitions)
+            best = best_time(db_path, pool, query, expected, args.repeat)
+            baseline = baseline or best
+            print(f"{partitions:3d} partitions: {best:7.3f}s  {args.docs / best:12.0f} docs/s  "
+                  f"speedup {baseline / best:5.2f}x")
+    pool.shutdown()
+
+
+if __name__ == "__main__":
+    main()
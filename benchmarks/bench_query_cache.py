@@ -0,0 +1,55 @@
+"""Repeated find queries with and without the query result cache.
+
+A dashboard-like workload: a few distinct find queries issued over and
+over against one collection, with an insert every --write-every reads.
+Reports reads per second and the cache's hit ratio.
+
+    python benchmarks/bench_query_cache.py [--docs 50000] [--reads 300] [--write-every 50]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+QUERIES = ['db.events.find({"kind": "buy"})', 'db.events.find({"region": "eu", "kind": "view"})',
+           'db.events.find({"user": "user42"})']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--docs", type=int, default=50000)
+    parser.add_argument("--reads", type=int, default=300)
+    parser.add_argument("--write-every", type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as base_dir:
+        os.environ["MANGODB_DATABASES_DIR"] = base_dir
+        from app import db
+        from collection_file import save_documents
+        from query_cache import QueryCache
+
+        db.create_database("bench")
+        db.create_collection("bench", "events")
+        save_documents(os.path.join(base_dir, "bench"), "events", [
+            {"_id": f"e{i}", "kind": ["click", "view", "buy"][i % 3], "region": ["eu", "us"][i % 2],
+             "user": f"user{i % 1000}"}
+            for i in range(args.docs)
+        ])
+        for label, max_bytes in (("no cache", 0), ("cache", 64 * 1024 * 1024)):
+            db.query_cache = QueryCache(max_bytes)
+            start = time.perf_counter()
+            for i in range(args.reads):
+                if args.write_every and i % args.write_every == args.write_every - 1:
+                    db.execute_query("bench", f'db.events.insert({{"_id": "{label}{i}", "kind": "buy"}})')
+                db.execute_query("bench", QUERIES[i % len(QUERIES)])
+            duration = time.perf_counter() - start
+            stats = db.query_cache.stats()
+            print(f"{label:9s} {args.reads / duration:9.1f} reads/s   hit ratio {stats['hit_ratio']:.2f}   "
+                  f"cached {stats['bytes']} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Measure crash recovery time over a synthetic transaction log.
+
+Writes a log of roughly --size-mb megabytes (committed inserts and updates
+spread over several collections, plus a few in-flight transactions), leaves
+the collection files empty as if the crash happened before any data was
+flushed, then runs TransactionManager.recover_from_checkpoint.
+
+    python benchmarks/bench_recovery.py [--size-mb 64] [--collections 8] [--workers N]
+
+Use --size-mb 2048 or more for the multi-gigabyte case.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from collection_file import create_collection_file  # noqa: E402
+from transaction_manager import TransactionManager  # noqa: E402
+
+
+def build_log(base_dir, size_mb, collections, fields):
+    """Generate the log through the transaction manager; returns record count"""
+    os.makedirs(os.path.join(base_dir, "bench"), exist_ok=True)
+    names = [f"coll{i}" for i in range(collections)]
+    for name in names:
+        create_collection_file(os.path.join(base_dir, "bench"), name)
+
+    tm = TransactionManager(base_dir)
+    target = size_mb * 1024 * 1024
+    docs = {name: [] for name in names}
+    operations = 0
+    while tm.next_lsn == 1 or log_size(tm) < target:
+        transaction_id = tm.begin_transaction()
+        for _ in range(10):
+            name = random.choice(names)
+            if not docs[name] or random.random() < 0.3:
+                doc = {"_id": str(uuid.uuid4())}
+                doc.update({f"field_{i}": "x" * 20 for i in range(fields)})
+                tm.log_operation(transaction_id, "insert", "bench", name, doc["_id"], None, doc)
+                docs[name].append(doc)
+            else:
+                doc = random.choice(docs[name])
+                before = dict(doc)
+                doc[f"field_{random.randrange(fields)}"] = random.randint(0, 1_000_000)
+                tm.log_operation(transaction_id, "update", "bench", name, doc["_id"], before, dict(doc))
+            operations += 1
+        tm.commit_transaction(transaction_id)
+
+    # A few transactions in flight at the time of the crash
+    for _ in range(5):
+        transaction_id = tm.begin_transaction()
+        doc = {"_id": str(uuid.uuid4()), "in_flight": True}
+        tm.log_operation(transaction_id, "insert", "bench", names[0], doc["_id"], None, doc)
+        operations += 1
+
+    size = log_size(tm)
+    for writer in tm.log_writers.values():
+        writer.close()
+    return operations, size
+
+
+def log_size(tm):
+    """Bytes of log written so far (segments are preallocated, so not file sizes)"""
+    writer = tm.log_writers["bench"]
+    return (len(writer.segments) - 1) * writer.segment_size + writer.offset
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=64)
+    parser.add_argument("--collections", type=int, default=8)
+    parser.add_argument("--fields", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    random.seed(42)
+    with tempfile.TemporaryDirectory() as base_dir:
+        start = time.perf_counter()
+        operations, log_size = build_log(base_dir, args.size_mb, args.collections, args.fields)
+        print(f"log generated:     {log_size / 1024 / 1024:.1f} MiB, {operations} operations "
+              f"in {time.perf_counter() - start:.1f}s")
+
+        tm = TransactionManager(base_dir)
+        success, message = tm.recover_from_checkpoint(max_workers=args.workers)
+        stats = tm.recovery_stats
+        print(message)
+        if success:
+            print(f"recovery time:     {stats['duration']:.2f}s")
+            print(f"records replayed:  {stats['records_redone'] + stats['records_undone']}")
+            print(f"log throughput:    {log_size / 1024 / 1024 / stats['duration']:.1f} MiB/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Compare the legacy JSON-lines transaction log with the binary WAL format.
+
+Runs an update-heavy workload (each update changes one or two fields of a
+large document) and reports log size and append throughput for both formats.
+
+    python benchmarks/bench_wal_format.py [--updates N] [--fields N]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wal import SegmentedWALWriter, read_records  # noqa: E402
+
+
+def make_document(fields):
+    doc = {"_id": str(uuid.uuid4())}
+    for i in range(fields):
+        doc[f"field_{i}"] = f"value {i} " + "x" * random.randint(5, 40)
+    return doc
+
+
+def workload(updates, fields, documents=100):
+    """Yield (transaction_id, doc_id, before, after) for an update-heavy mix"""
+    docs = [make_document(fields) for _ in range(documents)]
+    for _ in range(updates):
+        doc = random.choice(docs)
+        before = dict(doc)
+        for _ in range(random.randint(1, 2)):
+            doc[f"field_{random.randrange(fields)}"] = random.randint(0, 1_000_000)
+        yield str(uuid.uuid4()), doc["_id"], before, dict(doc)
+
+
+def run_json(path, ops):
+    """The pre-WAL format: one JSON object per line, file reopened per append"""
+    start = time.perf_counter()
+    for transaction_id, doc_id, before, after in ops:
+        log_entry = {
+            "transaction_id": transaction_id,
+            "timestamp": datetime.now().isoformat(),
+            "operation": "update",
+            "db_name": "bench",
+            "collection": "documents",
+            "document_id": doc_id,
+            "before_state": before,
+            "after_state": after,
+            "isolation_level": "repeatable_read",
+        }
+        with open(path, "a") as f:
+            f.write(json.dumps(log_entry) + "\n")
+    return time.perf_counter() - start
+
+
+def run_wal(directory, ops):
+    """Returns (elapsed, bytes written, segment paths)"""
+    start = time.perf_counter()
+    writer = SegmentedWALWriter(directory)
+    written = 0
+    for lsn, (transaction_id, doc_id, before, after) in enumerate(ops, start=1):
+        written += writer.append(lsn, time.time(), transaction_id, "repeatable_read", "update",
+                                 "bench", "documents", doc_id, before, after)
+    writer.close()
+    return time.perf_counter() - start, written, writer.paths()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=20000)
+    parser.add_argument("--fields", type=int, default=40)
+    args = parser.parse_args()
+
+    random.seed(42)
+    ops = list(workload(args.updates, args.fields))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path = os.path.join(tmp, "bench_transactions.log")
+        json_time = run_json(json_path, ops)
+        wal_time, wal_size, segments = run_wal(os.path.join(tmp, "bench"), ops)
+        json_size = os.path.getsize(json_path)
+
+        start = time.perf_counter()
+        replayed = sum(1 for path in segments for _ in read_records(path))
+        read_time = time.perf_counter() - start
+
+    print(f"updates:          {args.updates} ({args.fields} fields per document)")
+    print(f"json log size:    {json_size / 1024:.1f} KiB ({json_size / args.updates:.0f} B/record)")
+    print(f"binary log size:  {wal_size / 1024:.1f} KiB ({wal_size / args.updates:.0f} B/record)")
+    print(f"size reduction:   {json_size / wal_size:.1f}x")
+    print(f"json appends/s:   {args.updates / json_time:,.0f}")
+    print(f"binary appends/s: {args.updates / wal_time:,.0f}")
+    print(f"binary reads/s:   {replayed / read_time:,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Measure single-statement insert throughput under concurrent writers.
+
+Each thread runs DocumentDB.execute_query inserts against one collection,
+as concurrent /execute_query requests do. Reports throughput, how many
+writes each apply-and-persist cycle coalesced, and checks that no write was
+lost.
+
+    python benchmarks/bench_write_coalescing.py [--threads 1,4,16,64] [--writes 2000] [--docs 5000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def run(db, collection, threads, writes):
+    per_thread = writes // threads
+    errors = []
+
+    def writer(thread_no):
+        for i in range(per_thread):
+            result = db.execute_query(
+                "bench", f'db.{collection}.insert({{"_id": "t{thread_no}w{i}", "value": {i}}})'
+            )
+            if "error" in result:
+                errors.append(result["error"])
+
+    workers = [threading.Thread(target=writer, args=(n,)) for n in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return per_thread * threads, time.perf_counter() - start, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", default="1,4,16,64")
+    parser.add_argument("--writes", type=int, default=2000, help="inserts per run")
+    parser.add_argument("--docs", type=int, default=5000, help="documents already in the collection")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as base_dir:
+        os.environ["MANGODB_DATABASES_DIR"] = base_dir
+        from app import db
+        from collection_file import read_documents, save_documents
+
+        db.create_database("bench")
+        for threads in (int(n) for n in args.threads.split(",")):
+            collection = f"coll{threads}"
+            db.create_collection("bench", collection)
+            save_documents(os.path.join(base_dir, "bench"), collection,
+                           [{"_id": f"seed{i}", "value": i} for i in range(args.docs)])
+
+            writes, duration, errors = run(db, collection, threads, args.writes)
+            queue = db.write_queues[("bench", collection)]
+            stored = len(read_documents(os.path.join(base_dir, "bench"), collection)) - args.docs
+            print(f"{threads:3d} threads: {writes / duration:8.1f} writes/s   "
+                  f"{queue.writes / queue.groups:6.1f} writes/group   "
+                  f"stored {stored}/{writes}   errors {len(errors)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,360 @@
+"""Benchmark suite: storage operations, indexes, parser, locks and the log.
+
+Runs every benchmark against synthetic data of the chosen size and writes
+the results as JSON; `compare` flags regressions between two result files.
+
+    python benchmarks/suite.py run [--size 10k|100k|1m] [--only find_by_id,parser] [--output FILE]
+                                   [--max-seconds 5]
+    python benchmarks/suite.py compare BASE.json NEW.json [--threshold 0.1]
+
+Every result has `ops`, `seconds` and `ops_per_sec` (the figure compare
+uses), plus p50/p99 latencies in milliseconds where single operations are
+timed. Operations that rewrite the collection get slower with its size,
+so each benchmark stops after --max-seconds.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SIZES = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+CITIES = [f"City {i}" for i in range(100)]
+
+
+def make_documents(count, seed=42, prefix="doc"):
+    """Synthetic documents with a string _id, numbers, a string, a list and a nested object"""
+    rng = random.Random(seed)
+    for i in range(count):
+        yield {
+            "_id": f"{prefix}{i:07d}",
+            "name": f"User {i}",
+            "age": rng.randrange(18, 90),
+            "city": rng.choice(CITIES),
+            "score": round(rng.random() * 100, 2),
+            "active": rng.random() < 0.5,
+            "tags": rng.sample(["a", "b", "c", "d", "e"], rng.randrange(0, 4)),
+            "address": {"zip": rng.randrange(10000, 99999), "street": f"{rng.randrange(1, 500)} Main St"},
+        }
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0.0
+
+
+def timed(operation, max_ops, max_seconds):
+    """Call operation(i) until max_ops calls or max_seconds; throughput and latencies"""
+    latencies = []
+    start = time.perf_counter()
+    for i in range(max_ops):
+        began = time.perf_counter()
+        operation(i)
+        latencies.append(time.perf_counter() - began)
+        if began - start > max_seconds:
+            break
+    seconds = time.perf_counter() - start
+    return {
+        "ops": len(latencies),
+        "seconds": round(seconds, 6),
+        "ops_per_sec": round(len(latencies) / seconds, 3) if seconds else 0.0,
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 4),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 4),
+    }
+
+
+def throughput(ops, seconds, **extra):
+    result = {"ops": ops, "seconds": round(seconds, 6), "ops_per_sec": round(ops / seconds, 3) if seconds else 0.0}
+    result.update(extra)
+    return result
+
+
+def check(result):
+    if isinstance(result, dict) and "error" in result:
+        raise RuntimeError(result["error"])
+    return result
+
+
+class Context:
+    """A DocumentDB in a temporary directory with a preloaded `docs` collection"""
+
+    def __init__(self, base_dir, documents, max_seconds):
+        from app import DocumentDB
+        from collection_file import save_documents
+        from query_cache import QueryCache
+
+        self.base_dir = base_dir
+        self.documents = documents
+        self.max_seconds = max_seconds
+        self.db = DocumentDB(os.path.join(base_dir, "engine"))
+        # Measure the engine, not the query result cache
+        self.db.query_cache = QueryCache(0)
+        self.db.create_database("bench")
+        self.db.create_collection("bench", "docs")
+        start = time.perf_counter()
+        save_documents(os.path.join(self.db.databases_dir, "bench"), "docs", make_documents(documents))
+        self.db.catalog.refresh_collection("bench", "docs")
+        self.load_seconds = time.perf_counter() - start
+        self.rng = random.Random(7)
+
+    def random_id(self):
+        return f"doc{self.rng.randrange(self.documents):07d}"
+
+
+# Benchmarks: each takes the Context and returns a result dict
+
+def bench_insert(ctx):
+    return timed(lambda i: check(ctx.db.execute_query(
+        "bench", f'db.docs.insert({{"_id": "insert{i}", "name": "New", "age": 30}})'
+    )), 200, ctx.max_seconds)
+
+
+def bench_insert_many(ctx):
+    batch = 1000
+
+    def insert_many(i):
+        docs = list(make_documents(batch, seed=i, prefix=f"many{i}-"))
+        check(ctx.db.execute_query("bench", f"db.docs.insertMany({json.dumps(docs)})"))
+
+    result = timed(insert_many, 50, ctx.max_seconds)
+    result["documents_per_sec"] = round(result["ops_per_sec"] * batch, 3)
+    return result
+
+
+def bench_find_by_id(ctx):
+    return timed(lambda i: check(ctx.db.execute_query("bench", f'db.docs.find({{"_id": "{ctx.random_id()}"}})')),
+                 2000, ctx.max_seconds)
+
+
+def bench_find_scan(ctx):
+    return timed(lambda i: check(ctx.db.execute_query("bench", f'db.docs.find({{"city": "{CITIES[i % 100]}"}})')),
+                 50, ctx.max_seconds)
+
+
+def bench_update(ctx):
+    return timed(lambda i: check(ctx.db.execute_query(
+        "bench", f'db.docs.update({{"_id": "{ctx.random_id()}"}}, {{"$set": {{"score": {i}}}}})'
+    )), 200, ctx.max_seconds)
+
+
+def bench_delete(ctx):
+    # Single-statement deletes go through the batch path
+    return timed(lambda i: check(ctx.db.execute_batch_query(
+        "bench", f'db.docs.delete({{"_id": "doc{ctx.documents - 1 - i:07d}"}});'
+    )), 200, ctx.max_seconds)
+
+
+def bench_index_build(ctx):
+    from indexing import IndexManager
+
+    manager = IndexManager(os.path.join(ctx.base_dir, "index_build"))
+    manager.create_index("docs", "age")
+    entries = [(doc["age"], doc["_id"]) for doc in make_documents(ctx.documents)]
+    start = time.perf_counter()
+    manager.build_index("docs", "age", entries)
+    ctx.index_manager = manager
+    return throughput(len(entries), time.perf_counter() - start)
+
+
+def bench_index_lookup(ctx):
+    manager = getattr(ctx, "index_manager", None)
+    if manager is None:
+        bench_index_build(ctx)
+        manager = ctx.index_manager
+    return timed(lambda i: manager.find_documents("docs", "age", 18 + i % 72), 20000, ctx.max_seconds)
+
+
+PARSER_QUERIES = [
+    'db.users.find({"age": 30, "city": "City 4"})',
+    'db.users.insert({"_id": "u1", "name": "Ann", "tags": ["a", "b"], "address": {"zip": 12345}})',
+    "db.users.update({'_id': 'u1'}, {'$set': {'age': 31}})",
+    'db.users.delete({"_id": "u1"})',
+    'db.users.createIndex({"age": 1})',
+]
+
+
+def bench_parser(ctx):
+    from query_parser import parse_raw_query
+
+    count = 50_000
+    start = time.perf_counter()
+    for i in range(count):
+        parse_raw_query(PARSER_QUERIES[i % len(PARSER_QUERIES)])
+    return throughput(count, time.perf_counter() - start)
+
+
+def bench_lock_contention(ctx, threads=8, hot_keys=32, per_thread=5000):
+    """Threads take and release write locks on a small set of documents"""
+    from transaction_manager import IsolationLevel, LockManager, LockType
+
+    manager = LockManager()
+    conflicts = [0] * threads
+    ids = iter(range(1, threads * per_thread + 1))
+    ids_lock = threading.Lock()
+
+    def worker(n):
+        rng = random.Random(n)
+        for _ in range(per_thread):
+            with ids_lock:
+                transaction_id = next(ids)
+            doc_id = f"doc{rng.randrange(hot_keys)}"
+            success, _ = manager.acquire_lock("bench", "docs", doc_id, LockType.WRITE, transaction_id,
+                                              IsolationLevel.REPEATABLE_READ)
+            if not success:
+                conflicts[n] += 1
+            manager.release_transaction_locks(transaction_id, [("bench", "docs", doc_id)] if success else [])
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    total = threads * per_thread
+    return throughput(total, time.perf_counter() - start, conflict_ratio=round(sum(conflicts) / total, 4))
+
+
+def bench_wal_append(ctx):
+    """Inserts logged through the TransactionManager, 100 records and one flush per transaction"""
+    from collection_file import create_collection_file
+    from transaction_manager import TransactionManager
+
+    base_dir = os.path.join(ctx.base_dir, "wal")
+    os.makedirs(os.path.join(base_dir, "bench"), exist_ok=True)
+    create_collection_file(os.path.join(base_dir, "bench"), "docs")
+    manager = TransactionManager(base_dir)
+    records = min(ctx.documents, 200_000)
+    documents = make_documents(records)
+    start = time.perf_counter()
+    for first in range(0, records, 100):
+        transaction_id = manager.begin_transaction()
+        for doc in (next(documents) for _ in range(min(100, records - first))):
+            manager.log_operation(transaction_id, "insert", "bench", "docs", doc["_id"], None, doc, flush=False)
+        manager.commit_transaction(transaction_id)
+    seconds = time.perf_counter() - start
+    log_dir = os.path.join(base_dir, "transaction_logs", "bench")
+    log_bytes = sum(os.path.getsize(os.path.join(log_dir, name)) for name in os.listdir(log_dir))
+    ctx.wal_dir = base_dir
+    return throughput(records, seconds, mb_per_sec=round(log_bytes / seconds / 1e6, 3) if seconds else 0.0)
+
+
+def bench_recovery(ctx):
+    """Redo the log written by wal_append into empty collection files"""
+    from transaction_manager import TransactionManager
+
+    if not hasattr(ctx, "wal_dir"):
+        bench_wal_append(ctx)
+    manager = TransactionManager(ctx.wal_dir)
+    start = time.perf_counter()
+    success, message = manager.recover_from_checkpoint()
+    seconds = time.perf_counter() - start
+    if not success:
+        raise RuntimeError(message)
+    stats = manager.recovery_stats
+    return throughput(stats["records_analyzed"], seconds, records_redone=stats["records_redone"])
+
+
+# Read-only benchmarks first, then the ones that change the collection
+BENCHMARKS = {
+    "find_by_id": bench_find_by_id,
+    "find_scan": bench_find_scan,
+    "insert": bench_insert,
+    "insert_many": bench_insert_many,
+    "update": bench_update,
+    "delete": bench_delete,
+    "index_build": bench_index_build,
+    "index_lookup": bench_index_lookup,
+    "parser": bench_parser,
+    "lock_contention": bench_lock_contention,
+    "wal_append": bench_wal_append,
+    "recovery": bench_recovery,
+}
+
+
+def run(args):
+    names = args.only.split(",") if args.only else list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        print(f"Unknown benchmarks: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+    report = {
+        "size": args.size,
+        "documents": SIZES[args.size],
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": {},
+    }
+    with tempfile.TemporaryDirectory() as base_dir:
+        ctx = Context(base_dir, SIZES[args.size], args.max_seconds)
+        report["load_seconds"] = round(ctx.load_seconds, 3)
+        print(f"loaded {ctx.documents} documents in {ctx.load_seconds:.1f}s", file=sys.stderr)
+        for name in names:
+            try:
+                result = BENCHMARKS[name](ctx)
+            except Exception as e:
+                result = {"error": str(e)}
+            report["results"][name] = result
+            summary = result.get("error") or f"{result['ops_per_sec']:.1f} ops/s"
+            print(f"{name:16s} {summary}", file=sys.stderr)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return 0
+
+
+def compare(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    if base.get("size") != new.get("size"):
+        print(f"warning: comparing size {base.get('size')} with {new.get('size')}")
+    regressions = 0
+    print(f"{'benchmark':16s} {'base ops/s':>12s} {'new ops/s':>12s} {'change':>8s}")
+    for name in sorted(set(base["results"]) | set(new["results"])):
+        old_result, new_result = base["results"].get(name, {}), new["results"].get(name, {})
+        if "ops_per_sec" not in old_result or "ops_per_sec" not in new_result:
+            print(f"{name:16s} {'not in both runs':>34s}")
+            continue
+        old_rate, new_rate = old_result["ops_per_sec"], new_result["ops_per_sec"]
+        change = new_rate / old_rate - 1 if old_rate else 0.0
+        flag = ""
+        if change < -args.threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        elif change > args.threshold:
+            flag = "  improved"
+        print(f"{name:16s} {old_rate:12.1f} {new_rate:12.1f} {change:+8.1%}{flag}")
+    print(f"{regressions} regression(s) beyond {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run the benchmarks and print or save JSON results")
+    run_parser.add_argument("--size", choices=SIZES, default="10k")
+    run_parser.add_argument("--only", help="comma-separated benchmark names")
+    run_parser.add_argument("--output", help="write results to this file instead of stdout")
+    run_parser.add_argument("--max-seconds", type=float, default=5.0, help="time limit per benchmark")
+    compare_parser = commands.add_parser("compare", help="flag regressions between two result files")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.10, help="relative change that counts")
+    args = parser.parse_args()
+    sys.exit(run(args) if args.command == "run" else compare(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+"""YCSB-style workload generator against the HTTP API.
+
+Loads --records documents through /bulk_insert, then runs one of the YCSB
+core workloads through /execute_query from --clients concurrent clients,
+with keys drawn from a scrambled zipfian distribution (workload D reads
+the latest inserts most):
+
+    A  50% read, 50% update            D  95% read, 5% insert (latest)
+    B  95% read, 5% update             E  95% scan, 5% insert
+    C  100% read                       F  50% read, 50% read-modify-write
+
+The query language has no range queries, so a scan is a find on a `group`
+field shared by --scan-length consecutive keys (a filter scan of the whole
+collection). Every --interval seconds it prints throughput, p50/p99
+latency and the lock-failure and abort rates of that window; the summary
+has percentiles per operation.
+
+    python benchmarks/ycsb.py --workload A [--clients 16] [--records 10000] [--seconds 30]
+                              [--server flask|asgi | --url http://host:port] [--output FILE]
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode, urlparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORKLOADS = {
+    "A": {"read": 0.5, "update": 0.5},
+    "B": {"read": 0.95, "update": 0.05},
+    "C": {"read": 1.0},
+    "D": {"read": 0.95, "insert": 0.05},
+    "E": {"scan": 0.95, "insert": 0.05},
+    "F": {"read": 0.5, "read_modify_write": 0.5},
+}
+TABLE = "usertable"
+
+
+class ZipfianGenerator:
+    """Item numbers 0..items-1, item 0 the most popular (Gray et al., as in YCSB)"""
+
+    def __init__(self, items, theta=0.99):
+        self.items = items
+        self.theta = theta
+        self.zetan = sum(1 / (i ** theta) for i in range(1, items + 1))
+        zeta2 = 1 + 0.5 ** theta
+        self.alpha = 1 / (1 - theta)
+        self.eta = (1 - (2 / items) ** (1 - theta)) / (1 - zeta2 / self.zetan)
+        self.half_pow_theta = 0.5 ** theta
+
+    def next(self, rng):
+        u = rng.random()
+        uz = u * self.zetan
+        if uz < 1:
+            return 0
+        if uz < 1 + self.half_pow_theta:
+            return 1
+        return min(self.items - 1, int(self.items * (self.eta * u - self.eta + 1) ** self.alpha))
+
+
+def fnv_hash(value):
+    """64-bit FNV-1a of an integer; spreads the popular items over the key space"""
+    h = 0xCBF29CE484222325
+    for _ in range(8):
+        h ^= value & 0xFF
+        h = (h * 0x100000001B3) & 0xFFFFFFFFFFFFFFFF
+        value >>= 8
+    return h
+
+
+def key_name(number):
+    return f"user{number:010d}"
+
+
+def make_record(number, fields, field_length, scan_length, rng):
+    doc = {"_id": key_name(number), "group": number // scan_length}
+    for field in range(fields):
+        doc[f"field{field}"] = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(field_length))
+    return doc
+
+
+class Stats:
+    """Latencies and outcomes, per operation and per reporting window"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}  # operation -> [seconds]
+        self.window = []
+        self.lock_failures = 0
+        self.errors = 0
+        self.window_lock_failures = 0
+        self.window_errors = 0
+
+    def record(self, operation, seconds, error):
+        with self.lock:
+            self.latencies.setdefault(operation, []).append(seconds)
+            self.window.append(seconds)
+            if error:
+                self.errors += 1
+                self.window_errors += 1
+                if "lock" in error.lower() or "deadlock" in error.lower():
+                    self.lock_failures += 1
+                    self.window_lock_failures += 1
+
+    def take_window(self):
+        with self.lock:
+            window, self.window = self.window, []
+            lock_failures, errors = self.window_lock_failures, self.window_errors
+            self.window_lock_failures = self.window_errors = 0
+        return window, lock_failures, errors
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0.0
+
+
+class Client:
+    def __init__(self, host, port, db_name):
+        self.connection = http.client.HTTPConnection(host, port, timeout=300)
+        self.db_name = db_name
+
+    def query(self, query):
+        """The error of a query, or None"""
+        self.connection.request("POST", "/execute_query", urlencode({"db_name": self.db_name, "query": query}),
+                                {"Content-Type": "application/x-www-form-urlencoded"})
+        response = self.connection.getresponse()
+        body = response.read()
+        if response.status != 200:
+            return f"HTTP {response.status}"
+        result = json.loads(body)
+        return result.get("error") if isinstance(result, dict) else None
+
+    def post(self, path, form):
+        self.connection.request("POST", path, urlencode(form), {"Content-Type": "application/x-www-form-urlencoded"})
+        response = self.connection.getresponse()
+        return json.loads(response.read())
+
+    def bulk_insert(self, collection, lines):
+        self.connection.request("POST", f"/bulk_insert/{self.db_name}/{collection}", body=lines,
+                                encode_chunked=True, headers={"Content-Type": "application/x-ndjson"})
+        response = self.connection.getresponse()
+        return json.loads(response.read())
+
+
+def start_server(kind, data_dir):
+    """Start the Flask (threaded) or asyncio server on a free port; (process, port)"""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    env = dict(os.environ, MANGODB_DATABASES_DIR=data_dir)
+    if kind == "asgi":
+        command = [sys.executable, os.path.join(ROOT, "asgi.py"), "--port", str(port)]
+    else:
+        command = [sys.executable, "-c",
+                   "import logging; from werkzeug.serving import make_server; from app import app; "
+                   "logging.getLogger('werkzeug').setLevel(logging.ERROR); "
+                   f"make_server('127.0.0.1', {port}, app, threaded=True).serve_forever()"]
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process, port
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("Server did not start")
+
+
+def load(client, args):
+    result = client.post("/create_database", {"db_name": client.db_name})
+    if not result.get("success") and "exists" not in result.get("message", ""):
+        raise RuntimeError(result.get("message"))
+    client.post(f"/create_collection/{client.db_name}", {"collection_name": TABLE})
+    rng = random.Random(1)
+
+    def lines():
+        for number in range(args.records):
+            doc = make_record(number, args.fields, args.field_length, args.scan_length, rng)
+            yield (json.dumps(doc) + "\n").encode()
+
+    start = time.perf_counter()
+    result = client.bulk_insert(TABLE, lines())
+    if "error" in result:
+        raise RuntimeError(result["error"])
+    print(f"loaded {result['inserted']} records in {time.perf_counter() - start:.1f}s "
+          f"({result['failed']} failed)")
+
+
+def run_clients(args, host, port, stats):
+    mix = list(WORKLOADS[args.workload].items())
+    zipfian = ZipfianGenerator(args.records, args.theta)
+    inserted = itertools.count(args.records)
+    latest = [args.records - 1]
+    deadline = time.perf_counter() + args.seconds
+    stop = threading.Event()
+
+    def choose_key(rng):
+        if args.workload == "D":
+            # Latest distribution: the most recent inserts are the most popular
+            return key_name(max(0, latest[0] - zipfian.next(rng)))
+        return key_name(fnv_hash(zipfian.next(rng)) % args.records)
+
+    def worker(n):
+        rng = random.Random(100 + n)
+        client = Client(host, port, args.db)
+        update_value = "x" * args.field_length
+        while time.perf_counter() < deadline:
+            r = rng.random()
+            for operation, share in mix:
+                r -= share
+                if r < 0:
+                    break
+            start = time.perf_counter()
+            if operation == "read":
+                error = client.query(f'db.{TABLE}.find({{"_id": "{choose_key(rng)}"}})')
+            elif operation == "update":
+                error = client.query(f'db.{TABLE}.update({{"_id": "{choose_key(rng)}"}}, '
+                                     f'{{"$set": {{"field{rng.randrange(args.fields)}": "{update_value}"}}}})')
+            elif operation == "insert":
+                number = next(inserted)
+                doc = make_record(number, args.fields, args.field_length, args.scan_length, rng)
+                error = client.query(f"db.{TABLE}.insert({json.dumps(doc)})")
+                latest[0] = max(latest[0], number)
+            elif operation == "scan":
+                group = (fnv_hash(zipfian.next(rng)) % args.records) // args.scan_length
+                error = client.query(f'db.{TABLE}.find({{"group": {group}}})')
+            else:
+                key = choose_key(rng)
+                error = client.query(f'db.{TABLE}.find({{"_id": "{key}"}})') or client.query(
+                    f'db.{TABLE}.update({{"_id": "{key}"}}, {{"$set": {{"field0": "{update_value}"}}}})'
+                )
+            stats.record(operation, time.perf_counter() - start, error)
+
+    def reporter():
+        started = time.perf_counter()
+        while not stop.wait(args.interval):
+            window, lock_failures, errors = stats.take_window()
+            count = len(window)
+            entry = {
+                "t": round(time.perf_counter() - started, 1),
+                "ops_per_sec": round(count / args.interval, 1),
+                "p50_ms": round(percentile(window, 0.5) * 1000, 2),
+                "p99_ms": round(percentile(window, 0.99) * 1000, 2),
+                "lock_failure_rate": round(lock_failures / count, 4) if count else 0.0,
+                "abort_rate": round(errors / count, 4) if count else 0.0,
+            }
+            series.append(entry)
+            print(f"{entry['t']:6.1f}s {entry['ops_per_sec']:9.1f} ops/s  p50 {entry['p50_ms']:8.2f} ms  "
+                  f"p99 {entry['p99_ms']:8.2f} ms  lock failures {entry['lock_failure_rate']:6.2%}  "
+                  f"aborts {entry['abort_rate']:6.2%}")
+
+    series = []
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(args.clients)]
+    report_thread = threading.Thread(target=reporter, daemon=True)
+    start = time.perf_counter()
+    report_thread.start()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    stop.set()
+    report_thread.join()
+    return time.perf_counter() - start, series
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workload", choices=sorted(WORKLOADS), default="A")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--records", type=int, default=10000)
+    parser.add_argument("--seconds", type=float, default=30)
+    parser.add_argument("--fields", type=int, default=10)
+    parser.add_argument("--field-length", type=int, default=100)
+    parser.add_argument("--scan-length", type=int, default=100)
+    parser.add_argument("--theta", type=float, default=0.99, help="zipfian skew")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between progress lines")
+    parser.add_argument("--db", default="ycsb")
+    parser.add_argument("--server", choices=("flask", "asgi"), default="flask",
+                        help="server started locally on a temporary data directory")
+    parser.add_argument("--url", help="use a running server instead of starting one")
+    parser.add_argument("--output", help="write the summary and time series as JSON")
+    args = parser.parse_args()
+
+    process = None
+    data_dir = None
+    if args.url:
+        url = urlparse(args.url)
+        host, port = url.hostname, url.port or 80
+    else:
+        data_dir = tempfile.TemporaryDirectory()
+        process, port = start_server(args.server, data_dir.name)
+        host = "127.0.0.1"
+    try:
+        load(Client(host, port, args.db), args)
+        stats = Stats()
+        seconds, series = run_clients(args, host, port, stats)
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+        if data_dir:
+            data_dir.cleanup()
+
+    operations = sum(len(latencies) for latencies in stats.latencies.values())
+    summary = {
+        "workload": args.workload,
+        "clients": args.clients,
+        "records": args.records,
+        "server": args.url or args.server,
+        "seconds": round(seconds, 3),
+        "operations": operations,
+        "ops_per_sec": round(operations / seconds, 2),
+        "lock_failure_rate": round(stats.lock_failures / operations, 4) if operations else 0.0,
+        "abort_rate": round(stats.errors / operations, 4) if operations else 0.0,
+        "operations_by_type": {},
+    }
+    print(f"\nworkload {args.workload}: {operations} operations in {seconds:.1f}s, "
+          f"{summary['ops_per_sec']:.1f} ops/s, lock failures {summary['lock_failure_rate']:.2%}, "
+          f"aborts {summary['abort_rate']:.2%}")
+    for operation, latencies in sorted(stats.latencies.items()):
+        figures = {f"p{label}_ms": round(percentile(latencies, fraction) * 1000, 2)
+                   for label, fraction in (("50", 0.5), ("95", 0.95), ("99", 0.99), ("999", 0.999))}
+        summary["operations_by_type"][operation] = dict(count=len(latencies), **figures)
+        print(f"  {operation:18s} n={len(latencies):7d}  " + "  ".join(f"{k} {v:8.2f}" for k, v in figures.items()))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"summary": summary, "series": series}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""Block compression for collection and index files.
+
+Collection files compress their documents in blocks of about BLOCK_SIZE
+bytes that never split a document, so reading one document decompresses
+one block. Decompressed blocks are kept in a process-wide LRU cache
+bounded by size; a sequential scan decompresses each block once.
+"""
+import lzma
+import threading
+import zlib
+from collections import OrderedDict
+
+BLOCK_SIZE = 64 * 1024
+BLOCK_CACHE_BYTES = 32 * 1024 * 1024
+
+
+class Compression:
+    """A compression method and level; "none" stores blocks as they are"""
+
+    def __init__(self, name="none", level=None):
+        if name not in METHODS:
+            raise ValueError(f"Unknown compression '{name}', expected one of: {', '.join(sorted(METHODS))}")
+        compression_id, default_level = METHODS[name]
+        if level is None:
+            level = default_level
+        level = int(level)
+        if not 0 <= level <= 9:
+            raise ValueError("Compression level must be between 0 and 9")
+        self.name = name
+        self.compression_id = compression_id
+        self.level = level if name != "none" else 0
+
+    @classmethod
+    def from_id(cls, compression_id, level):
+        for name, (method_id, _) in METHODS.items():
+            if method_id == compression_id:
+                return cls(name, level)
+        raise ValueError(f"Unknown compression id {compression_id}")
+
+    @property
+    def enabled(self):
+        return self.name != "none"
+
+    def compress(self, data):
+        if self.name == "zlib":
+            return zlib.compress(data, self.level)
+        if self.name == "lzma":
+            return lzma.compress(data, preset=self.level)
+        return data
+
+    def decompress(self, data):
+        if self.name == "zlib":
+            return zlib.decompress(data)
+        if self.name == "lzma":
+            return lzma.decompress(data)
+        return data
+
+    def __eq__(self, other):
+        return isinstance(other, Compression) and (self.name, self.level) == (other.name, other.level)
+
+    def __repr__(self):
+        return f"{self.name}:{self.level}" if self.enabled else self.name
+
+
+# name -> (id stored in collection file headers, default level)
+METHODS = {"none": (0, 0), "zlib": (1, 6), "lzma": (2, 6)}
+NO_COMPRESSION = Compression()
+
+_XZ_MAGIC = b"\xfd7zXZ\x00"
+
+
+def decompress_file_data(data):
+    """Decompress a whole file written with Compression.compress(); plain data is returned unchanged"""
+    if data.startswith(_XZ_MAGIC):
+        return lzma.decompress(data)
+    if data[:1] == b"\x78":
+        # zlib header; plain JSON never starts with "x"
+        return zlib.decompress(data)
+    return data
+
+
+class BlockCache:
+    """LRU cache of decompressed blocks, bounded by their total size"""
+
+    def __init__(self, max_bytes=BLOCK_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.blocks = OrderedDict()  # key -> bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, load):
+        """The cached block for key, calling load() to decompress it on a miss"""
+        with self.lock:
+            block = self.blocks.get(key)
+            if block is not None:
+                self.blocks.move_to_end(key)
+                self.hits += 1
+                return block
+            self.misses += 1
+        block = load()
+        if len(block) > self.max_bytes:
+            return block
+        with self.lock:
+            if key not in self.blocks:
+                self.blocks[key] = block
+                self.size += len(block)
+                while self.size > self.max_bytes:
+                    _, evicted = self.blocks.popitem(last=False)
+                    self.size -= len(evicted)
+        return block
+
+    def clear(self):
+        with self.lock:
+            self.blocks.clear()
+            self.size = 0
+
+
+block_cache = BlockCache()
@@ -0,0 +1,178 @@
+import json
+import os
+import threading
+
+from collection_file import (
+    collection_files, collection_stats, legacy_path, list_collections, partition_count, swap_lock
+)
+from file_sync import fsync_file, replace_file, temp_path
+
+CATALOG_FILE = "catalog.json"
+SYSTEM_DIRS = {"transaction_logs", "checkpoints"}
+
+
+class Catalog:
+    """In-memory catalog of databases, collections and indexes.
+
+    Reads never touch the filesystem. Write paths keep the catalog current
+    (refresh_collection() after a collection is written, set_indexes()
+    after index DDL), and it is saved to databases/catalog.json by the
+    checkpointer. At startup the manifest is loaded and reconciled with the
+    database directories once; only collections whose files changed since
+    the manifest was written are read again.
+
+    Collection entries: documents, bytes, modified (mtime), codec,
+    compression and partitions.
+    """
+
+    def __init__(self, databases_dir, on_dirty=None):
+        self.databases_dir = databases_dir
+        self.path = os.path.join(databases_dir, CATALOG_FILE)
+        self.on_dirty = on_dirty  # called after every change so the owner can schedule save()
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()  # held from snapshot to rename: the newest snapshot is written last
+        self.databases = {}  # db_name -> {"collections": {name: stats}, "indexes": {name: [fields]}}
+
+    def load(self):
+        """Load the manifest and reconcile it with the database directories"""
+        manifest = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    manifest = json.load(f)["databases"]
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Error loading catalog, rebuilding it: {str(e)}")
+        databases = {}
+        for db_name in sorted(os.listdir(self.databases_dir)):
+            db_path = os.path.join(self.databases_dir, db_name)
+            if db_name in SYSTEM_DIRS or not os.path.isdir(db_path):
+                continue
+            known = manifest.get(db_name, {}).get("collections", {})
+            collections = {}
+            for name in list_collections(db_path):
+                stats = known.get(name)
+                bytes_on_disk, modified = self._signature(db_path, name)
+                if not stats or stats.get("bytes") != bytes_on_disk or stats.get("modified") != modified:
+                    stats = collection_stats(db_path, name)
+                collections[name] = stats
+            databases[db_name] = {
+                "collections": collections,
+                "indexes": self._scan_indexes(db_path, collections),
+            }
+        with self.lock:
+            self.databases = databases
+        self.save()
+
+    @staticmethod
+    def _signature(db_path, name):
+        """(bytes, mtime) of a collection's files, without reading them"""
+        with swap_lock:
+            paths = collection_files(db_path, name)
+            if not partition_count(db_path, name) and not os.path.exists(paths[0]):
+                paths = [legacy_path(db_path, name)]
+            return sum(os.path.getsize(path) for path in paths), max(os.path.getmtime(path) for path in paths)
+
+    @staticmethod
+    def _scan_indexes(db_path, collections):
+        """Indexed fields per collection, from the index file names (<collection>_<field>_index.json)"""
+        indexes = {}
+        indexes_dir = os.path.join(db_path, "indexes")
+        if not os.path.isdir(indexes_dir):
+            return indexes
+        # Longest name first: "orders_2023" wins over "orders" for "orders_2023_day_index.json"
+        names = sorted(collections, key=len, reverse=True)
+        for file_name in sorted(os.listdir(indexes_dir)):
+            if not file_name.endswith("_index.json"):
+                continue
+            for name in names:
+                if file_name.startswith(f"{name}_"):
+                    field = file_name[len(name) + 1:-len("_index.json")]
+                    indexes.setdefault(name, []).append(field)
+                    break
+        return indexes
+
+    def save(self):
+        """Write the manifest (temp file + rename)"""
+        with self.save_lock:
+            with self.lock:
+                data = json.dumps({"databases": self.databases}, indent=2)
+            temp = temp_path(self.path)
+            with open(temp, "w") as f:
+                f.write(data)
+                fsync_file(f)
+            replace_file(temp, self.path)
+
+    def _changed(self):
+        if self.on_dirty:
+            self.on_dirty()
+
+    # Reads
+
+    def database_names(self):
+        with self.lock:
+            return sorted(self.databases)
+
+    def has_database(self, db_name):
+        with self.lock:
+            return db_name in self.databases
+
+    def collection_names(self, db_name):
+        with self.lock:
+            return sorted(self.databases.get(db_name, {}).get("collections", {}))
+
+    def has_collection(self, db_name, collection):
+        with self.lock:
+            return collection in self.databases.get(db_name, {}).get("collections", {})
+
+    def collection(self, db_name, collection):
+        """Stats of a collection (a copy), or None"""
+        with self.lock:
+            stats = self.databases.get(db_name, {}).get("collections", {}).get(collection)
+            return dict(stats) if stats else None
+
+    def indexes(self, db_name, collection):
+        with self.lock:
+            return list(self.databases.get(db_name, {}).get("indexes", {}).get(collection, []))
+
+    def describe(self, db_name=None):
+        """The catalog (or one database of it) as plain data"""
+        with self.lock:
+            data = self.databases if db_name is None else {db_name: self.databases.get(db_name)}
+            return json.loads(json.dumps(data))
+
+    # Changes, made by write paths
+
+    def add_database(self, db_name):
+        with self.lock:
+            self.databases.setdefault(db_name, {"collections": {}, "indexes": {}})
+        self._changed()
+
+    def remove_database(self, db_name):
+        with self.lock:
+            self.databases.pop(db_name, None)
+        self._changed()
+
+    def refresh_collection(self, db_name, collection):
+        """Re-read a collection's stats after it was written"""
+        db_path = os.path.join(self.databases_dir, db_name)
+        try:
+            stats = collection_stats(db_path, collection)
+        except FileNotFoundError:
+            stats = None
+        with self.lock:
+            database = self.databases.setdefault(db_name, {"collections": {}, "indexes": {}})
+            if stats is None:
+                database["collections"].pop(collection, None)
+                database["indexes"].pop(collection, None)
+            else:
+                database["collections"][collection] = stats
+        self._changed()
+
+    def set_indexes(self, db_name, collection, fields):
+        with self.lock:
+            database = self.databases.setdefault(db_name, {"collections": {}, "indexes": {}})
+            if fields:
+                database["indexes"][collection] = sorted(fields)
+            else:
+                database["indexes"].pop(collection, None)
+        self._changed()
@@ -0,0 +1,243 @@
+"""Change streams: the committed inserts, updates and deletes of a database, read from its log.
+
+A ChangeStream follows one database's log with a LogTail and turns the
+operation records of each committed transaction into change events, in
+commit order, keeping those of the collections and operations it was
+asked for. Every event carries a resume token, the commit LSN of its
+transaction; a stream opened with `resume_after=token` returns what was
+committed after it. Polls end on transaction boundaries, so a consumer
+that stores the token of the last event it handled neither misses nor
+repeats a change after a restart. Tokens are LSNs of this server: a
+replica numbers its own log.
+
+Resuming is cheap for a token this server handed out recently:
+ChangeStreams remembers where the log must be read from for it, and
+keeps the tail of a finished long poll to carry on without rereading.
+For any other token the log is read from its oldest segment. A token
+older than the log (truncated after a checkpoint) cannot be resumed
+from; only a stream being read keeps the log from being truncated.
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+from log_tail import LogGap, LogTail
+from recovery import DATA_OPERATIONS
+from wal import WALError, compute_delta, list_segments, read_segment_header
+
+DEFAULT_TIMEOUT = 30.0  # seconds a long poll waits for a change
+HEARTBEAT_INTERVAL = 10.0  # seconds between heartbeats on an idle stream
+MAX_EVENTS = 1000  # events returned by a long poll
+
+
+def change_event(db_name, transaction, record):
+    """The event for one operation record of a committed transaction"""
+    operation = record["operation"]
+    event = {
+        "resume_token": transaction["lsn"],
+        "lsn": record["lsn"],
+        "operation": operation,
+        "database": db_name,
+        "collection": record["collection"],
+        "document_id": record["document_id"],
+        "transaction_id": transaction["transaction_id"],
+        "committed_at": transaction["timestamp"],
+    }
+    if operation == "insert":
+        event["document"] = record["after_state"]
+    elif operation == "update":
+        delta = record["delta"] or compute_delta(record["before_state"] or {}, record["after_state"] or {})
+        event["updated_fields"] = delta["set"]
+        event["removed_fields"] = delta["unset"]
+    return event
+
+
+def event_lines(events):
+    """Events as newline-delimited JSON"""
+    return b"".join(json.dumps(event, separators=(",", ":")).encode("utf-8") + b"\n" for event in events)
+
+
+def heartbeat_line(stream):
+    """Sent on an idle stream: the consumer learns its resume token, the server that it is still connected"""
+    heartbeat = {"heartbeat": time.time(), "resume_token": stream.resume_token}
+    return json.dumps(heartbeat, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+def watch_options(args):
+    """watch() keyword arguments from request parameters; raises ValueError.
+
+    `collection` and `operations` are comma-separated lists.
+    """
+    options = {}
+    for name, key in (("collection", "collections"), ("operations", "operations")):
+        if args.get(name):
+            options[key] = [value.strip() for value in args[name].split(",") if value.strip()]
+    for name in ("resume_after", "max_events"):
+        if args.get(name) not in (None, ""):
+            try:
+                options[name] = int(args[name])
+            except ValueError:
+                raise ValueError(f"{name} must be an integer")
+    return options
+
+
+class ChangeStream:
+    def __init__(self, streams, db_name, tail, resume_token, restart_lsn, backlog=None, collections=None,
+                 operations=None, retain=False):
+        self.streams = streams
+        self.db_name = db_name
+        self.tail = tail
+        self.backlog = backlog or deque()  # transactions polled from the tail but not returned yet
+        self.collections = set(collections) if collections else None
+        self.operations = set(operations) if operations else None
+        # Position after the events returned so far
+        self.resume_token = resume_token
+        self.restart_lsn = restart_lsn
+        self.retain = retain
+        if retain:
+            streams.transaction_manager.retain_log(self, self.restart_lsn)
+
+    def poll(self, max_events=None):
+        """Events of the transactions committed since the last poll; raises LogGap.
+
+        At most `max_events` events unless one transaction alone has more.
+        """
+        if not self.backlog:
+            self.backlog.extend(self.tail.poll())
+        events = []
+        while self.backlog and (max_events is None or len(events) < max_events):
+            transaction = self.backlog.popleft()
+            events.extend(
+                change_event(self.db_name, transaction, record) for record in transaction["records"]
+                if record["operation"] in DATA_OPERATIONS
+                and (self.operations is None or record["operation"] in self.operations)
+                and (self.collections is None or record["collection"] in self.collections)
+            )
+            self.resume_token, self.restart_lsn = transaction["lsn"], transaction["restart_lsn"]
+        self.streams.remember(self.db_name, self.resume_token, self.restart_lsn)
+        if self.retain:
+            self.streams.transaction_manager.retain_log(self, self.restart_lsn)
+        return events
+
+    def close(self):
+        if self.retain:
+            self.streams.transaction_manager.release_log(self)
+        else:
+            self.streams.release(self)
+
+
+class ChangeStreams:
+    """Opens change streams on the logs of a TransactionManager.
+
+    Remembers the restart LSN of the last `keep` resume tokens it handed
+    out and keeps the tails of up to `keep_idle` finished long polls.
+    """
+
+    def __init__(self, transaction_manager, keep=4096, keep_idle=64):
+        self.transaction_manager = transaction_manager
+        self.keep = keep
+        self.keep_idle = keep_idle
+        self.restart_points = OrderedDict()  # (db_name, resume token) -> restart LSN
+        self.idle = OrderedDict()  # (db_name, resume token) -> (tail, backlog, restart LSN)
+        self.lock = threading.Lock()
+
+    def open(self, db_name, collections=None, operations=None, resume_after=None, retain=False):
+        """A stream of the changes committed after `resume_after` (default: from now on).
+
+        Without `resume_after` the stream returns the transactions that
+        commit after it was opened, including those already running, and
+        none committed before.
+
+        With `retain` the log is kept back to the stream's position until
+        it is closed. A token the log no longer reaches raises LogGap here
+        or on the first poll.
+        """
+        log_dir = os.path.join(self.transaction_manager.log_dir, db_name)
+        backlog = None
+        if resume_after is None:
+            # Read from the oldest running transaction, return only what commits after the last record logged
+            resume_after, restart_lsn = self.transaction_manager.log_position()
+            tail = LogTail(log_dir, resume_after, restart_lsn)
+        else:
+            with self.lock:
+                idle = self.idle.pop((db_name, resume_after), None)
+                restart_lsn = self.restart_points.get((db_name, resume_after))
+            if idle is not None:
+                tail, backlog, restart_lsn = idle
+            else:
+                if restart_lsn is None:
+                    restart_lsn = self._oldest_lsn(log_dir, resume_after)
+                tail = LogTail(log_dir, resume_after, restart_lsn)
+        self.remember(db_name, resume_after, restart_lsn)
+        return ChangeStream(self, db_name, tail, resume_after, restart_lsn, backlog, collections, operations, retain)
+
+    @staticmethod
+    def _oldest_lsn(log_dir, resume_after):
+        """Where to read a token this server does not remember from: the oldest record logged"""
+        segments = list_segments(log_dir)
+        if not segments:
+            return 0
+        try:
+            base_lsn = read_segment_header(segments[0][1])["base_lsn"]
+        except (OSError, WALError):
+            return 0
+        if segments[0][0] != 1 and base_lsn > resume_after + 1:
+            raise LogGap(f"log of {os.path.basename(log_dir)} starts after LSN {resume_after}")
+        return base_lsn
+
+    def remember(self, db_name, resume_token, restart_lsn):
+        with self.lock:
+            self.restart_points[(db_name, resume_token)] = restart_lsn
+            self.restart_points.move_to_end((db_name, resume_token))
+            while len(self.restart_points) > self.keep:
+                self.restart_points.popitem(last=False)
+
+    def release(self, stream):
+        """Keep the tail of a finished stream for the next one resuming at its token"""
+        with self.lock:
+            self.idle[(stream.db_name, stream.resume_token)] = (stream.tail, stream.backlog, stream.restart_lsn)
+            self.idle.move_to_end((stream.db_name, stream.resume_token))
+            while len(self.idle) > self.keep_idle:
+                self.idle.popitem(last=False)
+
+    def watch(self, db_name, collections=None, operations=None, resume_after=None, max_events=MAX_EVENTS, timeout=0):
+        """Long poll: {"events", "resume_token"}, waiting up to `timeout` seconds for an event"""
+        stream = self.open(db_name, collections, operations, resume_after)
+        try:
+            deadline = time.monotonic() + timeout
+            flushes = self.transaction_manager.log_flushes
+            while True:
+                events = stream.poll(max_events)
+                remaining = deadline - time.monotonic()
+                if events or remaining <= 0:
+                    return {"events": events, "resume_token": stream.resume_token}
+                flushes = self.transaction_manager.wait_for_log(flushes, remaining)
+        finally:
+            stream.close()
+
+    def follow(self, stream, heartbeat_interval=HEARTBEAT_INTERVAL):
+        """NDJSON chunks of a stream's events as they are committed, with heartbeats while idle.
+
+        Runs until the consumer goes away (the generator is closed) and
+        closes the stream; a LogGap ends it with an error line.
+        """
+        try:
+            flushes = self.transaction_manager.log_flushes
+            last_sent = time.monotonic()
+            while True:
+                try:
+                    events = stream.poll()
+                except LogGap as e:
+                    yield json.dumps({"error": f"Change stream interrupted: {str(e)}"}).encode("utf-8") + b"\n"
+                    return
+                if events:
+                    yield event_lines(events)
+                    last_sent = time.monotonic()
+                elif time.monotonic() - last_sent >= heartbeat_interval:
+                    yield heartbeat_line(stream)
+                    last_sent = time.monotonic()
+                flushes = self.transaction_manager.wait_for_log(flushes, heartbeat_interval)
+        finally:
+            stream.close()
@@ -0,0 +1,260 @@
+"""Collection dumps: every document of a collection as one byte stream.
+
+Formats:
+
+    ndjson  one JSON document per line and nothing else, the format
+            /bulk_insert/<db>/<collection> reads
+    binary  magic "MDMP", version u16, then frames of kind u8, payload
+            length u32 and payload:
+              H  JSON header: collection, codec, compression, partitions, indexes
+              S  JSON {"codec": name}: the documents that follow use this
+                 codec, starting with an empty field-name table
+              N  JSON array of field names appended to that table
+              D  one encoded document
+              E  JSON {"documents": count}, the end of the dump
+            Documents of binary-codec files are copied without decoding.
+
+Either can be gzip-compressed; read_dump() detects it.
+
+    python collection_dump.py dump <database> <collection> [-o FILE] [--format ndjson|binary] [--gzip]
+    python collection_dump.py restore <database> <FILE> [--collection NAME] [--batch-size N]
+"""
+import argparse
+import json
+import struct
+import sys
+import zlib
+
+from document_codec import BinaryCodec, get_codec
+from ndjson import iter_documents, iter_lines
+
+DUMP_MAGIC = b"MDMP"
+DUMP_VERSION = 1
+DUMP_FORMATS = ("ndjson", "binary")
+CHUNK_SIZE = 64 * 1024
+
+_PREFIX = struct.Struct("<4sH")
+_FRAME = struct.Struct("<BI")
+_GZIP_MAGIC = b"\x1f\x8b"
+
+
+def _frame(kind, payload):
+    return _FRAME.pack(ord(kind), len(payload)) + payload
+
+
+def _json(value):
+    return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+
+def _ndjson_pieces(sources):
+    for source in sources:
+        if isinstance(source, list):
+            # Previous JSON array format, already decoded
+            for doc in source:
+                yield _json(doc) + b"\n"
+        elif source.codec.name == "json":
+            # Stored documents are compact JSON already
+            for position in range(len(source)):
+                yield bytes(source.raw(position)) + b"\n"
+        else:
+            for doc in source:
+                yield _json(doc) + b"\n"
+
+
+def _binary_pieces(sources, header):
+    yield _PREFIX.pack(DUMP_MAGIC, DUMP_VERSION)
+    yield _frame("H", _json(header))
+    count = 0
+    for source in sources:
+        yield _frame("S", _json({"codec": "binary"}))
+        if not isinstance(source, list) and source.codec.name == "binary":
+            yield _frame("N", _json(source.codec.names))
+            for position in range(len(source)):
+                yield _frame("D", source.raw(position))
+            count += len(source)
+            continue
+        encoder = BinaryCodec()
+        for doc in source:
+            known = len(encoder.names)
+            data = encoder.encode(doc)
+            if len(encoder.names) > known:
+                yield _frame("N", _json(encoder.names[known:]))
+            yield _frame("D", data)
+            count += 1
+    yield _frame("E", _json({"documents": count}))
+
+
+def dump_chunks(sources, dump_format, header, compress=False):
+    """Chunks of about CHUNK_SIZE bytes of a dump.
+
+    `sources` are open CollectionFile objects (closed when the dump ends)
+    or lists of documents.
+    """
+    pieces = _ndjson_pieces(sources) if dump_format == "ndjson" else _binary_pieces(sources, header)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buffer = bytearray()
+    try:
+        for piece in pieces:
+            buffer += piece
+            if len(buffer) >= CHUNK_SIZE:
+                chunk = compressor.compress(bytes(buffer)) if compressor else bytes(buffer)
+                buffer.clear()
+                if chunk:
+                    yield chunk
+        chunk = compressor.compress(bytes(buffer)) + compressor.flush() if compressor else bytes(buffer)
+        if chunk:
+            yield chunk
+    finally:
+        for source in sources:
+            if not isinstance(source, list):
+                source.close()
+
+
+def _gunzip(chunks):
+    decompressor = zlib.decompressobj(31)
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+def _peek(chunks, size):
+    """(first `size` bytes or fewer at the end, iterator over the whole stream)"""
+    chunks = iter(chunks)
+    head = b""
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= size:
+            break
+
+    def stream():
+        if head:
+            yield head
+        yield from chunks
+
+    return head[:size], stream()
+
+
+class _ByteReader:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffer = bytearray()
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                raise ValueError("Truncated dump")
+            self.buffer += chunk
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def frame(self):
+        kind, length = _FRAME.unpack(self.read(_FRAME.size))
+        return chr(kind), self.read(length)
+
+
+def _binary_documents(reader):
+    codec = None
+    number = 0
+    try:
+        while True:
+            kind, payload = reader.frame()
+            if kind == "D":
+                number += 1
+                if codec is None:
+                    yield number, None, "Document before the first section"
+                    continue
+                try:
+                    yield number, codec.decode(payload), None
+                except (ValueError, IndexError) as e:
+                    yield number, None, f"Invalid document: {str(e)}"
+            elif kind == "N" and codec is not None:
+                codec = type(codec)(codec.names + json.loads(payload))
+            elif kind == "S":
+                codec = get_codec(json.loads(payload)["codec"])()
+            elif kind == "E":
+                return
+    except ValueError as e:
+        yield number + 1, None, str(e)
+
+
+def read_dump(chunks):
+    """(header, entries) of a dump in either format, gzip-compressed or not.
+
+    header is None for NDJSON; entries yields (number, document, error)
+    like ndjson.iter_documents, numbering lines or binary documents.
+    """
+    magic, chunks = _peek(chunks, 2)
+    if magic == _GZIP_MAGIC:
+        chunks = _gunzip(chunks)
+    prefix, chunks = _peek(chunks, _PREFIX.size)
+    if prefix[:4] != DUMP_MAGIC:
+        return None, iter_documents(iter_lines(chunks))
+    reader = _ByteReader(chunks)
+    _, version = _PREFIX.unpack(reader.read(_PREFIX.size))
+    if version != DUMP_VERSION:
+        raise ValueError(f"Unsupported dump version {version}")
+    kind, payload = reader.frame()
+    if kind != "H":
+        raise ValueError("Dump has no header")
+    return json.loads(payload), _binary_documents(reader)
+
+
+def _read_file(path):
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+def _main(argv):
+    parser = argparse.ArgumentParser(description="Dump and restore collections")
+    commands = parser.add_subparsers(dest="command", required=True)
+    dump = commands.add_parser("dump", help="write a collection to a file or stdout")
+    dump.add_argument("database")
+    dump.add_argument("collection")
+    dump.add_argument("-o", "--output", help="output file (default: stdout)")
+    dump.add_argument("--format", choices=DUMP_FORMATS, default="ndjson")
+    dump.add_argument("--gzip", action="store_true")
+    restore = commands.add_parser("restore", help="load a dump into a collection")
+    restore.add_argument("database")
+    restore.add_argument("file")
+    restore.add_argument("--collection", help="target collection (default: the one in a binary dump's header)")
+    restore.add_argument("--batch-size", type=int)
+    args = parser.parse_args(argv)
+
+    # The database's status messages go to stderr, stdout may be the dump
+    stdout = sys.stdout.buffer
+    sys.stdout = sys.stderr
+    # Uses the database directory of the server (MANGODB_DATABASES_DIR); run
+    # it while the server is stopped, or use the HTTP endpoints instead
+    from app import db
+
+    if args.command == "dump":
+        chunks, error = db.export_collection(args.database, args.collection, args.format, args.gzip)
+        if error:
+            print(error, file=sys.stderr)
+            return 1
+        output = open(args.output, "wb") if args.output else stdout
+        try:
+            for chunk in chunks:
+                output.write(chunk)
+        finally:
+            if args.output:
+                output.close()
+        return 0
+
+    result = db.restore_collection(args.database, args.collection, _read_file(args.file), args.batch_size)
+    stdout.write(json.dumps(result, indent=2).encode("utf-8") + b"\n")
+    return 1 if "error" in result else 0
+
+
+if __name__ == "__main__":
+    sys.exit(_main(sys.argv[1:]))
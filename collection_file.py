@@ -0,0 +1,611 @@
+"""Collection file format with an offset directory, read through mmap.
+
+Layout of <collection>.col:
+
+    header     magic "MCOL", version u16, codec id u16, compression id u8,
+               compression level u8, reserved u16, document count u64,
+               directory offset u64, directory length u64
+    documents  one encoded document after another (see document_codec),
+               or compressed blocks of whole documents
+    directory  (offset u64, length u32) per document, then a JSON object
+               with the array of their _ids (null for documents without
+               one), the codec's per-file state (binary field names) and,
+               when compressed, the blocks as
+               [file offset, compressed length, offset, length]
+
+Opening a collection only parses the directory; documents are decoded
+when they are accessed, so a lookup by _id decodes one document and a
+rewrite can copy unchanged documents byte for byte. In a compressed file
+document offsets are positions in the uncompressed stream and reading a
+document decompresses only its block (see block_compression). Version 1
+and 2 files (no compression fields) are still read, and so are
+collections stored as a JSON array in <collection>.json (the previous
+format); they are converted the first time they are written.
+
+A collection can instead be split into N partition files by a hash of
+_id, each in the format above; filter scans then run one worker per
+partition. They are stored as <collection>.parts/<generation>/part-0000.col
+... part-<N-1>.col, where <collection>.parts/CURRENT names the generation.
+A write puts every partition in a new generation (unchanged ones are hard
+links) and switches CURRENT with one rename, so readers and crashes see
+all partitions of one write or all of the previous one. The earlier flat
+layout, <collection>.parts/part-0000.col ..., is still read.
+
+    python collection_file.py info <database dir> [collection]
+    python collection_file.py convert <database dir> <collection> <json|binary>
+    python collection_file.py compress <database dir> <collection> <none|zlib|lzma> [level]
+    python collection_file.py partition <database dir> <collection> <partitions>
+"""
+import bisect
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import threading
+import zlib
+
+from block_compression import BLOCK_SIZE, NO_COMPRESSION, Compression, block_cache
+from document_codec import CODECS_BY_ID, DEFAULT_CODEC, JSONCodec, get_codec
+from file_sync import fsync_directory, fsync_file, temp_directory, temp_path
+import metrics
+
+COLLECTION_MAGIC = b"MCOL"
+COLLECTION_VERSION = 3
+COLLECTION_EXTENSION = ".col"
+LEGACY_EXTENSION = ".json"
+PARTITIONS_EXTENSION = ".parts"
+MANIFEST_FILE = "CURRENT"  # in <collection>.parts, names the current generation
+GENERATION_PREFIX = "gen"
+MAX_PARTITIONS = 256
+
+# Held while the files of a collection are renamed into place, and while
+# readers find and open them (open_snapshot()), so that they see all of
+# them from the same write and none is removed in between
+swap_lock = threading.Lock()
+
+BYTES_READ = metrics.counter("mangodb_collection_bytes_read_total", "Encoded document bytes read from collection files")
+BYTES_WRITTEN = metrics.counter("mangodb_collection_bytes_written_total", "Bytes written to collection files")
+
+_PREFIX = struct.Struct("<4sH")
+_HEADER_V2 = struct.Struct("<4sHHQQQ")
+_HEADER = struct.Struct("<4sHHBBHQQQ")
+_ENTRY = struct.Struct("<QI")
+
+
+def _read_header(data):
+    """(version, codec id, compression, count, directory offset, directory length)"""
+    magic, version = _PREFIX.unpack_from(data)
+    if magic != COLLECTION_MAGIC or version > COLLECTION_VERSION:
+        raise ValueError("not a collection file")
+    if version < 3:
+        _, _, codec_id, count, directory_offset, directory_length = _HEADER_V2.unpack_from(data)
+        return version, codec_id, NO_COMPRESSION, count, directory_offset, directory_length
+    (_, _, codec_id, compression_id, level, _,
+     count, directory_offset, directory_length) = _HEADER.unpack_from(data)
+    return (version, codec_id, Compression.from_id(compression_id, level),
+            count, directory_offset, directory_length)
+
+
+def collection_path(db_path, name):
+    return os.path.join(db_path, f"{name}{COLLECTION_EXTENSION}")
+
+
+def legacy_path(db_path, name):
+    return os.path.join(db_path, f"{name}{LEGACY_EXTENSION}")
+
+
+def partitions_path(db_path, name):
+    return os.path.join(db_path, f"{name}{PARTITIONS_EXTENSION}")
+
+
+def partition_file_name(partition):
+    return f"part-{partition:04d}{COLLECTION_EXTENSION}"
+
+
+def generation_path(db_path, name):
+    """Directory of a partitioned collection's current files: the generation
+    CURRENT names, or the .parts directory itself in the flat layout"""
+    directory = partitions_path(db_path, name)
+    try:
+        with open(os.path.join(directory, MANIFEST_FILE), "r") as f:
+            return os.path.join(directory, f.read().strip())
+    except FileNotFoundError:
+        return directory
+
+
+def partition_path(db_path, name, partition):
+    return os.path.join(generation_path(db_path, name), partition_file_name(partition))
+
+
+def partition_count(db_path, name):
+    """Number of partition files of a collection, 0 if it is a single file"""
+    if not os.path.isdir(partitions_path(db_path, name)):
+        return 0
+    try:
+        file_names = os.listdir(generation_path(db_path, name))
+    except FileNotFoundError:
+        return 0
+    return sum(1 for file_name in file_names
+               if file_name.startswith("part-") and file_name.endswith(COLLECTION_EXTENSION))
+
+
+def partition_of(doc_id, partitions):
+    """Partition of a document; stable across processes, unlike hash()"""
+    key = json.dumps(doc_id, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    return zlib.crc32(key) % partitions
+
+
+def collection_files(db_path, name):
+    """Paths of a collection's files: its partitions, or the single collection file"""
+    partitions = partition_count(db_path, name)
+    if partitions:
+        directory = generation_path(db_path, name)
+        return [os.path.join(directory, partition_file_name(partition)) for partition in range(partitions)]
+    return [collection_path(db_path, name)]
+
+
+def collection_exists(db_path, name):
+    return (os.path.exists(collection_path(db_path, name)) or os.path.exists(legacy_path(db_path, name))
+            or os.path.isdir(partitions_path(db_path, name)))
+
+
+def list_collections(db_path):
+    """Names of the collections stored in a database directory, in any format"""
+    names = set()
+    for file_name in os.listdir(db_path):
+        for extension in (COLLECTION_EXTENSION, LEGACY_EXTENSION):
+            if file_name.endswith(extension) and os.path.isfile(os.path.join(db_path, file_name)):
+                names.add(file_name[:-len(extension)])
+        if file_name.endswith(PARTITIONS_EXTENSION) and os.path.isdir(os.path.join(db_path, file_name)):
+            names.add(file_name[:-len(PARTITIONS_EXTENSION)])
+    return sorted(names)
+
+
+class CollectionFile:
+    """Read-only, memory-mapped view of a collection file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = []  # (offset, length) per document
+        self.ids = []
+        self.codec = JSONCodec()
+        self.compression = NO_COMPRESSION
+        self.blocks = None  # (file offset, compressed length, offset, length) when compressed
+        self.identity = None
+        self.data = None
+        self.bytes_read = 0  # added to BYTES_READ when closed
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            if stat.st_size == 0:
+                return
+            # Files are replaced by renames, so this names one version of the
+            # file, also under the name of a link in a later generation
+            self.identity = (stat.st_dev, stat.st_ino, stat.st_mtime_ns)
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            version, codec_id, self.compression, count, directory_offset, directory_length = \
+                _read_header(self.data)
+            if codec_id not in CODECS_BY_ID:
+                raise ValueError(f"unknown codec {codec_id}")
+        except (ValueError, struct.error):
+            self.close()
+            raise ValueError(f"{path} is not a collection file")
+        ids_offset = directory_offset + count * _ENTRY.size
+        self.entries = list(_ENTRY.iter_unpack(self.data[directory_offset:ids_offset]))
+        directory = json.loads(self.data[ids_offset:directory_offset + directory_length])
+        if version == 1:
+            # Version 1 stored the id array alone, always with JSON documents
+            directory = {"ids": directory, "names": None}
+        self.ids = directory["ids"]
+        self.codec = CODECS_BY_ID[codec_id](directory["names"])
+        if self.compression.enabled:
+            self.blocks = directory["blocks"]
+            self.block_starts = [block[2] for block in self.blocks]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def raw(self, position):
+        """Encoded bytes of the document at a position"""
+        offset, length = self.entries[position]
+        self.bytes_read += length
+        if self.blocks is None:
+            return self.data[offset:offset + length]
+        block_no = bisect.bisect_right(self.block_starts, offset) - 1
+        block = block_cache.get((self.identity, block_no), lambda: self._decompress(block_no))
+        start = offset - self.block_starts[block_no]
+        return block[start:start + length]
+
+    def _decompress(self, block_no):
+        file_offset, compressed_length, _, _ = self.blocks[block_no]
+        return self.compression.decompress(self.data[file_offset:file_offset + compressed_length])
+
+    def document(self, position):
+        return self.codec.decode(self.raw(position))
+
+    def __iter__(self):
+        for position in range(len(self.entries)):
+            yield self.document(position)
+
+    def close(self):
+        if self.bytes_read:
+            BYTES_READ.inc(self.bytes_read)
+            self.bytes_read = 0
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+
+
+def open_snapshot(db_path, name):
+    """Views of every file of a collection, all from the same write.
+
+    Writers replace files by renaming new ones over them, so the mapped
+    files stay readable, unchanged, while later writes go on; only the
+    opening waits for a swap in progress. Returns None for a collection in
+    the previous JSON array format.
+    """
+    with swap_lock:
+        if not partition_count(db_path, name) and not os.path.exists(collection_path(db_path, name)):
+            return None
+        files = []
+        try:
+            for path in collection_files(db_path, name):
+                files.append(CollectionFile(path))
+        except Exception:
+            for collection in files:
+                collection.close()
+            raise
+        return files
+
+
+def write_collection(path, records, codec, compression=NO_COMPRESSION):
+    """Write a collection file from (doc_id, encoded document) pairs.
+
+    The documents must have been encoded by `codec`, whose per-file state
+    is written last, after every document has been encoded. With
+    compression, documents are gathered into blocks of about BLOCK_SIZE
+    bytes and each block is compressed on its own.
+    """
+    entries, ids, blocks = [], [], []
+    block = bytearray()
+    with open(path, "wb") as f:
+        f.write(bytes(_HEADER.size))
+        file_offset = _HEADER.size
+        # Document offsets are file offsets, or stream offsets when compressed
+        offset = 0 if compression.enabled else _HEADER.size
+
+        def write_block():
+            nonlocal file_offset
+            compressed = compression.compress(bytes(block))
+            f.write(compressed)
+            blocks.append([file_offset, len(compressed), offset - len(block), len(block)])
+            file_offset += len(compressed)
+            block.clear()
+
+        for doc_id, encoded in records:
+            if compression.enabled:
+                block += encoded
+            else:
+                f.write(encoded)
+                file_offset += len(encoded)
+            entries.append(_ENTRY.pack(offset, len(encoded)))
+            ids.append(doc_id)
+            offset += len(encoded)
+            if len(block) >= BLOCK_SIZE:
+                write_block()
+        if block:
+            write_block()
+
+        directory = {"ids": ids, "names": codec.names}
+        if compression.enabled:
+            directory["blocks"] = blocks
+        directory = b"".join(entries) + json.dumps(directory, separators=(",", ":")).encode("utf-8")
+        f.write(directory)
+        f.seek(0)
+        f.write(_HEADER.pack(COLLECTION_MAGIC, COLLECTION_VERSION, codec.codec_id,
+                             compression.compression_id, compression.level, 0,
+                             len(ids), file_offset, len(directory)))
+        # Durable before it is renamed over the collection: a checkpoint may then drop the log
+        fsync_file(f)
+    BYTES_WRITTEN.inc(file_offset + len(directory))
+
+
+def write_documents(path, documents, codec, compression=NO_COMPRESSION):
+    write_collection(path, ((doc.get("_id"), codec.encode(doc)) for doc in documents), codec, compression)
+
+
+def _file_storage(path):
+    if not os.path.exists(path) or os.path.getsize(path) < _HEADER_V2.size:
+        return DEFAULT_CODEC, NO_COMPRESSION
+    with open(path, "rb") as f:
+        _, codec_id, compression, _, _, _ = _read_header(f.read(_HEADER.size))
+    return CODECS_BY_ID[codec_id].name, compression
+
+
+def collection_storage(db_path, name):
+    """(codec name, Compression) a collection is stored with"""
+    with swap_lock:
+        return _file_storage(collection_files(db_path, name)[0])
+
+
+def collection_codec(db_path, name):
+    """Name of the codec a collection is stored with"""
+    return collection_storage(db_path, name)[0]
+
+
+def collection_compression(db_path, name):
+    """Compression a collection is stored with"""
+    return collection_storage(db_path, name)[1]
+
+
+def read_documents(db_path, name):
+    """Every document of a collection, decoded, in any format"""
+    if not collection_exists(db_path, name):
+        raise FileNotFoundError(f"Collection '{name}' does not exist")
+    files = open_snapshot(db_path, name)
+    if files is None:
+        with open(legacy_path(db_path, name), "r") as f:
+            return json.load(f)
+    documents = []
+    try:
+        for collection in files:
+            documents.extend(collection)
+    finally:
+        for collection in files:
+            collection.close()
+    return documents
+
+
+def collection_size(db_path, name):
+    """Bytes on disk of a collection's files"""
+    with swap_lock:
+        if partition_count(db_path, name):
+            return sum(os.path.getsize(path) for path in collection_files(db_path, name))
+        if os.path.exists(collection_path(db_path, name)):
+            return os.path.getsize(collection_path(db_path, name))
+    return os.path.getsize(legacy_path(db_path, name))
+
+
+def collection_stats(db_path, name):
+    """Document count, size, modification time and storage settings of a collection.
+
+    Reads only file headers, except for the previous JSON array format.
+    """
+    with swap_lock:
+        partitions = partition_count(db_path, name)
+        if partitions or os.path.exists(collection_path(db_path, name)):
+            paths = collection_files(db_path, name)
+            documents = 0
+            for path in paths:
+                with open(path, "rb") as f:
+                    documents += _read_header(f.read(_HEADER.size))[3]
+            codec_name, compression = _file_storage(paths[0])
+            return {
+                "documents": documents,
+                "bytes": sum(os.path.getsize(path) for path in paths),
+                "modified": max(os.path.getmtime(path) for path in paths),
+                "codec": codec_name,
+                "compression": repr(compression),
+                "partitions": partitions,
+            }
+    path = legacy_path(db_path, name)
+    with open(path, "r") as f:
+        documents = len(json.load(f))
+    return {"documents": documents, "bytes": os.path.getsize(path), "modified": os.path.getmtime(path),
+            "codec": DEFAULT_CODEC, "compression": repr(NO_COMPRESSION), "partitions": 0}
+
+
+class StagedCollection:
+    """New files of a collection, written next to the current ones but not in use yet.
+
+    Write each partition to path(partition) (or link() an unchanged one),
+    then seal(). publish() puts them in use with one rename; call it with
+    swap_lock held, and finish() after releasing it to remove the files
+    they replaced. discard() drops them instead. A single-file collection
+    is written to a temp file renamed over <collection>.col; partitions
+    go to a new generation that CURRENT is switched to.
+    """
+
+    def __init__(self, db_path, name, partitions):
+        self.db_path = db_path
+        self.name = name
+        self.partitions = partitions
+        self.directory = partitions_path(db_path, name)
+        self.stale = []  # files and directories replaced, removed by finish()
+        self.new_directory = None  # a first partitioned layout: renamed to <collection>.parts
+        self.manifest = None
+        self.published = None  # directory of the new partition files, once published
+        if partitions <= 1:
+            self.generation = None
+            self.temp = temp_path(collection_path(db_path, name))
+            return
+        self.temp = None
+        if not os.path.isdir(self.directory):
+            self.new_directory = temp_directory(self.directory)
+        # Unfinished generations keep the .temp suffix: publish() never removes those
+        self.generation = temp_directory(os.path.join(self.new_directory or self.directory, GENERATION_PREFIX))
+
+    def path(self, partition=0):
+        """Where to write a partition (or the single file)"""
+        if self.generation is None:
+            return self.temp
+        return os.path.join(self.generation, partition_file_name(partition))
+
+    def link(self, partition, source):
+        """Reuse an unchanged partition file: a hard link, or a copy where links are not supported"""
+        path = self.path(partition)
+        try:
+            os.link(source, path)
+        except OSError:
+            shutil.copyfile(source, path)
+            with open(path, "rb+") as f:
+                fsync_file(f)
+
+    def seal(self):
+        """Make the written files durable; the manifest naming them is written as a temp file"""
+        if self.generation is None:
+            return
+        fsync_directory(self.generation)
+        directory = self.new_directory or self.directory
+        self.manifest = temp_path(os.path.join(directory, MANIFEST_FILE))
+        with open(self.manifest, "w") as f:
+            f.write(os.path.basename(self.generation)[:-len(".temp")])
+            fsync_file(f)
+
+    def publish(self):
+        """Put the new files in use with one rename (swap_lock held)"""
+        single = collection_path(self.db_path, self.name)
+        if self.generation is None:
+            os.replace(self.temp, single)
+            if os.path.isdir(self.directory):
+                # The partitions take precedence over the single file until they are moved away
+                fsync_directory(self.db_path)
+                shutil.rmtree(self.directory + ".old", ignore_errors=True)
+                os.replace(self.directory, self.directory + ".old")
+                self.stale.append(self.directory + ".old")
+            remove_legacy(self.db_path, self.name)
+            self.temp = None
+            return
+        generation = self.generation[:-len(".temp")]
+        os.rename(self.generation, generation)
+        self.generation = None
+        self.published = os.path.join(self.directory, os.path.basename(generation))
+        if self.new_directory is not None:
+            os.replace(os.path.join(self.new_directory, os.path.basename(self.manifest)),
+                       os.path.join(self.new_directory, MANIFEST_FILE))
+            os.rename(self.new_directory, self.directory)
+            self.new_directory = None
+            # The single file or JSON array is removed only once the partitions are durable
+            fsync_directory(self.db_path)
+        else:
+            os.replace(self.manifest, os.path.join(self.directory, MANIFEST_FILE))
+            for entry in os.listdir(self.directory):
+                if entry not in (MANIFEST_FILE, os.path.basename(generation)) and not entry.endswith(".temp"):
+                    self.stale.append(os.path.join(self.directory, entry))
+        for path in (single, legacy_path(self.db_path, self.name)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def published_path(self, partition=0):
+        """Path of a partition (or the single file) once published"""
+        if self.published is None:
+            return collection_path(self.db_path, self.name)
+        return os.path.join(self.published, partition_file_name(partition))
+
+    def finish(self):
+        """Make the switch durable, then remove the files it replaced"""
+        fsync_directory(self.directory if self.partitions > 1 else self.db_path)
+        for path in self.stale:
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                os.remove(path)
+        self.stale = []
+
+    def discard(self):
+        """Drop the new files (when writing them failed)"""
+        if self.temp is not None and os.path.exists(self.temp):
+            os.remove(self.temp)
+        for path in (self.generation, self.new_directory):
+            if path is not None:
+                shutil.rmtree(path, ignore_errors=True)
+        if self.manifest is not None and os.path.exists(self.manifest):
+            os.remove(self.manifest)
+
+
+def stage_documents(db_path, name, documents, codec_name, compression, partitions):
+    """A StagedCollection of `documents`, routed to their partitions, written and sealed"""
+    if partitions > MAX_PARTITIONS:
+        raise ValueError(f"A collection can have at most {MAX_PARTITIONS} partitions")
+    stage = StagedCollection(db_path, name, partitions)
+    try:
+        if partitions <= 1:
+            write_documents(stage.path(), documents, get_codec(codec_name)(), compression)
+        else:
+            buckets = [[] for _ in range(partitions)]
+            for doc in documents:
+                buckets[partition_of(doc.get("_id"), partitions)].append(doc)
+            for partition, bucket in enumerate(buckets):
+                write_documents(stage.path(partition), bucket, get_codec(codec_name)(), compression)
+        stage.seal()
+    except BaseException:
+        stage.discard()
+        raise
+    return stage
+
+
+def save_documents(db_path, name, documents, codec_name=None, compression=None, partitions=None):
+    """Atomically replace a collection's contents.
+
+    The collection keeps its current codec, compression and partition
+    count unless `codec_name`, `compression` or `partitions` is given.
+    Every file is written first, then swapped in with one rename (see
+    StagedCollection).
+    """
+    current_codec, current_compression = collection_storage(db_path, name)
+    if partitions is None:
+        partitions = partition_count(db_path, name)
+    stage = stage_documents(db_path, name, documents, codec_name or current_codec,
+                            compression or current_compression, partitions)
+    with swap_lock:
+        stage.publish()
+    stage.finish()
+
+
+def convert_collection(db_path, name, codec_name=None, compression=None, partitions=None):
+    """Rewrite a collection with another codec, compression or partition count;
+    returns (old size, new size) in bytes"""
+    if codec_name:
+        get_codec(codec_name)
+    old_size = collection_size(db_path, name)
+    save_documents(db_path, name, read_documents(db_path, name), codec_name, compression, partitions)
+    return old_size, collection_size(db_path, name)
+
+
+def remove_legacy(db_path, name):
+    if os.path.exists(legacy_path(db_path, name)):
+        os.remove(legacy_path(db_path, name))
+
+
+def create_collection_file(db_path, name, codec_name=None, compression=None, partitions=None):
+    save_documents(db_path, name, [], codec_name, compression, partitions)
+
+
+def _main(argv):
+    if len(argv) >= 2 and argv[0] == "info":
+        db_path = argv[1]
+        for name in argv[2:] or list_collections(db_path):
+            paths = collection_files(db_path, name)
+            if not os.path.exists(paths[0]):
+                print(f"{name}: previous JSON array format")
+                continue
+            collections = [CollectionFile(path) for path in paths]
+            partitions = f", {len(paths)} partitions" if partition_count(db_path, name) else ""
+            print(f"{name}: {sum(len(c) for c in collections)} documents, codec {collections[0].codec.name}, "
+                  f"compression {collections[0].compression!r}{partitions}, "
+                  f"{collection_size(db_path, name)} bytes")
+            for collection in collections:
+                collection.close()
+        return 0
+    if len(argv) == 4 and argv[0] == "convert":
+        old_size, new_size = convert_collection(argv[1], argv[2], argv[3])
+        print(f"{argv[2]}: {old_size} -> {new_size} bytes ({argv[3]})")
+        return 0
+    if len(argv) in (4, 5) and argv[0] == "compress":
+        compression = Compression(argv[3], argv[4] if len(argv) == 5 else None)
+        old_size, new_size = convert_collection(argv[1], argv[2], compression=compression)
+        print(f"{argv[2]}: {old_size} -> {new_size} bytes ({compression!r})")
+        return 0
+    if len(argv) == 4 and argv[0] == "partition":
+        old_size, new_size = convert_collection(argv[1], argv[2], partitions=int(argv[3]))
+        print(f"{argv[2]}: {old_size} -> {new_size} bytes ({argv[3]} partitions)")
+        return 0
+    for line in __doc__.strip().splitlines()[-4:]:
+        print(line)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(_main(sys.argv[1:]))
@@ -0,0 +1,154 @@
+"""Document encodings used by collection files.
+
+A codec instance belongs to one collection file: encode() and decode()
+convert single documents, and `names` is whatever per-file state the
+codec needs stored alongside the documents (None for JSON, the interned
+field names for the binary codec).
+
+Binary encoding: every value starts with a type byte; integers are
+zigzag varints, floats are f64, strings, lists and objects are prefixed
+with their varint length, and object keys are varint references into the
+file's field-name table.
+"""
+import json
+import struct
+
+_F64 = struct.Struct("<d")
+
+(T_NULL, T_FALSE, T_TRUE, T_INT, T_FLOAT, T_STR, T_LIST, T_OBJECT) = range(8)
+
+
+class JSONCodec:
+    """Compact JSON; readable and compatible with the previous file format"""
+    name = "json"
+    codec_id = 0
+
+    def __init__(self, names=None):
+        self.names = None
+
+    def encode(self, doc):
+        return json.dumps(doc, separators=(",", ":")).encode("utf-8")
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+def _write_varint(out, value):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, pos):
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+class BinaryCodec:
+    """Typed, length-prefixed values with field names interned per file"""
+    name = "binary"
+    codec_id = 1
+
+    def __init__(self, names=None):
+        self.names = list(names or [])
+        self.refs = {name: ref for ref, name in enumerate(self.names)}
+
+    def _ref(self, name):
+        ref = self.refs.get(name)
+        if ref is None:
+            ref = self.refs[name] = len(self.names)
+            self.names.append(name)
+        return ref
+
+    def encode(self, doc):
+        out = bytearray()
+        self._encode(doc, out)
+        return bytes(out)
+
+    def _encode(self, value, out):
+        kind = type(value)
+        if kind is str:
+            data = value.encode("utf-8")
+            out.append(T_STR)
+            _write_varint(out, len(data))
+            out += data
+        elif kind is dict:
+            out.append(T_OBJECT)
+            _write_varint(out, len(value))
+            for key, item in value.items():
+                _write_varint(out, self._ref(key))
+                self._encode(item, out)
+        elif kind is int:
+            out.append(T_INT)
+            _write_varint(out, value * 2 if value >= 0 else -value * 2 - 1)
+        elif kind is bool:
+            out.append(T_TRUE if value else T_FALSE)
+        elif kind is float:
+            out.append(T_FLOAT)
+            out += _F64.pack(value)
+        elif kind is list:
+            out.append(T_LIST)
+            _write_varint(out, len(value))
+            for item in value:
+                self._encode(item, out)
+        elif value is None:
+            out.append(T_NULL)
+        else:
+            raise TypeError(f"Cannot encode value of type {kind.__name__}")
+
+    def decode(self, data):
+        value, _ = self._decode(data, 0)
+        return value
+
+    def _decode(self, data, pos):
+        kind = data[pos]
+        pos += 1
+        if kind == T_STR:
+            length, pos = _read_varint(data, pos)
+            return str(data[pos:pos + length], "utf-8"), pos + length
+        if kind == T_OBJECT:
+            count, pos = _read_varint(data, pos)
+            names = self.names
+            result = {}
+            for _ in range(count):
+                ref, pos = _read_varint(data, pos)
+                result[names[ref]], pos = self._decode(data, pos)
+            return result, pos
+        if kind == T_INT:
+            value, pos = _read_varint(data, pos)
+            return (value >> 1) ^ -(value & 1), pos
+        if kind == T_LIST:
+            count, pos = _read_varint(data, pos)
+            result = []
+            for _ in range(count):
+                item, pos = self._decode(data, pos)
+                result.append(item)
+            return result, pos
+        if kind == T_FLOAT:
+            return _F64.unpack_from(data, pos)[0], pos + 8
+        if kind == T_TRUE:
+            return True, pos
+        if kind == T_FALSE:
+            return False, pos
+        if kind == T_NULL:
+            return None, pos
+        raise ValueError(f"Unknown value type {kind}")
+
+
+CODECS = {codec.name: codec for codec in (JSONCodec, BinaryCodec)}
+CODECS_BY_ID = {codec.codec_id: codec for codec in (JSONCodec, BinaryCodec)}
+DEFAULT_CODEC = "json"
+
+
+def get_codec(name):
+    """Codec class by name; raises ValueError for unknown names"""
+    if name not in CODECS:
+        raise ValueError(f"Unknown codec '{name}', expected one of: {', '.join(sorted(CODECS))}")
+    return CODECS[name]
@@ -2,6 +2,7 @@ import uuid
 from typing import Dict, Any, Optional, List
 import json
 import os
+from profiling import traced
 
 class DocumentValidator:
     def __init__(self, db_path: str):
@@ -31,6 +32,7 @@ class DocumentValidator:
         self.unique_indexes[collection][field] = index_file
         return True
 
+    @traced("validate")
     def validate_document(self, collection: str, document: Dict[str, Any], 
                          is_update: bool = False, old_doc: Optional[Dict[str, Any]] = None) -> tuple[bool, str]:
         """Validate document against schema rules and unique constraints."""
@@ -40,6 +42,9 @@ class DocumentValidator:
         # Check unique constraints
         if collection in self.unique_indexes:
             for field, index_file in self.unique_indexes[collection].items():
+                # _id uniqueness is enforced by the collection's primary index
+                if field == '_id':
+                    continue
                 if field in document:
                     # Skip uniqueness check for the same document during update
                     if is_update and old_doc and old_doc.get(field) == document[field]:
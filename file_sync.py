@@ -0,0 +1,53 @@
+"""Forcing written files, and the directory entries naming them, to disk.
+
+flush() only hands data to the OS; it survives a process crash but not an
+OS crash or power loss. A new or renamed file is durable once its data
+was fsynced and then its directory. Directories cannot be opened on
+every platform (Windows); there the directory sync is skipped.
+"""
+import os
+import tempfile
+
+
+def fsync_file(f):
+    """Force an open file's buffered and written data to disk"""
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def fsync_directory(path):
+    """Force a directory's entries (files created, renamed or removed in it) to disk"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def temp_path(path):
+    """A new, empty temp file next to `path` for one writer to write and rename over it.
+
+    Concurrent writers of the same file each get their own; a fixed name
+    would have one writer's rename move another's half-written file.
+    """
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".",
+                                suffix=".temp")
+    os.close(fd)
+    return temp
+
+
+def temp_directory(path):
+    """A new, empty temp directory next to `path`, see temp_path()"""
+    return tempfile.mkdtemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".",
+                            suffix=".temp")
+
+
+def replace_file(temp_path, path):
+    """Rename a written and fsynced temp file over `path` and make the rename durable"""
+    os.replace(temp_path, path)
+    fsync_directory(os.path.dirname(path) or ".")
@@ -1,7 +1,11 @@
 import json
 import os
-from typing import Dict, List, Any, Optional
+import threading
+from typing import Callable, Dict, Iterable, List, Any, Optional, Tuple
 from bplus_tree import BPlusTree
+from block_compression import decompress_file_data
+from collection_file import collection_compression
+from file_sync import fsync_file, replace_file, temp_path
 
 class Index:
     def __init__(self, collection_name: str, field_name: str):
@@ -23,9 +27,11 @@ class Index:
         
     def to_dict(self) -> dict:
         """Convert index to dictionary for storage"""
-        # Traverse B+ tree to get all data
+        # Traverse B+ tree to get all data, starting from the leftmost leaf
         data = {}
         node = self.tree.root
+        while not node.leaf:
+            node = node.children[0]
         while node.leaf:
             for i, key in enumerate(node.keys):
                 data[key] = node.values[i]
@@ -52,12 +58,63 @@ class Index:
                 index.tree.insert(key, doc_id)
         return index
 
+class PrimaryIndex:
+    """Hash index from _id to the document's slot in a collection"""
+
+    def __init__(self, ids: Iterable[Any]):
+        # ids[slot] is the _id of the document in that slot, None if it has none
+        self.slots: Dict[Any, int] = {
+            self.key(doc_id): slot
+            for slot, doc_id in enumerate(ids) if doc_id is not None
+        }
+
+    @staticmethod
+    def key(doc_id: Any) -> Any:
+        """Hashable form of an _id; documents ids are normally strings or numbers"""
+        try:
+            hash(doc_id)
+            return doc_id
+        except TypeError:
+            return ("__json__", json.dumps(doc_id, sort_keys=True))
+
+    def get(self, doc_id: Any) -> Optional[int]:
+        return self.slots.get(self.key(doc_id))
+
+    def __contains__(self, doc_id: Any) -> bool:
+        return self.key(doc_id) in self.slots
+
+    def add(self, doc_id: Any, slot: int):
+        self.slots[self.key(doc_id)] = slot
+
+    def remove(self, doc_id: Any):
+        self.slots.pop(self.key(doc_id), None)
+
 class IndexManager:
-    def __init__(self, database_dir: str):
+    def __init__(self, database_dir: str, on_dirty: Optional[Callable[[str, str], None]] = None):
         self.database_dir = database_dir
         self.indexes_dir = os.path.join(database_dir, "indexes")
         os.makedirs(self.indexes_dir, exist_ok=True)
         self.indexes: Dict[str, Dict[str, Index]] = {}  # collection_name -> {field_name -> Index}
+        # Index changes are written back lazily; on_dirty(collection, field) is
+        # called on every change so the owner can schedule a flush
+        self.dirty = set()  # (collection_name, field_name)
+        self.on_dirty = on_dirty
+        self.lock = threading.RLock()
+        # Held from snapshot to rename, so a flush never replaces a newer write of the same index
+        self.flush_lock = threading.Lock()
+        self._load_indexes()
+
+    def _load_indexes(self):
+        """Load every index file of the database"""
+        for file_name in os.listdir(self.indexes_dir):
+            if not file_name.endswith("_index.json"):
+                continue
+            try:
+                with open(os.path.join(self.indexes_dir, file_name), 'rb') as f:
+                    index = Index.from_dict(json.loads(decompress_file_data(f.read())))
+                self.indexes.setdefault(index.collection_name, {})[index.field_name] = index
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Error loading index {file_name}: {str(e)}")
         
     def _get_index_path(self, collection_name: str, field_name: str) -> str:
         """Get the path to the index file"""
@@ -79,6 +136,7 @@ class IndexManager:
         """Drop an index for a collection field"""
         if collection_name in self.indexes and field_name in self.indexes[collection_name]:
             del self.indexes[collection_name][field_name]
+            self.dirty.discard((collection_name, field_name))
             if not self.indexes[collection_name]:
                 del self.indexes[collection_name]
             
@@ -96,34 +154,94 @@ class IndexManager:
         """List all indexed fields for a collection"""
         return list(self.indexes.get(collection_name, {}).keys())
         
+    def _encode_index(self, collection_name: str, data: dict) -> bytes:
+        """Index file contents, compressed like the collection they index"""
+        compression = collection_compression(self.database_dir, collection_name)
+        if not compression.enabled:
+            return json.dumps(data, indent=2).encode('utf-8')
+        return compression.compress(json.dumps(data, separators=(',', ':')).encode('utf-8'))
+
     def _save_index(self, index: Index):
         """Save index to disk"""
         index_path = self._get_index_path(index.collection_name, index.field_name)
-        with open(index_path, 'w') as f:
-            json.dump(index.to_dict(), f, indent=2)
+        with open(index_path, 'wb') as f:
+            f.write(self._encode_index(index.collection_name, index.to_dict()))
             
     def _load_index(self, collection_name: str, field_name: str) -> Optional[Index]:
         """Load index from disk"""
         index_path = self._get_index_path(collection_name, field_name)
         if os.path.exists(index_path):
-            with open(index_path, 'r') as f:
-                data = json.load(f)
+            with open(index_path, 'rb') as f:
+                data = json.loads(decompress_file_data(f.read()))
                 return Index.from_dict(data)
         return None
         
+    def _mark_dirty(self, collection_name: str, field_name: str):
+        self.dirty.add((collection_name, field_name))
+        if self.on_dirty:
+            self.on_dirty(collection_name, field_name)
+
+    def flush_index(self, collection_name: str, field_name: str):
+        """Write a dirty index back to disk"""
+        with self.flush_lock:
+            with self.lock:
+                index = self.get_index(collection_name, field_name)
+                if not index or (collection_name, field_name) not in self.dirty:
+                    return
+                self.dirty.discard((collection_name, field_name))
+                data = index.to_dict()
+            # Writers only wait for the snapshot above, not for the file write
+            index_path = self._get_index_path(collection_name, field_name)
+            temp = temp_path(index_path)
+            with open(temp, 'wb') as f:
+                f.write(self._encode_index(collection_name, data))
+                fsync_file(f)
+            replace_file(temp, index_path)
+
+    def mark_collection_dirty(self, collection_name: str):
+        """Schedule every index of a collection to be written again, e.g. after its compression changed"""
+        with self.lock:
+            for field_name in self.list_indexes(collection_name):
+                self._mark_dirty(collection_name, field_name)
+
+    def flush(self):
+        """Write every dirty index back to disk"""
+        for collection_name, field_name in list(self.dirty):
+            self.flush_index(collection_name, field_name)
+
+    def build_index(self, collection_name: str, field_name: str, entries: Iterable[Tuple[Any, str]]):
+        """Fill an index from (field value, document id) pairs in one pass.
+
+        Entries are inserted in key order, so every insert lands in the
+        rightmost leaf of the B+ tree, and the index is marked dirty once.
+        """
+        entries = list(entries)
+        try:
+            entries.sort(key=lambda entry: entry[0])
+        except TypeError:
+            pass  # values of mixed types are inserted as they come
+        with self.lock:
+            index = self.get_index(collection_name, field_name)
+            if index:
+                for field_value, document_id in entries:
+                    index.add_entry(field_value, document_id)
+                self._mark_dirty(collection_name, field_name)
+
     def update_index(self, collection_name: str, field_name: str, field_value: Any, document_id: str):
         """Update an index with a new document"""
-        index = self.get_index(collection_name, field_name)
-        if index:
-            index.add_entry(field_value, document_id)
-            self._save_index(index)
+        with self.lock:
+            index = self.get_index(collection_name, field_name)
+            if index:
+                index.add_entry(field_value, document_id)
+                self._mark_dirty(collection_name, field_name)
             
     def remove_from_index(self, collection_name: str, field_name: str, field_value: Any, document_id: str):
         """Remove a document from an index"""
-        index = self.get_index(collection_name, field_name)
-        if index:
-            index.remove_entry(field_value, document_id)
-            self._save_index(index)
+        with self.lock:
+            index = self.get_index(collection_name, field_name)
+            if index:
+                index.remove_entry(field_value, document_id)
+                self._mark_dirty(collection_name, field_name)
             
     def find_documents(self, collection_name: str, field_name: str, field_value: Any) -> List[str]:
         """Find documents using an index"""
@@ -0,0 +1,116 @@
+"""Committed transactions read back from a database's log while it is written.
+
+A LogTail follows the segment directory of one database (see wal) and
+remembers where it stopped, so each poll() reads only what was flushed
+since. Operation records are held per transaction until its commit record
+arrives, and dropped on an abort, so a poll returns committed work only,
+in commit order.
+
+Two LSNs describe a reader's position: `applied_lsn`, the commit LSN of
+the last transaction it has taken, and `restart_lsn`, where reading must
+start again to see every record of the transactions that commit later
+(the first record of the oldest one still in flight). A reader that
+stores both can resume after a restart without losing or repeating a
+transaction, as long as the log still reaches back to restart_lsn.
+"""
+import os
+
+from wal import WAL_EXTENSION, WALError, list_segments, read_segment_header, tail_records
+
+
+class LogGap(Exception):
+    """Records the reader needs were truncated from the log"""
+
+
+class LogTail:
+    def __init__(self, log_dir, applied_lsn=0, restart_lsn=0):
+        self.log_dir = log_dir
+        self.applied_lsn = applied_lsn
+        self.start_lsn = restart_lsn
+        self.seq = None  # segment being read
+        self.offset = None  # end of the last record read from it
+        self.names = {}  # names interned in that segment
+        self.last_lsn = restart_lsn - 1  # last record read
+        self.pending = {}  # transaction_id -> records logged so far
+
+    @property
+    def restart_lsn(self):
+        if self.pending:
+            return min(records[0]["lsn"] for records in self.pending.values())
+        return max(self.last_lsn + 1, self.start_lsn)
+
+    def _path(self, seq):
+        return os.path.join(self.log_dir, f"{seq:08d}{WAL_EXTENSION}")
+
+    def _start(self, segments):
+        """Pick the segment holding start_lsn; raises LogGap if it was truncated"""
+        try:
+            headers = [(seq, read_segment_header(path)) for seq, path in segments]
+        except (OSError, WALError):
+            return  # A segment being created; try again on the next poll
+        for seq, header in reversed(headers):
+            if header["base_lsn"] <= self.start_lsn:
+                self.seq = seq
+                return
+        # Everything left starts after start_lsn: fine unless segments were dropped
+        if segments[0][0] != 1:
+            raise LogGap(f"log of {os.path.basename(self.log_dir)} starts after LSN {self.start_lsn}")
+        self.seq = segments[0][0]
+
+    def poll(self):
+        """Transactions committed since the last poll, oldest first.
+
+        Each is {"lsn": commit LSN, "transaction_id", "timestamp": commit
+        time, "restart_lsn": the reader's restart_lsn once it has taken this
+        transaction, "records": its operation records in log order}.
+        """
+        committed = []
+        segments = list_segments(self.log_dir)
+        if not segments:
+            return committed
+        if self.seq is None:
+            self._start(segments)
+            if self.seq is None:
+                return committed
+        while True:
+            if not os.path.exists(self._path(self.seq)):
+                raise LogGap(f"segment {self.seq} of {os.path.basename(self.log_dir)} was truncated while read")
+            newer = [seq for seq, _ in segments if seq > self.seq]
+            # Read the current segment to its end even when a newer one
+            # exists: the writer only moves on once it is finished
+            self._read(committed)
+            if not newer:
+                return committed
+            try:
+                header = read_segment_header(self._path(newer[0]))
+            except (OSError, WALError):
+                return committed
+            if header["base_lsn"] <= self.last_lsn:
+                # A recycled segment whose new header is not written yet
+                return committed
+            self.seq, self.offset, self.names = newer[0], None, {}
+
+    def _read(self, committed):
+        for offset, record in tail_records(self._path(self.seq), self.offset, self.names):
+            self.offset = offset
+            lsn = record["lsn"]
+            self.last_lsn = max(self.last_lsn, lsn)
+            if lsn < self.start_lsn:
+                continue
+            transaction_id = record["transaction_id"]
+            operation = record["operation"]
+            if operation == "abort":
+                self.pending.pop(transaction_id, None)
+            elif operation == "commit":
+                records = self.pending.pop(transaction_id, None)
+                if records and lsn > self.applied_lsn:
+                    committed.append({
+                        "lsn": lsn,
+                        "transaction_id": transaction_id,
+                        "timestamp": record["timestamp"],
+                        "restart_lsn": min([lsn + 1] + [pending[0]["lsn"] for pending in self.pending.values()]),
+                        "records": records,
+                    })
+                    self.applied_lsn = lsn
+            else:
+                self.pending.setdefault(transaction_id, []).append(record)
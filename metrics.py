@@ -0,0 +1,212 @@
+"""Process-wide counters and histograms, rendered in the Prometheus text format.
+
+Metrics are created once at import time by the modules that update them
+(`counter`, `histogram`, `gauge` and `observed_counter` register them in
+REGISTRY). Updating one is a dict lookup for its label values plus a few
+additions under a per-series lock; nothing is formatted until render()
+is called.
+"""
+import bisect
+import math
+import threading
+
+# Seconds; from sub-millisecond lookups to multi-second scans
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Seconds; for WAL appends and flushes
+FINE_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.25)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.series = {}  # label values -> series
+        self.series_lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def labels(self, *values):
+        """The series for these label values, created on first use"""
+        series = self.series.get(values)
+        if series is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes labels {self.labelnames}")
+            with self.series_lock:
+                series = self.series.setdefault(values, self._new_series())
+        return series
+
+    def _new_series(self):
+        raise NotImplementedError
+
+    def samples(self):
+        """(suffix, label values, extra label, value) for each sample"""
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {_escape(self.documentation)}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, values, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, values, extra)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class _CounterSeries:
+    __slots__ = ("value", "lock")
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_series(self):
+        return _CounterSeries()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def samples(self):
+        for values, series in sorted(self.series.items()):
+            yield "", values, None, series.value
+
+
+class _HistogramSeries:
+    __slots__ = ("buckets", "counts", "total", "lock")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is above every bound
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        position = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[position] += 1
+            self.total += value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_series(self):
+        return _HistogramSeries(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def samples(self):
+        for values, series in sorted(self.series.items()):
+            with series.lock:
+                counts, total = list(series.counts), series.total
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield "_bucket", values, ("le", _format_value(float(bound))), cumulative
+            count = cumulative + counts[-1]
+            yield "_bucket", values, ("le", "+Inf"), count
+            yield "_sum", values, None, total
+            yield "_count", values, None, count
+
+
+class Observed(_Metric):
+    """Values read when the metrics are rendered, from a function set by their owner.
+
+    The function returns a number, or {label values: number} for a metric
+    with labels. Owners that already count under their own lock use this
+    instead of updating a Counter on every call.
+    """
+
+    def __init__(self, name, documentation, kind, labelnames=()):
+        self.kind = kind
+        self.function = None
+        super().__init__(name, documentation, labelnames)
+
+    def _new_series(self):
+        return None
+
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self):
+        if self.function is None:
+            return
+        value = self.function()
+        if not self.labelnames:
+            yield "", (), None, value
+            return
+        for values, number in sorted(value.items()):
+            yield "", values, None, number
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.register(Observed(name, documentation, "gauge", labelnames))
+
+
+def observed_counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Observed(name, documentation, "counter", labelnames))
+
+
+def render():
+    return REGISTRY.render()
@@ -0,0 +1,57 @@
+"""Newline-delimited JSON (one document per line) for bulk loading collections"""
+import json
+
+MAX_LINE_BYTES = 16 * 1024 * 1024
+
+
+def iter_lines(chunks, max_line_bytes=MAX_LINE_BYTES):
+    """Lines of a byte stream given as chunks, without their line endings.
+
+    Only the current line is buffered. A line longer than max_line_bytes is
+    dropped as it arrives and None is yielded in its place, so the caller
+    can report it by line number.
+    """
+    pending = bytearray()
+    skipping = False
+    for chunk in chunks:
+        start = 0
+        while True:
+            end = chunk.find(b"\n", start)
+            if end < 0:
+                if not skipping:
+                    pending += chunk[start:]
+                    if len(pending) > max_line_bytes:
+                        pending.clear()
+                        skipping = True
+                break
+            if skipping:
+                skipping = False
+                yield None
+            else:
+                pending += chunk[start:end]
+                yield None if len(pending) > max_line_bytes else bytes(pending).rstrip(b"\r")
+                pending.clear()
+            start = end + 1
+    if skipping:
+        yield None
+    elif pending.strip():
+        yield bytes(pending).rstrip(b"\r")
+
+
+def iter_documents(lines):
+    """(line number, document, error) for each non-blank line; document is None when error is set"""
+    for line_number, line in enumerate(lines, 1):
+        if line is None:
+            yield line_number, None, "Line too long"
+            continue
+        if not line.strip():
+            continue
+        try:
+            doc = json.loads(line)
+        except ValueError as e:
+            yield line_number, None, f"Invalid JSON: {str(e)}"
+            continue
+        if not isinstance(doc, dict):
+            yield line_number, None, "Line is not a JSON object"
+            continue
+        yield line_number, doc, None
@@ -0,0 +1,281 @@
+"""Opt-in request profiling: a tree of timed spans with allocation figures.
+
+A request is profiled when the client asks for it (`X-Profile: 1` header
+or `profile=1` parameter) or when it is sampled (Profiler.sample_rate).
+While a profile is active in a thread, `span(name)` blocks and functions
+decorated with `traced(name)` add a span under the current one; repeated
+spans with the same name and parent are merged and counted. With no
+profile active anywhere they cost one check of a module global.
+
+Allocations are measured with tracemalloc, which runs only while at least
+one profile is active: each span gets the net bytes allocated during it
+and the profile lists its top allocation sites with their counts. Both
+include whatever other threads allocated meanwhile.
+"""
+import functools
+import json
+import random
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+_local = threading.local()
+_active = 0  # profiles running in the process
+_active_lock = threading.Lock()
+_started_tracing = False
+
+
+class Span:
+    __slots__ = ("name", "seconds", "calls", "alloc_bytes", "children")
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.calls = 0
+        self.alloc_bytes = 0
+        self.children = {}  # name -> Span, in first-call order
+
+    def to_dict(self):
+        node = {"name": self.name, "ms": round(self.seconds * 1000, 3), "calls": self.calls,
+                "alloc_kb": round(self.alloc_bytes / 1024, 1)}
+        if self.children:
+            node["children"] = [child.to_dict() for child in self.children.values()]
+        return node
+
+
+class _NullSpan:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _SpanContext:
+    __slots__ = ("profile", "name", "span", "start", "memory")
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        stack = _local.stack
+        parent = stack[-1]
+        with self.profile.lock:
+            span = parent.children.get(self.name)
+            if span is None:
+                span = parent.children[self.name] = Span(self.name)
+        stack.append(span)
+        self.span = span
+        self.memory = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+        self.start = time.perf_counter()
+        return span
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        memory = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+        with self.profile.lock:
+            self.span.seconds += seconds
+            self.span.calls += 1
+            self.span.alloc_bytes += memory - self.memory
+        _local.stack.pop()
+        return False
+
+
+class Profile:
+    def __init__(self, name, sampled=False):
+        self.name = name
+        self.sampled = sampled
+        self.root = Span(name)
+        self.lock = threading.Lock()  # batch statements add spans from several threads
+        self.started = time.time()
+        self.allocations = []
+        self.peak_bytes = 0
+
+    def span(self, name):
+        return _SpanContext(self, name)
+
+    def graft(self, span, parent=None):
+        """Attach a finished span tree (e.g. a write group's) under `parent` or the root.
+
+        The tree may be grafted into several profiles; its nodes are shared.
+        """
+        parent = parent or self.root
+        with self.lock:
+            name = span.name
+            while name in parent.children:
+                name += "'"
+            grafted = Span(name)
+            grafted.seconds, grafted.calls, grafted.alloc_bytes = span.seconds, span.calls, span.alloc_bytes
+            grafted.children = span.children
+            parent.children[name] = grafted
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "sampled": self.sampled,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(self.started)),
+            "ms": round(self.root.seconds * 1000, 3),
+            "alloc_kb": round(self.root.alloc_bytes / 1024, 1),
+            "peak_kb": round(self.peak_bytes / 1024, 1),
+            "spans": [child.to_dict() for child in self.root.children.values()],
+            "allocations": self.allocations,
+        }
+
+
+def _start_tracing():
+    global _active, _started_tracing
+    with _active_lock:
+        _active += 1
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _started_tracing = True
+
+
+def _stop_tracing():
+    global _active, _started_tracing
+    with _active_lock:
+        _active -= 1
+        if _active == 0 and _started_tracing:
+            tracemalloc.stop()
+            _started_tracing = False
+
+
+def current():
+    """The profile active in this thread, or None"""
+    if not _active:
+        return None
+    return getattr(_local, "profile", None)
+
+
+def current_span():
+    stack = getattr(_local, "stack", None)
+    return stack[-1] if stack else None
+
+
+class activate:
+    """Make a profile the active one in this thread, under `parent` (default: its root).
+
+    Used to carry a profile into a worker thread; None deactivates
+    profiling for the block.
+    """
+
+    def __init__(self, profile, parent=None):
+        self.profile = profile
+        self.parent = parent
+
+    def __enter__(self):
+        self.saved = (getattr(_local, "profile", None), getattr(_local, "stack", None))
+        _local.profile = self.profile
+        _local.stack = [self.parent or self.profile.root] if self.profile else None
+        return self.profile
+
+    def __exit__(self, *exc_info):
+        _local.profile, _local.stack = self.saved
+        return False
+
+
+def span(name):
+    """Context manager timing a block as a span of the active profile, if any"""
+    if not _active:
+        return _NULL_SPAN
+    profile = getattr(_local, "profile", None)
+    if profile is None:
+        return _NULL_SPAN
+    return _SpanContext(profile, name)
+
+
+def traced(name):
+    """Decorator recording every call of a function as a span named `name`"""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _active:
+                return function(*args, **kwargs)
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def run_in(profile, function, *args):
+    """Call function(*args) with `profile` active and time it as the profile's root"""
+    memory = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+    with activate(profile):
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            profile.root.seconds = time.perf_counter() - start
+            profile.root.calls = 1
+            if tracemalloc.is_tracing():
+                current_memory, profile.peak_bytes = tracemalloc.get_traced_memory()
+                profile.root.alloc_bytes = current_memory - memory
+
+
+def run_profiled(profile, function, *args):
+    """run_in() with tracemalloc running, recording the top allocation sites"""
+    _start_tracing()
+    try:
+        start_snapshot = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        try:
+            return run_in(profile, function, *args)
+        finally:
+            profile.allocations = [
+                {"where": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                 "kb": round(stat.size_diff / 1024, 1), "count": stat.count_diff}
+                for stat in tracemalloc.take_snapshot().compare_to(start_snapshot, "lineno")[:10]
+                if stat.size_diff > 0
+            ]
+    finally:
+        _stop_tracing()
+
+
+class Profiler:
+    """Decides which requests to profile and keeps the `keep` most recent profiles"""
+
+    def __init__(self, sample_rate=0.0, keep=100):
+        self.sample_rate = sample_rate
+        self.profiles = deque(maxlen=keep)
+        self.lock = threading.Lock()
+
+    def run(self, name, requested, function, *args):
+        """function(*args), profiled if requested or sampled.
+
+        A requested profile is also returned with the result, under
+        "profile" when the result is a dict; every profile is kept for
+        recent().
+        """
+        sampled = not requested and self.sample_rate > 0 and random.random() < self.sample_rate
+        if not requested and not sampled:
+            return function(*args)
+        profile = Profile(name, sampled)
+        result = run_profiled(profile, self._serialized, function, args)
+        profile_dict = profile.to_dict()
+        with self.lock:
+            self.profiles.append(profile_dict)
+        if requested and isinstance(result, dict):
+            result = dict(result, profile=profile_dict)
+        return result
+
+    @staticmethod
+    def _serialized(function, args):
+        result = function(*args)
+        # What the server will do with the result next
+        with span("serialize"):
+            json.dumps(result)
+        return result
+
+    def recent(self, limit=20):
+        with self.lock:
+            return list(self.profiles)[-limit:][::-1]
+
+
+def is_requested(value):
+    """Whether a header or parameter value asks for a profile"""
+    return value is not None and str(value).lower() in ("1", "true", "yes")
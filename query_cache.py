@@ -0,0 +1,108 @@
+import itertools
+import json
+import threading
+from collections import OrderedDict
+
+
+class QueryCache:
+    """Results of read queries, keyed by normalised query and collection version.
+
+    Every committed write to a collection bumps its version after the
+    collection files are written, so an entry can only be found while the
+    data it was computed from is current. A result must be stored with the
+    version read *before* the data was loaded; entries stored under an
+    older version are dropped. Results are kept JSON-encoded, which gives
+    their size for the byte bound and hands every reader its own copy.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_bytes // 8  # one huge result must not flush the cache
+        self.entries = OrderedDict()  # (db, collection, version, query key) -> encoded result
+        self.size = 0
+        self.keys = {}  # (db, collection) -> keys of its entries
+        self.versions = {}  # (db, collection) -> version of its last committed write
+        self.generations = {}  # db -> generation, bumped when the database is deleted
+        self.counter = itertools.count(1)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @staticmethod
+    def query_key(operation, query):
+        """Normalised form of a query: field order does not matter"""
+        return operation + json.dumps(query, sort_keys=True, separators=(",", ":"))
+
+    def version(self, db_name, collection):
+        with self.lock:
+            return self.generations.get(db_name, 0), self.versions.get((db_name, collection), 0)
+
+    def get(self, db_name, collection, version, query_key):
+        """A fresh copy of the cached result, or None"""
+        if not self.enabled:
+            return None
+        with self.lock:
+            encoded = self.entries.get((db_name, collection, version, query_key))
+            if encoded is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end((db_name, collection, version, query_key))
+            self.hits += 1
+        return json.loads(encoded)
+
+    def put(self, db_name, collection, version, query_key, result):
+        if not self.enabled:
+            return
+        encoded = json.dumps(result, separators=(",", ":")).encode("utf-8")
+        if len(encoded) > self.max_entry_bytes:
+            return
+        key = (db_name, collection, version, query_key)
+        with self.lock:
+            current = self.generations.get(db_name, 0), self.versions.get((db_name, collection), 0)
+            if version != current or key in self.entries:
+                return
+            self.entries[key] = encoded
+            self.keys.setdefault((db_name, collection), set()).add(key)
+            self.size += len(encoded)
+            while self.size > self.max_bytes:
+                evicted_key, evicted = self.entries.popitem(last=False)
+                self.keys[evicted_key[:2]].discard(evicted_key)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def bump(self, db_name, collection):
+        """Record a committed write: cached results of the collection become unreachable"""
+        with self.lock:
+            self.versions[(db_name, collection)] = next(self.counter)
+            self._drop((db_name, collection))
+
+    def drop_database(self, db_name):
+        with self.lock:
+            self.generations[db_name] = next(self.counter)
+            for collection_key in [key for key in self.keys if key[0] == db_name]:
+                self._drop(collection_key)
+
+    def _drop(self, collection_key):
+        for key in self.keys.pop(collection_key, ()):
+            self.size -= len(self.entries.pop(key))
+            self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
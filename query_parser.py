@@ -4,12 +4,13 @@ import json
 def parse_raw_query(query_str):
     """
     Parses a raw MongoDB-style string (e.g., db.users.find({...})) into:
-    - operation (find, insert, update, delete, create_collection, insert_many, create_index, drop_index)
+    - operation (find, explain, insert, update, delete, create_collection, insert_many, create_index, drop_index)
     - collection name
     - parameters (dict or list)
 
     Supports:
     - find({query})
+    - find({query}).explain()  (operation 'explain', params are the find's)
     - insert({doc})
     - insertMany([{doc1}, {doc2}, ...])
     - update({query}, {update})
@@ -24,6 +25,13 @@ def parse_raw_query(query_str):
     # Clean up the string: remove newlines, tabs
     query_str = query_str.strip().replace('\n', ' ').replace('\t', ' ')
     
+    # find(...).explain() runs the find and reports how it was executed
+    if query_str.endswith('.explain()'):
+        operation, collection_name, params = parse_raw_query(query_str[:-len('.explain()')])
+        if operation != 'find':
+            return None, None, None
+        return 'explain', collection_name, params
+
     # Regex pattern: db.collection.operation(params)
     pattern = r'^db\.([a-zA-Z0-9_]+)\.([a-zA-Z0-9_]+)\((.*)\)$'
     match = re.match(pattern, query_str)
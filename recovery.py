@@ -0,0 +1,200 @@
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from collection_file import collection_exists, create_collection_file, read_documents, save_documents
+from indexing import PrimaryIndex
+from wal import apply_delta, read_records
+
+# Operations replayed against collection files; everything else is either
+# transaction control (commit/abort) or DDL handled before the data phase.
+DATA_OPERATIONS = {"insert", "update", "delete"}
+
+
+def analyze(log_paths, start_lsn=0):
+    """Analysis pass: transaction outcomes and the collections each log touches.
+
+    Only record headers are decoded, so this is cheap even for large logs.
+    `log_paths` maps db_name -> list of log files in LSN order.
+    """
+    committed, aborted = set(), set()
+    transactions = defaultdict(set)  # transaction_id -> db names it logged to
+    partitions = set()  # (db_name, collection)
+    ddl = []
+    records = 0
+    last_lsn = 0
+
+    for db_name, paths in log_paths.items():
+        for path in paths:
+            for record in read_records(path, with_payload=False):
+                if record["lsn"] < start_lsn:
+                    continue
+                records += 1
+                last_lsn = max(last_lsn, record["lsn"])
+                transaction_id = record["transaction_id"]
+                operation = record["operation"]
+                if operation == "commit":
+                    committed.add(transaction_id)
+                elif operation == "abort":
+                    aborted.add(transaction_id)
+                else:
+                    transactions[transaction_id].add(record["db_name"])
+                    if operation in DATA_OPERATIONS:
+                        partitions.add((record["db_name"], record["collection"]))
+                    else:
+                        ddl.append(record)
+
+    # Transactions with neither a commit nor an abort record were in flight
+    losers = {tid: dbs for tid, dbs in transactions.items()
+              if tid not in committed and tid not in aborted}
+    return {
+        "committed": committed,
+        "aborted": aborted,
+        "losers": losers,
+        "partitions": sorted(partitions),
+        "ddl": sorted(ddl, key=lambda record: record["lsn"]),
+        "records": records,
+        "last_lsn": last_lsn,
+    }
+
+
+def redo_ddl(databases_dir, ddl, committed):
+    """Re-create databases and collections whose creation was committed"""
+    for record in ddl:
+        if record["transaction_id"] not in committed:
+            continue
+        db_path = os.path.join(databases_dir, record["db_name"])
+        if record["operation"] == "create_database":
+            os.makedirs(os.path.join(db_path, "indexes"), exist_ok=True)
+        elif record["operation"] == "create_collection" and os.path.isdir(db_path):
+            if not collection_exists(db_path, record["collection"]):
+                create_collection_file(db_path, record["collection"])
+
+
+def _redo(documents, record):
+    """Apply a committed operation; returns True if the collection changed"""
+    key = PrimaryIndex.key(record["document_id"])
+    operation = record["operation"]
+    if operation == "insert":
+        if documents.get(key) == record["after_state"]:
+            return False
+        documents[key] = record["after_state"]
+        return True
+    if operation == "delete":
+        return documents.pop(key, None) is not None
+    # update
+    doc = documents.get(key)
+    if doc is None:
+        return False
+    before = dict(doc)
+    if record["delta"] is not None:
+        apply_delta(doc, record["delta"])
+    elif record["after_state"] is not None:
+        doc.clear()
+        doc.update(record["after_state"])
+    return doc != before
+
+
+def _undo(documents, record):
+    """Roll back an operation of an in-flight transaction"""
+    key = PrimaryIndex.key(record["document_id"])
+    operation = record["operation"]
+    if operation == "insert":
+        return documents.pop(key, None) is not None
+    if operation == "delete":
+        if key in documents or record["before_state"] is None:
+            return False
+        documents[key] = record["before_state"]
+        return True
+    # update
+    doc = documents.get(key)
+    if doc is None:
+        return False
+    before = dict(doc)
+    if record["delta"] is not None:
+        apply_delta(doc, record["delta"], undo=True)
+    elif record["before_state"] is not None:
+        doc.clear()
+        doc.update(record["before_state"])
+    return doc != before
+
+
+def replay_collection(task):
+    """Redo committed and undo in-flight work for one collection.
+
+    Runs in a worker process; the collection file is loaded once, every
+    record for it is applied in LSN order and the file is rewritten at most
+    once, atomically.
+    """
+    databases_dir, db_name, collection, paths, losers, aborted, start_lsn = task
+    stats = {"db_name": db_name, "collection": collection, "redone": 0, "undone": 0, "written": False}
+    db_path = os.path.join(databases_dir, db_name)
+    if not collection_exists(db_path, collection):
+        return stats
+
+    documents = {}
+    for position, doc in enumerate(read_documents(db_path, collection)):
+        key = PrimaryIndex.key(doc["_id"]) if "_id" in doc else ("__position__", position)
+        documents[key] = doc
+
+    changed = False
+    undo_records = []
+    for path in paths:
+        for record in read_records(path, collection=collection):
+            if record["lsn"] < start_lsn or record["operation"] not in DATA_OPERATIONS:
+                continue
+            transaction_id = record["transaction_id"]
+            if transaction_id in aborted:
+                continue
+            if transaction_id in losers:
+                undo_records.append(record)
+                continue
+            changed = _redo(documents, record) or changed
+            stats["redone"] += 1
+
+    for record in reversed(undo_records):
+        changed = _undo(documents, record) or changed
+        stats["undone"] += 1
+
+    if changed:
+        save_documents(db_path, collection, documents.values())
+        stats["written"] = True
+    return stats
+
+
+def recover(databases_dir, log_paths, start_lsn=0, max_workers=None):
+    """ARIES-style restart: analysis, redo of committed work, undo of losers.
+
+    Collections are independent, so the redo/undo phase runs one task per
+    collection on a process pool. Returns (analysis, stats).
+    """
+    start_time = time.time()
+    analysis = analyze(log_paths, start_lsn)
+    redo_ddl(databases_dir, analysis["ddl"], analysis["committed"])
+
+    losers = set(analysis["losers"])
+    tasks = [
+        (databases_dir, db_name, collection, log_paths.get(db_name, []),
+         losers, analysis["aborted"], start_lsn)
+        for db_name, collection in analysis["partitions"]
+    ]
+    if max_workers is None:
+        max_workers = min(len(tasks), os.cpu_count() or 1)
+    if max_workers > 1:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(replay_collection, tasks))
+    else:
+        results = [replay_collection(task) for task in tasks]
+
+    stats = {
+        "records_analyzed": analysis["records"],
+        "records_redone": sum(result["redone"] for result in results),
+        "records_undone": sum(result["undone"] for result in results),
+        "collections": len(tasks),
+        "collections_written": sum(1 for result in results if result["written"]),
+        "loser_transactions": len(losers),
+        "last_lsn": analysis["last_lsn"],
+        "duration": time.time() - start_time,
+    }
+    return analysis, stats
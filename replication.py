@@ -0,0 +1,659 @@
+"""WAL shipping to read replicas running as separate server processes.
+
+A server started with MANGODB_REPLICATION_PORT is a primary: its
+ReplicationServer accepts followers over TCP and streams them every
+transaction committed since the position they report, read from the
+databases' logs (see log_tail) as soon as they are flushed. A follower
+whose position is no longer in the log, or a new one once the log has
+been truncated, first gets a snapshot of the database.
+
+A server started with MANGODB_REPLICATE_FROM=host:port is a follower: it
+refuses writes from clients, applies what it receives through
+DocumentDB.apply_replicated to its own data directory (logging it to its
+own WAL, so it recovers like any server), and saves its positions in
+replication.json after each applied batch. Reads are served as usual.
+
+Messages are JSON objects, one per line:
+
+    follower -> primary   hello {name, url, positions}, ack {positions}
+    primary -> follower   transaction {db, lsn, restart_lsn, timestamp, records}
+                          snapshot {db, applied_lsn, restart_lsn, collections}
+                          documents {db, collection, documents}
+                          snapshot_end {db, applied_lsn, restart_lsn}
+                          heartbeat {lsn, time}
+
+positions map each database to {"applied_lsn", "restart_lsn"}. The primary
+keeps its logs back to the oldest restart_lsn a connected follower has
+acknowledged. Lag is the age of the oldest transaction committed on the
+primary that the follower has not applied yet; both sides report it.
+
+Finds sent to the primary with read preference "secondary" or
+"secondary_preferred" are forwarded to a follower that advertised a URL
+(MANGODB_ADVERTISE_URL) and is less than `max_lag` seconds behind, so
+they may not see the latest writes.
+"""
+import http.client
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from collections import deque
+from urllib.parse import urlencode, urlsplit
+
+import metrics
+from batch_planner import READ_OPERATIONS
+from collection_file import open_snapshot, read_documents
+from file_sync import fsync_file, replace_file
+from log_tail import LogGap, LogTail
+from query_parser import parse_raw_query
+from wal import list_segments
+
+FOLLOWER_LAG_SECONDS = metrics.gauge(
+    "mangodb_replication_follower_lag_seconds",
+    "Age of the oldest transaction shipped to a follower and not acknowledged", ("follower",)
+)
+ROUTED_READS = metrics.counter("mangodb_replication_routed_reads_total", "Queries forwarded to a follower",
+                               ("follower",))
+REPLICA_LAG_SECONDS = metrics.gauge(
+    "mangodb_replica_lag_seconds", "Age of the oldest transaction received from the primary and not applied yet"
+)
+REPLICA_APPLIED = metrics.observed_counter(
+    "mangodb_replica_transactions_applied_total", "Transactions received from the primary and applied"
+)
+
+READ_PREFERENCES = ("primary", "secondary_preferred", "secondary")
+STATE_FILE = "replication.json"
+
+
+def _send(writer, lock, message):
+    data = json.dumps(message, separators=(",", ":")).encode("utf-8") + b"\n"
+    with lock:
+        writer.write(data)
+        writer.flush()
+
+
+def _receive(reader):
+    line = reader.readline()
+    if not line:
+        raise ConnectionError("connection closed")
+    return json.loads(line)
+
+
+def _time(timestamp):
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(timestamp)) if timestamp else None
+
+
+def _collection_documents(db_path, collection):
+    """Every document of a collection, read from one consistent set of its files"""
+    sources = open_snapshot(db_path, collection)
+    if sources is None:
+        yield from read_documents(db_path, collection)
+        return
+    try:
+        for source in sources:
+            yield from source
+    finally:
+        for source in sources:
+            source.close()
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        _FollowerSession(self.server.replication, self.request, self.client_address).run()
+
+
+class ReplicationServer:
+    """Primary side: streams committed transactions to every connected follower"""
+
+    def __init__(self, database, host="127.0.0.1", port=0, max_lag=10.0, heartbeat_interval=1.0,
+                 snapshot_batch=1000):
+        self.db = database
+        self.host = host
+        self.port = port
+        self.max_lag = max_lag  # seconds; followers further behind get no routed reads
+        self.heartbeat_interval = heartbeat_interval
+        self.snapshot_batch = snapshot_batch  # documents per snapshot message
+        self.sessions = []
+        self.lock = threading.Lock()
+        self.next_session = 0  # round robin position for routed reads
+        self.connections = threading.local()  # keep-alive connections to followers, per thread
+        self.server = None
+        FOLLOWER_LAG_SECONDS.set_function(
+            lambda: {(session.name,): session.lag_seconds() for session in self.followers()}
+        )
+
+    def start(self):
+        """Listen for followers; returns the port"""
+        self.server = _TCPServer((self.host, self.port), _Handler)
+        self.server.replication = self
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, name="replication", daemon=True).start()
+        return self.port
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        for session in self.followers():
+            session.close()
+
+    def followers(self):
+        with self.lock:
+            return list(self.sessions)
+
+    def _register(self, session):
+        with self.lock:
+            self.sessions.append(session)
+
+    def _unregister(self, session):
+        with self.lock:
+            if session in self.sessions:
+                self.sessions.remove(session)
+
+    def status(self):
+        return {
+            "role": "primary",
+            "address": f"{self.host}:{self.port}",
+            "lsn": self.db.transaction_manager.next_lsn - 1,
+            "max_lag_seconds": self.max_lag,
+            "followers": [session.status() for session in self.followers()],
+        }
+
+    def route_read(self, db_name, query, read_preference, profile=False):
+        """Run a read-only query on a follower; None means run it here.
+
+        "secondary" answers with an error when no follower can take the
+        query, "secondary_preferred" falls back to the primary.
+        """
+        if read_preference not in READ_PREFERENCES:
+            return {"error": f"Unknown read preference '{read_preference}', expected one of: "
+                             f"{', '.join(READ_PREFERENCES)}"}
+        if read_preference == "primary" or parse_raw_query(query)[0] not in READ_OPERATIONS:
+            return None
+        for session in self._candidates():
+            try:
+                result = self._forward(session.url, db_name, query, profile)
+            except (OSError, ValueError, http.client.HTTPException) as e:
+                print(f"Error forwarding a read to {session.name}: {str(e)}")
+                continue
+            ROUTED_READS.labels(session.name).inc()
+            if isinstance(result, dict):
+                result["replica"] = session.name
+            return result
+        if read_preference == "secondary":
+            return {"error": f"No replica within {self.max_lag}s of the primary is available"}
+        return None
+
+    def _candidates(self):
+        """Followers that serve reads and are not too far behind, in round robin order"""
+        sessions = [session for session in self.followers()
+                    if session.url and session.lag_seconds() <= self.max_lag]
+        if not sessions:
+            return []
+        with self.lock:
+            start = self.next_session % len(sessions)
+            self.next_session += 1
+        return sessions[start:] + sessions[:start]
+
+    def _forward(self, url, db_name, query, profile):
+        connections = getattr(self.connections, "by_url", None)
+        if connections is None:
+            connections = self.connections.by_url = {}
+        parts = urlsplit(url)
+        body = urlencode({"db_name": db_name, "query": query, "profile": "1" if profile else ""})
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        # A kept-alive connection may have been closed by the follower; reads are safe to retry once
+        for attempt in range(2):
+            connection = connections.get(url)
+            if connection is None:
+                connection = connections[url] = http.client.HTTPConnection(parts.hostname, parts.port, timeout=30)
+            try:
+                connection.request("POST", parts.path.rstrip("/") + "/execute_query", body, headers)
+                response = connection.getresponse()
+                return json.loads(response.read())
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                del connections[url]
+                if attempt:
+                    raise
+
+
+class _FollowerSession:
+    """One connected follower: ships it transactions and tracks what it acknowledged"""
+
+    def __init__(self, replication, sock, address):
+        self.replication = replication
+        self.db = replication.db
+        self.sock = sock
+        self.reader = sock.makefile("rb")
+        self.writer = sock.makefile("wb")
+        self.send_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.address = f"{address[0]}:{address[1]}"
+        self.name = self.address
+        self.url = None
+        self.positions = {}  # db_name -> position acknowledged (or being streamed from)
+        self.shipped = deque()  # (db_name, commit lsn, commit time) not acknowledged yet
+        self.transactions_shipped = 0
+        self.snapshots = 0
+        self.connected_at = time.time()
+        self.closed = False
+
+    def run(self):
+        try:
+            hello = _receive(self.reader)
+            if hello.get("type") != "hello":
+                return
+            self.name = hello.get("name") or self.address
+            self.url = hello.get("url")
+            self.positions = hello.get("positions") or {}
+            self._retain()
+            self.replication._register(self)
+            threading.Thread(target=self._read_acks, name=f"replication-acks {self.name}", daemon=True).start()
+            self._stream()
+        except (OSError, ValueError, ConnectionError) as e:
+            if not self.closed:
+                print(f"Replication to {self.name} stopped: {str(e)}")
+        finally:
+            self.close()
+            self.replication._unregister(self)
+            self.db.transaction_manager.release_log(self)
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _send(self, message):
+        _send(self.writer, self.send_lock, message)
+
+    def _retain(self):
+        """Keep the log from the oldest position this follower may restart from"""
+        with self.lock:
+            lsn = min([position["restart_lsn"] for position in self.positions.values()], default=None)
+        if lsn is not None:
+            self.db.transaction_manager.retain_log(self, lsn)
+
+    def _set_position(self, db_name, position):
+        with self.lock:
+            self.positions[db_name] = position
+        self._retain()
+
+    def _databases(self):
+        """Databases with a log or in the catalog"""
+        log_dir = self.db.transaction_manager.log_dir
+        names = set(self.db.list_databases())
+        names.update(name for name in os.listdir(log_dir) if os.path.isdir(os.path.join(log_dir, name)))
+        return sorted(names)
+
+    def _stream(self):
+        transaction_manager = self.db.transaction_manager
+        tails = {}
+        flushes = 0
+        last_sent = 0
+        while not self.closed:
+            for db_name in self._databases():
+                if db_name not in tails:
+                    tails[db_name] = self._open_tail(db_name)
+            for db_name, tail in tails.items():
+                try:
+                    transactions = tail.poll()
+                except LogGap as e:
+                    print(f"Sending {self.name} a snapshot of {db_name}: {str(e)}")
+                    tails[db_name] = self._snapshot(db_name)
+                    continue
+                for transaction in transactions:
+                    self._ship(db_name, transaction)
+                    last_sent = time.time()
+            if time.time() - last_sent >= self.replication.heartbeat_interval:
+                self._send({"type": "heartbeat", "lsn": transaction_manager.next_lsn - 1, "time": time.time()})
+                last_sent = time.time()
+            flushes = transaction_manager.wait_for_log(flushes, self.replication.heartbeat_interval)
+
+    def _open_tail(self, db_name):
+        log_dir = os.path.join(self.db.transaction_manager.log_dir, db_name)
+        with self.lock:
+            position = self.positions.get(db_name)
+        if position is None:
+            if not list_segments(log_dir) and db_name in self.db.list_databases():
+                # Data from before the log existed
+                return self._snapshot(db_name)
+            position = {"applied_lsn": 0, "restart_lsn": 0}
+            self._set_position(db_name, position)
+        # A log that no longer reaches back to the position raises LogGap on poll()
+        return LogTail(log_dir, position["applied_lsn"], position["restart_lsn"])
+
+    def _snapshot(self, db_name):
+        """Send a copy of a database and return a tail that continues after it.
+
+        The copy is read after the restart point is taken, so it holds at
+        least every transaction that committed before; those that commit
+        later are streamed again, and applying them twice is harmless.
+        """
+        restart_lsn = self.db.transaction_manager.log_restart_lsn()
+        position = {"applied_lsn": restart_lsn - 1, "restart_lsn": restart_lsn}
+        self._set_position(db_name, position)
+        collections = None
+        if db_name in self.db.list_databases():
+            collections = []
+            for name in self.db.list_collections(db_name):
+                stats = self.db.catalog.collection(db_name, name)
+                if stats:
+                    collections.append({
+                        "name": name, "codec": stats["codec"], "compression": stats["compression"],
+                        "partitions": stats["partitions"], "indexes": self.db.list_indexes(db_name, name),
+                    })
+        self._send({"type": "snapshot", "db": db_name, "collections": collections, **position})
+        db_path = os.path.join(self.db.databases_dir, db_name)
+        for collection in collections or []:
+            documents = []
+            for doc in _collection_documents(db_path, collection["name"]):
+                documents.append(doc)
+                if len(documents) >= self.replication.snapshot_batch:
+                    self._send({"type": "documents", "db": db_name, "collection": collection["name"],
+                                "documents": documents})
+                    documents = []
+            if documents:
+                self._send({"type": "documents", "db": db_name, "collection": collection["name"],
+                            "documents": documents})
+        self._send({"type": "snapshot_end", "db": db_name, **position})
+        self.snapshots += 1
+        log_dir = os.path.join(self.db.transaction_manager.log_dir, db_name)
+        return LogTail(log_dir, position["applied_lsn"], position["restart_lsn"])
+
+    def _ship(self, db_name, transaction):
+        with self.lock:
+            self.shipped.append((db_name, transaction["lsn"], transaction["timestamp"]))
+            self.transactions_shipped += 1
+        self._send({"type": "transaction", "db": db_name, **transaction})
+
+    def _read_acks(self):
+        while not self.closed:
+            try:
+                message = _receive(self.reader)
+            except (OSError, ValueError, ConnectionError):
+                break
+            if message.get("type") != "ack":
+                continue
+            with self.lock:
+                self.positions.update(message["positions"])
+                while self.shipped:
+                    db_name, lsn, _ = self.shipped[0]
+                    if lsn > self.positions.get(db_name, {}).get("applied_lsn", 0):
+                        break
+                    self.shipped.popleft()
+            self._retain()
+        self.close()
+
+    def lag_seconds(self):
+        with self.lock:
+            oldest = self.shipped[0][2] if self.shipped else None
+        return max(time.time() - oldest, 0.0) if oldest is not None else 0.0
+
+    def status(self):
+        with self.lock:
+            positions = {db_name: dict(position) for db_name, position in self.positions.items()}
+            unacknowledged = len(self.shipped)
+        return {
+            "name": self.name,
+            "url": self.url,
+            "address": self.address,
+            "connected_since": _time(self.connected_at),
+            "positions": positions,
+            "applied_lsn": max([position["applied_lsn"] for position in positions.values()], default=0),
+            "transactions_shipped": self.transactions_shipped,
+            "unacknowledged": unacknowledged,
+            "snapshots": self.snapshots,
+            "lag_seconds": round(self.lag_seconds(), 3),
+        }
+
+
+class Follower:
+    """Replica side: receives the primary's transactions and applies them in order.
+
+    One thread reads from the primary (reconnecting every `retry_interval`
+    seconds while it is unreachable) and queues what arrives; another
+    applies the queue in batches of up to `batch_size` messages, grouping
+    consecutive transactions of a database into one local write.
+    """
+
+    def __init__(self, database, primary, name=None, url=None, retry_interval=1.0, batch_size=1000):
+        self.db = database
+        self.primary = primary  # "host:port" of the primary's replication server
+        self.name = name or url or f"{socket.gethostname()}:{os.getpid()}"
+        self.url = url  # where this server takes reads, for the primary to route them
+        self.retry_interval = retry_interval
+        self.batch_size = batch_size
+        self.state_path = os.path.join(database.databases_dir, STATE_FILE)
+        self.lock = threading.Lock()
+        self.positions = self._load_positions()
+        self.inbox = queue.Queue()
+        self.backlog = deque()  # (db_name, commit lsn, commit time) received and not applied yet
+        self.connection = None  # (socket, writer, send lock) while connected
+        self.state = "connecting"
+        self.primary_lsn = 0
+        self.applied_transactions = 0
+        self.last_applied_at = None
+        self.connects = 0
+        self.error = None
+        self.snapshot_indexes = {}  # db_name -> [(collection, field)] built when its snapshot ends
+        database.read_only = True
+        REPLICA_LAG_SECONDS.set_function(self.lag_seconds)
+        REPLICA_APPLIED.set_function(lambda: self.applied_transactions)
+
+    def start(self):
+        threading.Thread(target=self._receive_loop, name="replication-receive", daemon=True).start()
+        threading.Thread(target=self._apply_loop, name="replication-apply", daemon=True).start()
+
+    def route_read(self, db_name, query, read_preference, profile=False):
+        """Reads sent to a follower are always served by it"""
+        return None
+
+    def _load_positions(self):
+        try:
+            with open(self.state_path, "r") as f:
+                return json.load(f)["positions"]
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error reading replication positions, starting over: {str(e)}")
+            return {}
+
+    def _save_positions(self):
+        with self.lock:
+            state = {"primary": self.primary, "positions": self.positions}
+            temp_path = self.state_path + ".temp"
+            with open(temp_path, "w") as f:
+                json.dump(state, f)
+                fsync_file(f)
+            replace_file(temp_path, self.state_path)
+
+    # Receiving
+
+    def _receive_loop(self):
+        host, _, port = self.primary.rpartition(":")
+        while True:
+            sock = None
+            try:
+                sock = socket.create_connection((host or "127.0.0.1", int(port)), timeout=10)
+                # Heartbeats arrive every second; a silent primary is presumed gone
+                sock.settimeout(30)
+                reader, writer, send_lock = sock.makefile("rb"), sock.makefile("wb"), threading.Lock()
+                with self.lock:
+                    positions = {db_name: dict(position) for db_name, position in self.positions.items()}
+                    self.connection = (sock, writer, send_lock)
+                    self.state = "streaming"
+                    self.connects += 1
+                _send(writer, send_lock, {"type": "hello", "name": self.name, "url": self.url,
+                                          "positions": positions})
+                while True:
+                    message = _receive(reader)
+                    if message["type"] == "heartbeat":
+                        self.primary_lsn = max(self.primary_lsn, message["lsn"])
+                        continue
+                    if message["type"] == "transaction":
+                        self.primary_lsn = max(self.primary_lsn, message["lsn"])
+                        self.backlog.append((message["db"], message["lsn"], message["timestamp"]))
+                    self.inbox.put(message)
+            except (OSError, ValueError, KeyError, ConnectionError) as e:
+                self.error = f"Connection to {self.primary}: {str(e)}"
+            finally:
+                with self.lock:
+                    self.connection = None
+                    self.state = "connecting"
+                if sock is not None:
+                    sock.close()
+            time.sleep(self.retry_interval)
+
+    def _disconnect(self):
+        with self.lock:
+            connection = self.connection
+        if connection is not None:
+            try:
+                connection[0].shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _ack(self):
+        with self.lock:
+            connection = self.connection
+            positions = {db_name: dict(position) for db_name, position in self.positions.items()}
+        if connection is None:
+            return
+        try:
+            _send(connection[1], connection[2], {"type": "ack", "positions": positions})
+        except OSError:
+            pass  # The receiving thread notices and reconnects
+
+    # Applying
+
+    def _apply_loop(self):
+        while True:
+            messages = [self.inbox.get()]
+            while len(messages) < self.batch_size:
+                try:
+                    messages.append(self.inbox.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._apply(messages)
+                self._save_positions()
+            except Exception as e:
+                self.error = f"Applying replicated changes failed: {str(e)}"
+                print(self.error)
+                # Start over from the saved positions: the primary sends everything after them again
+                with self.lock:
+                    self.positions = self._load_positions()
+                while True:
+                    try:
+                        self.inbox.get_nowait()
+                    except queue.Empty:
+                        break
+                self.backlog.clear()
+                self._disconnect()
+                time.sleep(self.retry_interval)
+                continue
+            self._ack()
+
+    def _apply(self, messages):
+        group_db, group = None, []  # consecutive changes to one database, as lists of records
+
+        def apply_group():
+            if group:
+                self.db.apply_replicated(group_db, group)
+                group.clear()
+
+        for message in messages:
+            db_name, kind = message["db"], message["type"]
+            if kind in ("transaction", "documents"):
+                if db_name != group_db:
+                    apply_group()
+                    group_db = db_name
+            else:
+                apply_group()
+
+            if kind == "transaction":
+                with self.lock:
+                    position = self.positions.get(db_name)
+                    if position and message["lsn"] <= position["applied_lsn"]:
+                        continue  # Sent again after a reconnect
+                    self.positions[db_name] = {"applied_lsn": message["lsn"], "restart_lsn": message["restart_lsn"]}
+                group.append(message["records"])
+            elif kind == "documents":
+                group.append([
+                    {"operation": "insert", "collection": message["collection"], "document_id": doc.get("_id"),
+                     "after_state": doc, "before_state": None, "delta": None}
+                    for doc in message["documents"]
+                ])
+            elif kind == "snapshot":
+                with self.lock:
+                    self.positions.pop(db_name, None)
+                self.state = "snapshot"
+                self.db.load_replicated_snapshot(db_name, message["collections"])
+                self.snapshot_indexes[db_name] = [
+                    (collection["name"], field) for collection in message["collections"] or []
+                    for field in collection["indexes"] if field != "_id"
+                ]
+            elif kind == "snapshot_end":
+                # Indexes are built once, over the loaded documents
+                self.db.apply_replicated(db_name, [[
+                    {"operation": "create_index", "collection": collection, "after_state": {"field": field}}
+                    for collection, field in self.snapshot_indexes.pop(db_name, [])
+                ]])
+                with self.lock:
+                    self.positions[db_name] = {"applied_lsn": message["applied_lsn"],
+                                               "restart_lsn": message["restart_lsn"]}
+                    if self.connection is not None:
+                        self.state = "streaming"
+        apply_group()
+
+        applied = 0
+        with self.lock:
+            while self.backlog:
+                db_name, lsn, _ = self.backlog[0]
+                if lsn > self.positions.get(db_name, {}).get("applied_lsn", 0):
+                    break
+                self.backlog.popleft()
+                applied += 1
+        if applied:
+            self.applied_transactions += applied
+            self.last_applied_at = time.time()
+
+    def lag_seconds(self):
+        try:
+            oldest = self.backlog[0][2]
+        except IndexError:
+            return 0.0
+        return max(time.time() - oldest, 0.0)
+
+    def status(self):
+        with self.lock:
+            positions = {db_name: dict(position) for db_name, position in self.positions.items()}
+            connected = self.connection is not None
+        return {
+            "role": "replica",
+            "name": self.name,
+            "url": self.url,
+            "primary": self.primary,
+            "state": self.state,
+            "connected": connected,
+            "positions": positions,
+            "applied_lsn": max([position["applied_lsn"] for position in positions.values()], default=0),
+            "primary_lsn": self.primary_lsn,
+            "pending_transactions": len(self.backlog),
+            "lag_seconds": round(self.lag_seconds(), 3),
+            "applied_transactions": self.applied_transactions,
+            "last_applied": _time(self.last_applied_at),
+            "connects": self.connects,
+            "error": self.error,
+        }
@@ -0,0 +1,107 @@
+"""Log of statements slower than a threshold, with the slowest query shapes.
+
+A shape is a statement with its values replaced by "?": finds on the same
+fields of a collection share one whatever values they look for. Each slow
+statement is appended to a rotating file as one JSON object per line and
+added to a per-shape aggregate kept in memory (the `max_shapes` with the
+most total time).
+"""
+import json
+import logging
+import threading
+import time
+from logging.handlers import RotatingFileHandler
+
+
+def query_shape(value):
+    """The value with every scalar replaced by "?"; object keys (fields, operators) are kept"""
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in sorted(value.items())}
+    return "?"
+
+
+def statement_shape(operation, collection, params):
+    """e.g. users.find({"age":"?"}) or users.update({"_id":"?"}, {"$set":{"age":"?"}})"""
+    if operation == 'update':
+        arguments = [params['query'], params['update']]
+    elif operation == 'insert_many':
+        arguments = [[query_shape(doc) for doc in params[:1]]] if params else [[]]
+    else:
+        arguments = [params]
+    shaped = ", ".join(json.dumps(query_shape(argument) if isinstance(argument, dict) else argument,
+                                  separators=(",", ":")) for argument in arguments)
+    return f"{collection}.{operation}({shaped})"
+
+
+class SlowQueryLog:
+    def __init__(self, path, threshold_ms=100, max_bytes=10 * 1024 * 1024, backup_count=5, max_shapes=1000):
+        self.path = path
+        self.threshold_ms = threshold_ms  # None turns the log off
+        self.max_shapes = max_shapes
+        self.shapes = {}  # (database, shape) -> aggregate
+        self.logged = 0
+        self.lock = threading.Lock()
+        # A logger of its own per file; the file is created by the first slow statement
+        self.logger = logging.getLogger(f"mangodb.slow_queries.{path}")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        if not self.logger.handlers:
+            handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, delay=True)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self.logger.addHandler(handler)
+
+    def is_slow(self, ms):
+        return self.threshold_ms is not None and ms >= self.threshold_ms
+
+    def record(self, db_name, operation, collection, params, ms, plan=None, details=None):
+        """Log a statement that took `ms` milliseconds, if that is over the threshold"""
+        if not self.is_slow(ms):
+            return
+        shape = statement_shape(operation, collection, params)
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime()),
+            "database": db_name,
+            "collection": collection,
+            "operation": operation,
+            "shape": shape,
+            "ms": round(ms, 3),
+            "plan": plan,
+        }
+        entry.update(details or {})
+        try:
+            self.logger.info(json.dumps(entry, default=str))
+        except Exception as e:
+            print(f"Error writing slow query log: {str(e)}")
+        with self.lock:
+            self.logged += 1
+            aggregate = self.shapes.get((db_name, shape))
+            if aggregate is None:
+                if len(self.shapes) >= self.max_shapes:
+                    del self.shapes[min(self.shapes, key=lambda key: self.shapes[key]["total_ms"])]
+                aggregate = self.shapes[(db_name, shape)] = {
+                    "database": db_name, "collection": collection, "operation": operation, "shape": shape,
+                    "count": 0, "total_ms": 0.0, "max_ms": 0.0, "plan": plan,
+                }
+            aggregate["count"] += 1
+            aggregate["total_ms"] += ms
+            aggregate["max_ms"] = max(aggregate["max_ms"], ms)
+            aggregate["plan"] = plan
+
+    def top(self, limit=10):
+        """The `limit` shapes with the most total time in slow statements"""
+        with self.lock:
+            aggregates = sorted(self.shapes.values(), key=lambda aggregate: aggregate["total_ms"], reverse=True)
+            aggregates = [dict(aggregate) for aggregate in aggregates[:limit]]
+        for aggregate in aggregates:
+            aggregate["mean_ms"] = round(aggregate["total_ms"] / aggregate["count"], 3)
+            aggregate["total_ms"] = round(aggregate["total_ms"], 3)
+            aggregate["max_ms"] = round(aggregate["max_ms"], 3)
+        return aggregates
+
+    def stats(self, limit=10):
+        return {"threshold_ms": self.threshold_ms, "file": self.path, "logged": self.logged, "top": self.top(limit)}
+
+    def close(self):
+        for handler in list(self.logger.handlers):
+            handler.close()
+            self.logger.removeHandler(handler)
@@ -0,0 +1,18 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Importing app opens a module-level DocumentDB; keep it out of the repo's databases/
+os.environ.setdefault("MANGODB_DATABASES_DIR", tempfile.mkdtemp(prefix="mangodb-tests-"))
+
+
+@pytest.fixture
+def db(tmp_path):
+    from app import DocumentDB
+    database = DocumentDB(str(tmp_path / "databases"))
+    yield database
+    database.scan_pool.shutdown()
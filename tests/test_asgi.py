@@ -0,0 +1,65 @@
+import asyncio
+import json
+
+import pytest
+
+from asgi import AsyncServer, serve
+
+
+@pytest.fixture
+def server(db):
+    application = AsyncServer(db)
+    yield application
+    application.close()
+
+
+async def exchange(application, request):
+    """Send raw bytes to the built-in server and return the raw response"""
+    ready = asyncio.get_running_loop().create_future()
+    task = asyncio.create_task(serve(application, port=0, ready=ready.set_result))
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", await ready)
+        writer.write(request)
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(), 10)
+        writer.close()
+        return response
+    finally:
+        task.cancel()
+
+
+def status_and_body(response):
+    head, _, body = response.partition(b"\r\n\r\n")
+    return int(head.split(b" ")[1]), body
+
+
+def test_oversized_head_is_rejected(server):
+    request = b"GET /catalog HTTP/1.1\r\nx-padding: " + b"a" * 70000 + b"\r\n\r\n"
+    status, body = status_and_body(asyncio.run(exchange(server, request)))
+    assert status == 431
+    assert "error" in json.loads(body)
+
+
+def test_oversized_chunk_line_is_rejected(server):
+    request = (b"POST /create_database HTTP/1.1\r\ntransfer-encoding: chunked\r\n"
+               b"content-type: application/json\r\n\r\n" + b"1" * 70000 + b"\r\n")
+    status, _ = status_and_body(asyncio.run(exchange(server, request)))
+    assert status == 400
+
+
+def test_unknown_databases_share_one_limit(server, db):
+    db.create_database("shop")
+
+    async def run_all():
+        for n in range(50):
+            await server.run(server.read_executor, f"missing{n}", len, "")
+        await server.run(server.read_executor, "shop", len, "")
+
+    asyncio.run(run_all())
+    assert set(server.limiter.semaphores) == {"", "shop"}
+    assert set(server.limiter.pending) == {"", "shop"}
+
+    db.delete_database("shop")
+
+    asyncio.run(server.run(server.read_executor, "shop", len, ""))
+    assert set(server.limiter.semaphores) == {""}
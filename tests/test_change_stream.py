@@ -0,0 +1,64 @@
+def insert(db, doc_id):
+    assert "error" not in db.execute_query("shop", f'db.users.insert({{"_id": "{doc_id}"}})')
+
+
+def ids(events):
+    return [event["document_id"] for event in events]
+
+
+def setup_shop(db):
+    db.create_database("shop")
+    db.create_collection("shop", "users")
+
+
+def test_new_stream_returns_only_later_commits(db):
+    setup_shop(db)
+    tm = db.transaction_manager
+    # Running when the stream opens, committed after
+    running = tm.begin_transaction()
+    tm.log_operation(running, "insert", "shop", "users", "running", None, {"_id": "running"})
+    # Committed before the stream opens, after the running transaction started
+    insert(db, "before")
+
+    stream, error = db.open_change_stream("shop")
+    assert error is None
+    try:
+        assert stream.poll() == []
+        tm.commit_transaction(running)
+        insert(db, "after")
+        assert ids(stream.poll()) == ["running", "after"]
+        assert stream.poll() == []
+    finally:
+        stream.close()
+
+
+def test_resume_after_token_returns_each_commit_once(db):
+    setup_shop(db)
+    insert(db, "a")
+    first = db.watch("shop", resume_after=0)
+    assert ids(first["events"]) == ["a"]
+    token = first["resume_token"]
+    assert token == first["events"][-1]["resume_token"]
+
+    insert(db, "b")
+    insert(db, "c")
+    second = db.watch("shop", resume_after=token)
+    assert ids(second["events"]) == ["b", "c"]
+    assert db.watch("shop", resume_after=second["resume_token"])["events"] == []
+    # Resuming from the same token again gives the same events
+    assert ids(db.watch("shop", resume_after=token)["events"]) == ["b", "c"]
+
+
+def test_poll_limit_ends_on_a_transaction_boundary(db):
+    setup_shop(db)
+    token = db.watch("shop")["resume_token"]
+    for doc_id in "abcde":
+        insert(db, doc_id)
+    seen = []
+    while True:
+        result = db.watch("shop", resume_after=token, max_events=2)
+        if not result["events"]:
+            break
+        seen.extend(ids(result["events"]))
+        token = result["resume_token"]
+    assert seen == list("abcde")
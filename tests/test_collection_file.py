@@ -0,0 +1,45 @@
+import os
+
+import pytest
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="needs /proc to name synced files")
+def test_collection_files_are_synced_before_rename(db, monkeypatch):
+    db.create_database("shop")
+    db.create_collection("shop", "users")
+    events = []
+    real_fsync, real_replace = os.fsync, os.replace
+    monkeypatch.setattr(os, "fsync", lambda fd: events.append(("fsync", os.readlink(f"/proc/self/fd/{fd}")))
+                        or real_fsync(fd))
+    monkeypatch.setattr(os, "replace", lambda src, dst: events.append(("replace", str(src))) or real_replace(src, dst))
+    assert "error" not in db.execute_query("shop", 'db.users.insert({"_id": 1})')
+
+    renamed = [position for position, (kind, path) in enumerate(events)
+               if kind == "replace" and path.endswith(".temp") and "users" in path]
+    assert renamed
+    for position in renamed:
+        path = events[position][1]
+        assert ("fsync", os.path.realpath(path)) in events[:position], f"{path} renamed before it was synced"
+        # The directory entry is synced after the rename
+        assert ("fsync", os.path.realpath(os.path.dirname(path))) in events[position:]
+
+
+def test_concurrent_writers_use_their_own_temp_files(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+    from collection_file import create_collection_file, read_documents, save_documents
+
+    db_path = str(tmp_path)
+    create_collection_file(db_path, "users")
+    create_collection_file(db_path, "orders", partitions=3)
+
+    def write(n):
+        for name in ("users", "orders"):
+            save_documents(db_path, name, [{"_id": i, "writer": n} for i in range(50)])
+
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(write, range(32)))
+
+    for name in ("users", "orders"):
+        assert sorted(doc["_id"] for doc in read_documents(db_path, name)) == list(range(50))
+    leftovers = [name for _, _, names in os.walk(db_path) for name in names if name.endswith(".temp")]
+    assert not leftovers
@@ -0,0 +1,40 @@
+import threading
+
+from collection_file import read_documents
+
+
+def test_batches_do_not_overwrite_queued_writes(db):
+    db.create_database("shop")
+    db.create_collection("shop", "users")
+    db.create_collection("shop", "orders")
+    acknowledged = []
+    lock = threading.Lock()
+
+    def single(writer):
+        for n in range(40):
+            doc_id = f"s{writer}-{n}"
+            if "error" not in db.execute_query("shop", f'db.users.insert({{"_id": "{doc_id}"}})'):
+                with lock:
+                    acknowledged.append(doc_id)
+
+    def batch(writer):
+        for n in range(10):
+            ids = [f"b{writer}-{n}-{i}" for i in range(3)]
+            statements = "; ".join(f'db.users.insert({{"_id": "{doc_id}"}})' for doc_id in ids)
+            # A second collection: batches take their locks in the same order
+            statements += f'; db.orders.insert({{"_id": "{ids[0]}"}})'
+            if "error" not in db.execute_batch_query("shop", statements):
+                with lock:
+                    acknowledged.extend(ids)
+
+    threads = [threading.Thread(target=single, args=(n,)) for n in range(6)]
+    threads += [threading.Thread(target=batch, args=(n,)) for n in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(60)
+        assert not thread.is_alive()
+
+    stored = {doc["_id"] for doc in read_documents(db.databases_dir + "/shop", "users")}
+    assert len(acknowledged) > 0
+    assert set(acknowledged) <= stored, f"{len(set(acknowledged) - stored)} acknowledged inserts lost"
@@ -0,0 +1,22 @@
+import metrics
+
+
+def series(name):
+    return [line for line in metrics.render().splitlines() if line.startswith(name + "_count")]
+
+
+def test_unknown_names_share_one_series(db):
+    db.create_database("shop")
+    db.create_collection("shop", "users")
+    db.execute_query("shop", 'db.users.insert({"_id": "a"})')
+    for n in range(5):
+        assert "error" in db.execute_query(f"made-up-{n}", 'db.users.find({})')
+        assert "error" in db.execute_query("shop", f'db.made_up_{n}.find({{}})')
+    db.execute_batch_query("nowhere", 'db.users.find({})')
+
+    labelled = "\n".join(series("mangodb_operation_seconds"))
+    assert "made-up" not in labelled and "made_up" not in labelled and "nowhere" not in labelled
+    assert 'database="shop",collection="users"' in labelled
+    assert 'database="shop",collection="unknown"' in labelled
+    assert 'operation="find",database="unknown",collection="unknown"' in labelled
+    assert 'operation="batch",database="unknown",collection=""' in labelled
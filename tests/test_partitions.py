@@ -0,0 +1,175 @@
+import os
+
+import pytest
+
+import write_set as write_set_module
+from collection_file import (
+    MANIFEST_FILE, collection_exists, collection_files, collection_path, list_collections, open_snapshot,
+    partition_count, partitions_path, read_documents, save_documents
+)
+from write_set import WriteSet
+
+
+def documents(count, **fields):
+    return [dict({"_id": i}, **fields) for i in range(count)]
+
+
+def ids(db_path, name="events"):
+    return sorted(doc["_id"] for doc in read_documents(db_path, name))
+
+
+def leftovers(db_path):
+    """Temp files, unfinished generations and replaced layouts left behind"""
+    found = []
+    for directory, dir_names, file_names in os.walk(db_path):
+        found += [name for name in dir_names + file_names if name.endswith((".temp", ".old"))]
+    parts = partitions_path(db_path, "events")
+    if os.path.isdir(parts):
+        found += [name for name in os.listdir(parts) if name != MANIFEST_FILE and not name.startswith("gen.")]
+        found += [name for name in os.listdir(parts) if name.startswith("gen.")][1:]
+    return found
+
+
+def test_relayout(tmp_path):
+    db_path = str(tmp_path)
+    save_documents(db_path, "events", documents(200))
+    for partitions in (4, 2, 4, 1):
+        save_documents(db_path, "events", documents(200), partitions=partitions)
+        assert partition_count(db_path, "events") == (0 if partitions == 1 else partitions)
+        assert ids(db_path) == list(range(200))
+        assert list_collections(db_path) == ["events"]
+        assert not leftovers(db_path)
+    assert not os.path.exists(partitions_path(db_path, "events"))
+
+
+def test_relayout_through_the_write_queue(db):
+    db.create_database("shop")
+    db.create_collection("shop", "events")
+    db_path = os.path.join(db.databases_dir, "shop")
+    for n in range(50):
+        db.execute_query("shop", f'db.events.insert({{"_id": {n}}})')
+    for partitions in (4, 2, 1, 3):
+        assert db.set_collection_partitions("shop", "events", partitions)[0]
+        assert ids(db_path) == list(range(50))
+        assert db.catalog.collection("shop", "events")["partitions"] == (0 if partitions == 1 else partitions)
+    assert not leftovers(db_path)
+
+
+def test_unchanged_partitions_are_linked(tmp_path):
+    db_path = str(tmp_path)
+    save_documents(db_path, "events", documents(100), partitions=4)
+    before = [os.stat(path).st_ino for path in collection_files(db_path, "events")]
+
+    write_set = WriteSet(db_path)
+    doc = write_set.get("events", 7)
+    doc["seen"] = True
+    write_set.mark_changed("events", [doc])
+    write_set.persist()
+    write_set.discard()
+
+    after = [os.stat(path).st_ino for path in collection_files(db_path, "events")]
+    assert sum(1 for old, new in zip(before, after) if old != new) == 1
+    assert [doc for doc in read_documents(db_path, "events") if doc.get("seen")] == [{"_id": 7, "seen": True}]
+    assert not leftovers(db_path)
+
+
+def test_failed_write_changes_no_partition(tmp_path, monkeypatch):
+    db_path = str(tmp_path)
+    save_documents(db_path, "events", documents(100, v=0), partitions=4)
+    current = collection_files(db_path, "events")
+    real_write = write_set_module.write_collection
+    written = []
+
+    def failing_write(path, records, codec, compression):
+        if written:
+            raise OSError("disk full")
+        written.append(path)
+        real_write(path, records, codec, compression)
+
+    monkeypatch.setattr(write_set_module, "write_collection", failing_write)
+    write_set = WriteSet(db_path)
+    docs = write_set.load("events")
+    for doc in docs:
+        doc["v"] = 1
+    write_set.mark_changed("events", docs)
+    with pytest.raises(OSError):
+        write_set.persist()
+    write_set.discard()
+
+    assert collection_files(db_path, "events") == current
+    assert {doc["v"] for doc in read_documents(db_path, "events")} == {0}
+    assert not leftovers(db_path)
+
+
+def test_readers_keep_their_generation(tmp_path):
+    db_path = str(tmp_path)
+    save_documents(db_path, "events", documents(100, v=0), partitions=4)
+    files = open_snapshot(db_path, "events")
+    save_documents(db_path, "events", documents(100, v=1), partitions=2)
+    try:
+        # The old generation is removed, but mapped files stay readable
+        assert sorted((doc["_id"], doc["v"]) for f in files for doc in f) == [(i, 0) for i in range(100)]
+    finally:
+        for f in files:
+            f.close()
+    assert {doc["v"] for doc in read_documents(db_path, "events")} == {1}
+
+
+def test_flat_layout_is_read_and_replaced(tmp_path):
+    db_path = str(tmp_path)
+    save_documents(db_path, "events", documents(60), partitions=3)
+    # The earlier layout: partition files directly in <collection>.parts
+    parts = partitions_path(db_path, "events")
+    generation = collection_files(db_path, "events")
+    for path in generation:
+        os.replace(path, os.path.join(parts, os.path.basename(path)))
+    os.remove(os.path.join(parts, MANIFEST_FILE))
+    os.rmdir(os.path.dirname(generation[0]))
+    assert partition_count(db_path, "events") == 3
+    assert ids(db_path) == list(range(60))
+
+    save_documents(db_path, "events", documents(61))
+    assert partition_count(db_path, "events") == 3
+    assert ids(db_path) == list(range(61))
+    assert not leftovers(db_path)
+
+
+def test_stale_old_directory_does_not_block_a_merge(tmp_path):
+    db_path = str(tmp_path)
+    save_documents(db_path, "events", documents(40), partitions=2)
+    # Left by a crash during an earlier merge
+    os.makedirs(partitions_path(db_path, "events") + ".old")
+    save_documents(db_path, "events", documents(40), partitions=1)
+    assert os.path.exists(collection_path(db_path, "events"))
+    assert collection_exists(db_path, "events") and ids(db_path) == list(range(40))
+    assert not leftovers(db_path)
+
+
+@pytest.mark.parametrize("partitions", [4, 1])
+def test_interrupted_swap_leaves_one_version(tmp_path, monkeypatch, partitions):
+    db_path = str(tmp_path)
+    real_replace, real_rename = os.replace, os.rename
+    for fail_at in range(1, 5):
+        save_documents(db_path, "events", documents(100, v=0), partitions=4)
+        calls = []
+
+        def interrupted(real):
+            def rename(src, dst):
+                calls.append(dst)
+                if len(calls) == fail_at:
+                    raise OSError("interrupted")
+                return real(src, dst)
+            return rename
+
+        monkeypatch.setattr(os, "replace", interrupted(real_replace))
+        monkeypatch.setattr(os, "rename", interrupted(real_rename))
+        try:
+            save_documents(db_path, "events", documents(100, v=1), partitions=partitions)
+        except OSError:
+            pass
+        finally:
+            monkeypatch.setattr(os, "replace", real_replace)
+            monkeypatch.setattr(os, "rename", real_rename)
+        # Every partition from the same write
+        stored = read_documents(db_path, "events")
+        assert len(stored) == 100 and len({doc["v"] for doc in stored}) == 1
@@ -0,0 +1,86 @@
+import os
+
+import pytest
+
+from collection_file import read_documents, save_documents
+from indexing import PrimaryIndex
+from recovery import recover
+from wal import SegmentedWALWriter, list_segments
+
+
+def test_keys_keep_types_apart():
+    index = PrimaryIndex([1, "1", None, {"a": 1, "b": 2}, [1, "1"]])
+    assert PrimaryIndex.key(1) != PrimaryIndex.key("1")
+    assert (index.get(1), index.get("1")) == (0, 1)
+    # Unhashable ids are keyed by their JSON form, field order ignored
+    assert index.get({"b": 2, "a": 1}) == 3
+    assert index.get([1, "1"]) == 4
+    assert index.get(["1", 1]) is None
+
+    index.remove(1)
+    assert 1 not in index and "1" in index
+    index.add(1, 5)
+    assert (index.get(1), index.get("1")) == (5, 1)
+
+
+def find(db, query):
+    result = db.execute_query("shop", f"db.users.find({query})")
+    assert "error" not in result
+    return result["documents"]
+
+
+@pytest.mark.parametrize("partitions", [1, 4])
+def test_lookups_by_id_after_writes(db, partitions):
+    db.create_database("shop")
+    db.create_collection("shop", "users")
+    if partitions > 1:
+        assert db.set_collection_partitions("shop", "users", partitions)[0]
+    for statement in ('{"_id": 1, "type": "int"}', '{"_id": "1", "type": "str"}', '{"_id": 2}'):
+        assert "error" not in db.execute_query("shop", f"db.users.insert({statement})")
+    assert "error" in db.execute_query("shop", 'db.users.insert({"_id": 1})')
+
+    assert find(db, '{"_id": 1}') == [{"_id": 1, "type": "int"}]
+    assert find(db, '{"_id": "1"}') == [{"_id": "1", "type": "str"}]
+
+    assert db.execute_query("shop", 'db.users.update({"_id": 1}, {"$set": {"seen": true}})') == {
+        "message": "Updated 1 document(s)"
+    }
+    assert find(db, '{"_id": 1}') == [{"_id": 1, "type": "int", "seen": True}]
+    assert find(db, '{"_id": "1"}') == [{"_id": "1", "type": "str"}]
+
+    result = db.execute_batch_query("shop", 'db.users.delete({"_id": "1"}); db.users.find({"_id": "1"}); '
+                                            'db.users.find({"_id": 1})')
+    assert result["results"][1:] == [
+        {"documents": []}, {"documents": [{"_id": 1, "type": "int", "seen": True}]}
+    ]
+    assert find(db, '{"_id": "1"}') == []
+    assert find(db, '{"_id": 1}') == [{"_id": 1, "type": "int", "seen": True}]
+
+    # A deleted _id can be inserted again in the same batch
+    result = db.execute_batch_query("shop", 'db.users.delete({"_id": 2}); db.users.insert({"_id": 2, "again": 1}); '
+                                            'db.users.find({"_id": 2})')
+    assert result["results"][-1] == {"documents": [{"_id": 2, "again": 1}]}
+    assert find(db, '{"_id": 2}') == [{"_id": 2, "again": 1}]
+
+
+def test_replay_keys_match_live_keys(tmp_path):
+    databases_dir = str(tmp_path / "databases")
+    os.makedirs(os.path.join(databases_dir, "shop"))
+    db_path = os.path.join(databases_dir, "shop")
+    save_documents(db_path, "users", [{"_id": 1}, {"_id": "1"}, {"_id": {"a": 1, "b": 2}}])
+    writer = SegmentedWALWriter(str(tmp_path / "logs"))
+    records = [
+        ("delete", 1, {"_id": 1}, None),
+        ("update", "1", {"_id": "1"}, {"_id": "1", "kept": True}),
+        ("update", {"b": 2, "a": 1}, {"_id": {"a": 1, "b": 2}}, {"_id": {"a": 1, "b": 2}, "x": 1}),
+        ("commit", None, None, None),
+    ]
+    for lsn, (operation, doc_id, before, after) in enumerate(records, 1):
+        writer.append(lsn, 0.0, 1, "serializable", operation, "shop",
+                      "users" if doc_id is not None else None, doc_id, before, after)
+    writer.close()
+
+    recover(databases_dir, {"shop": [path for _, path in list_segments(str(tmp_path / "logs"))]}, max_workers=1)
+    assert sorted(read_documents(db_path, "users"), key=lambda doc: str(doc["_id"])) == [
+        {"_id": "1", "kept": True}, {"_id": {"a": 1, "b": 2}, "x": 1}
+    ]
@@ -0,0 +1,62 @@
+import pytest
+
+from query_cache import QueryCache
+
+FIND_ALL = 'db.users.find({"team": "a"})'
+
+
+def find(db):
+    result = db.execute_query("shop", FIND_ALL)
+    assert "error" not in result
+    return sorted(result["documents"], key=lambda doc: doc["_id"])
+
+
+@pytest.fixture
+def shop(db):
+    db.create_database("shop")
+    db.create_collection("shop", "users")
+    db.execute_query("shop", 'db.users.insert({"_id": 1, "team": "a"})')
+    return db
+
+
+@pytest.mark.parametrize("method, write, expected", [
+    ("execute_query", 'db.users.insert({"_id": 2, "team": "a"})',
+     [{"_id": 1, "team": "a"}, {"_id": 2, "team": "a"}]),
+    ("execute_query", 'db.users.update({"_id": 1}, {"$set": {"name": "Ann"}})',
+     [{"_id": 1, "team": "a", "name": "Ann"}]),
+    # Deletes run in batches only
+    ("execute_batch_query", 'db.users.delete({"_id": 1})', []),
+])
+def test_writes_invalidate_cached_finds(shop, method, write, expected):
+    cache = shop.query_cache
+    assert find(shop) == [{"_id": 1, "team": "a"}]
+    assert find(shop) == [{"_id": 1, "team": "a"}]
+    assert cache.stats()["hits"] == 1
+    version = cache.version("shop", "users")
+
+    assert "error" not in getattr(shop, method)("shop", write)
+    assert cache.version("shop", "users") != version
+    hits = cache.stats()["hits"]
+    assert find(shop) == expected
+    assert cache.stats()["hits"] == hits
+
+
+def test_cached_results_are_copies(shop):
+    first = shop.execute_query("shop", FIND_ALL)["documents"]
+    first[0]["team"] = "changed"
+    first.append({"_id": 99})
+    second = shop.execute_query("shop", FIND_ALL)["documents"]
+    assert shop.query_cache.stats()["hits"] == 1
+    assert second == [{"_id": 1, "team": "a"}]
+    second[0]["team"] = "changed again"
+    assert shop.execute_query("shop", FIND_ALL)["documents"] == [{"_id": 1, "team": "a"}]
+
+
+def test_entries_of_an_older_version_are_not_stored():
+    cache = QueryCache()
+    key = QueryCache.query_key("find", {"team": "a"})
+    stale = cache.version("shop", "users")
+    cache.bump("shop", "users")
+    cache.put("shop", "users", stale, key, [{"_id": 1}])
+    assert cache.get("shop", "users", stale, key) is None
+    assert cache.stats()["entries"] == 0
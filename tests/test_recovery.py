@@ -0,0 +1,95 @@
+import os
+
+from collection_file import create_collection_file, read_documents, save_documents
+from recovery import recover
+from wal import SegmentedWALWriter, list_segments
+
+COMMITTED, LOSER, ABORTED = 1, 2, 3
+
+
+def write_log(log_dir):
+    writer = SegmentedWALWriter(log_dir)
+    lsn = iter(range(1, 100))
+
+    def append(transaction_id, operation, doc_id=None, before=None, after=None):
+        writer.append(next(lsn), 0.0, transaction_id, "serializable", operation, "shop",
+                      "users" if doc_id is not None else None, doc_id, before, after)
+
+    append(COMMITTED, "insert", 1, None, {"_id": 1, "name": "Ann", "age": 30})
+    append(COMMITTED, "insert", 2, None, {"_id": 2, "name": "Bob"})
+    append(LOSER, "update", 2, {"_id": 2, "name": "Bob"}, {"_id": 2, "name": "Rob"})
+    append(COMMITTED, "update", 1, {"_id": 1, "name": "Ann", "age": 30}, {"_id": 1, "name": "Ann", "age": 31})
+    append(ABORTED, "insert", 4, None, {"_id": 4})
+    append(LOSER, "insert", 3, None, {"_id": 3})
+    append(LOSER, "delete", 1, {"_id": 1, "name": "Ann", "age": 31}, None)
+    append(COMMITTED, "commit")
+    append(ABORTED, "abort")
+    writer.close()
+    return {"shop": [path for _, path in list_segments(log_dir)]}
+
+
+def documents(databases_dir):
+    return sorted(read_documents(os.path.join(databases_dir, "shop"), "users"), key=lambda doc: doc["_id"])
+
+
+EXPECTED = [{"_id": 1, "name": "Ann", "age": 31}, {"_id": 2, "name": "Bob"}]
+
+
+def test_redo_and_undo(tmp_path):
+    databases_dir = str(tmp_path / "databases")
+    os.makedirs(os.path.join(databases_dir, "shop"))
+    create_collection_file(os.path.join(databases_dir, "shop"), "users")
+    log_paths = write_log(str(tmp_path / "logs"))
+
+    analysis, stats = recover(databases_dir, log_paths, max_workers=1)
+    assert analysis["committed"] == {COMMITTED}
+    assert set(analysis["losers"]) == {LOSER}
+    assert documents(databases_dir) == EXPECTED
+    assert stats["collections_written"] == 1
+
+
+def test_undo_of_flushed_loser_changes(tmp_path):
+    # The loser's changes reached the collection file before the crash
+    databases_dir = str(tmp_path / "databases")
+    db_path = os.path.join(databases_dir, "shop")
+    os.makedirs(db_path)
+    save_documents(db_path, "users", [{"_id": 1, "name": "Ann", "age": 30}, {"_id": 2, "name": "Rob"}, {"_id": 3}])
+    log_paths = write_log(str(tmp_path / "logs"))
+
+    recover(databases_dir, log_paths, max_workers=1)
+    assert documents(databases_dir) == EXPECTED
+
+
+def test_recovery_is_idempotent(tmp_path):
+    databases_dir = str(tmp_path / "databases")
+    os.makedirs(os.path.join(databases_dir, "shop"))
+    create_collection_file(os.path.join(databases_dir, "shop"), "users")
+    log_paths = write_log(str(tmp_path / "logs"))
+
+    # A crash during or after recovery replays the same log again
+    for _ in range(3):
+        _, stats = recover(databases_dir, log_paths, max_workers=1)
+        assert documents(databases_dir) == EXPECTED
+        assert (stats["records_redone"], stats["records_undone"]) == (3, 3)
+
+
+def test_int_and_str_ids_are_distinct(tmp_path):
+    databases_dir = str(tmp_path / "databases")
+    db_path = os.path.join(databases_dir, "shop")
+    os.makedirs(db_path)
+    save_documents(db_path, "users", [{"_id": 1, "name": "int"}, {"_id": 2}])
+    writer = SegmentedWALWriter(str(tmp_path / "logs"))
+    records = [
+        ("insert", "1", None, {"_id": "1", "name": "str"}),
+        ("update", 1, {"_id": 1, "name": "int"}, {"_id": 1, "name": "int", "age": 5}),
+        ("delete", "2", {"_id": "2"}, None),  # no such document: _id 2 stays
+        ("commit", None, None, None),
+    ]
+    for lsn, (operation, doc_id, before, after) in enumerate(records, 1):
+        writer.append(lsn, 0.0, COMMITTED, "serializable", operation, "shop",
+                      "users" if doc_id is not None else None, doc_id, before, after)
+    writer.close()
+
+    recover(databases_dir, {"shop": [path for _, path in list_segments(str(tmp_path / "logs"))]}, max_workers=1)
+    stored = sorted(read_documents(db_path, "users"), key=lambda doc: (type(doc["_id"]).__name__, doc["_id"]))
+    assert stored == [{"_id": 1, "name": "int", "age": 5}, {"_id": 2}, {"_id": "1", "name": "str"}]
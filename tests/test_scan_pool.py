@@ -0,0 +1,27 @@
+from batch_planner import ScanPool, scan_context
+from collection_file import save_documents
+from write_set import WriteSet
+
+
+def test_scan_workers_are_not_forked():
+    assert scan_context().get_start_method() in ("forkserver", "spawn")
+
+
+def test_process_scans_match_thread_scans(tmp_path):
+    db_path = str(tmp_path)
+    documents = [{"_id": i, "kind": ["a", "b", "c"][i % 3]} for i in range(3000)]
+    save_documents(db_path, "events", documents, partitions=2)
+    threads = ScanPool(max_workers=2)
+    processes = ScanPool(max_workers=2, threshold=1000)
+    processes.start()
+    try:
+        results = []
+        for pool in (threads, processes):
+            write_set = WriteSet(db_path)
+            results.append(sorted(doc["_id"] for doc in write_set.match("events", {"kind": "b"}, pool)))
+            write_set.discard()
+        assert results[0] == results[1] == list(range(1, 3000, 3))
+        # Only a pool with a threshold has worker processes
+        assert threads.executor is None and processes.executor is not None
+    finally:
+        processes.shutdown()
@@ -0,0 +1,135 @@
+import os
+
+from wal import SegmentedWALWriter, WALError, list_segments, read_records, read_segment_header
+
+
+def append(writer, lsn, transaction_id, operation, doc_id=None, before=None, after=None, collection="users"):
+    return writer.append(lsn, 1000.0 + lsn, transaction_id, "serializable", operation, "shop",
+                         collection if doc_id is not None else None, doc_id, before, after)
+
+
+def records_of(directory):
+    return [record for _, path in list_segments(directory) for record in read_records(path)]
+
+
+def test_records_round_trip(tmp_path):
+    writer = SegmentedWALWriter(str(tmp_path))
+    append(writer, 1, 7, "insert", 1, None, {"_id": 1, "name": "Ann", "age": 30})
+    append(writer, 2, 7, "update", 1, {"_id": 1, "name": "Ann", "age": 30}, {"_id": 1, "name": "Ann", "age": 31})
+    append(writer, 3, 7, "delete", "b", {"_id": "b"}, None)
+    append(writer, 4, 7, "commit")
+    writer.close()
+
+    records = records_of(str(tmp_path))
+    assert [record["lsn"] for record in records] == [1, 2, 3, 4]
+    assert [record["operation"] for record in records] == ["insert", "update", "delete", "commit"]
+    insert, update, delete, commit = records
+    assert insert["after_state"] == {"_id": 1, "name": "Ann", "age": 30}
+    assert (insert["db_name"], insert["collection"], insert["document_id"]) == ("shop", "users", 1)
+    assert insert["isolation_level"] == "serializable" and insert["timestamp"] == 1001.0
+    # Updates carry a field level delta and its undo image
+    assert update["delta"] == {"set": {"age": 31}, "unset": [], "undo_set": {"age": 30}, "undo_unset": []}
+    assert delete["before_state"] == {"_id": "b"} and delete["document_id"] == "b"
+    assert commit["transaction_id"] == 7 and commit["collection"] is None
+
+
+def test_corrupt_record_ends_the_log(tmp_path):
+    writer = SegmentedWALWriter(str(tmp_path))
+    for lsn in range(1, 4):
+        append(writer, lsn, 1, "insert", lsn, None, {"_id": lsn, "payload": "x" * 20})
+    writer.close()
+    path = list_segments(str(tmp_path))[0][1]
+    with open(path, "rb") as f:
+        data = bytearray(f.read())
+    # Flip a byte of the second record's document
+    position = data.index(b'"_id":2')
+    data[position + 1] ^= 0xFF
+    with open(path, "wb") as f:
+        f.write(data)
+
+    assert [record["lsn"] for record in read_records(path)] == [1]
+
+
+def test_torn_tail_is_ignored(tmp_path):
+    writer = SegmentedWALWriter(str(tmp_path))
+    append(writer, 1, 1, "insert", 1, None, {"_id": 1})
+    writer.flush()
+    size = writer.offset
+    append(writer, 2, 1, "insert", 2, None, {"_id": 2, "payload": "y" * 100})
+    writer.close()
+    path = list_segments(str(tmp_path))[0][1]
+    with open(path, "r+b") as f:
+        f.truncate(size + 10)
+
+    assert [record["lsn"] for record in read_records(path)] == [1]
+    # A writer reopening the log appends after the last intact record
+    writer = SegmentedWALWriter(str(tmp_path))
+    append(writer, 2, 1, "commit")
+    writer.close()
+    assert [record["lsn"] for record in read_records(path)] == [1, 2]
+
+
+def test_segments_roll_and_truncate(tmp_path):
+    writer = SegmentedWALWriter(str(tmp_path), segment_size=512, max_spares=1)
+    for lsn in range(1, 41):
+        append(writer, lsn, lsn, "insert", lsn, None, {"_id": lsn, "payload": "z" * 40})
+    writer.sync()
+    segments = list_segments(str(tmp_path))
+    assert len(segments) > 3
+    assert [record["lsn"] for record in records_of(str(tmp_path))] == list(range(1, 41))
+    bases = [read_segment_header(path)["base_lsn"] for _, path in segments]
+    assert bases == sorted(bases) and bases[0] == 1
+
+    # Only whole segments below the LSN are dropped; one is kept as a spare
+    writer.truncate(bases[2])
+    remaining = list_segments(str(tmp_path))
+    assert [seq for seq, _ in remaining] == [seq for seq, _ in segments[2:]]
+    assert records_of(str(tmp_path))[0]["lsn"] == bases[2]
+    assert len([name for name in os.listdir(tmp_path) if name.startswith("spare_")]) == 1
+    writer.close()
+
+
+def test_unknown_operation_is_rejected(tmp_path):
+    writer = SegmentedWALWriter(str(tmp_path))
+    try:
+        append(writer, 1, 1, "upsert", 1, None, {"_id": 1})
+    except WALError:
+        pass
+    else:
+        raise AssertionError("an unknown operation was logged")
+    writer.close()
+
+
+def test_commits_are_fsynced(db, monkeypatch):
+    synced = []
+    real_fsync = os.fsync
+    monkeypatch.setattr(os, "fsync", lambda fd: synced.append(fd) or real_fsync(fd))
+    db.create_database("shop")
+    db.create_collection("shop", "users")
+    synced.clear()
+    assert "error" not in db.execute_query("shop", 'db.users.insert({"_id": 1})')
+    assert synced, "the commit was not forced to disk"
+
+    db.transaction_manager.sync_log = False
+    synced.clear()
+    db.transaction_manager.flush_log("shop")
+    assert not synced
+
+
+def test_batch_flushes_its_log_once(db):
+    db.create_database("shop")
+    db.create_collection("shop", "users")
+    tm = db.transaction_manager
+    flushes = tm.log_flushes
+    documents = ", ".join(f'{{"_id": {n}}}' for n in range(20))
+    statements = f"db.users.insertMany([{documents}]); db.users.update({{}}, {{\"$set\": {{\"a\": 1}}}}); " \
+                 "db.users.delete({\"_id\": 3})"
+    assert "error" not in db.execute_batch_query("shop", statements)
+    # Records before the collection file changes, then the commit record
+    assert tm.log_flushes - flushes == 2
+
+    logged = [record for _, path in list_segments(os.path.join(tm.log_dir, "shop"))
+              for record in read_records(path, collection="users")]
+    assert [record["operation"] for record in logged].count("insert") == 20
+    assert [record["operation"] for record in logged].count("update") == 20
+    assert [record["operation"] for record in logged].count("delete") == 1
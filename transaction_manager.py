@@ -1,12 +1,38 @@
 import time
-import uuid
 import json
 import os
 from enum import Enum
 from threading import Lock, Timer
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, deque
 import threading
+from file_sync import fsync_file, replace_file, temp_path
+from wal import SegmentedWALWriter, WAL_EXTENSION, list_segments, scan_segment
+from recovery import recover
+import metrics
+from profiling import traced
+
+LOCK_REQUESTS = metrics.observed_counter(
+    "mangodb_lock_requests_total", "Document lock requests by lock type and outcome "
+    "(granted, upgraded, held, waiting: queued behind a conflicting lock, deadlock)", ("lock_type", "outcome")
+)
+LOCK_WAITERS = metrics.gauge("mangodb_lock_waiters", "Lock requests queued behind a conflicting lock")
+WAL_APPEND_SECONDS = metrics.histogram(
+    "mangodb_wal_append_seconds", "Time to encode and buffer one log record", buckets=metrics.FINE_BUCKETS
+)
+WAL_FLUSH_SECONDS = metrics.histogram(
+    "mangodb_wal_flush_seconds", "Time to hand buffered log records to the OS", buckets=metrics.FINE_BUCKETS
+)
+WAL_BYTES = metrics.observed_counter("mangodb_wal_bytes_written_total", "Bytes appended to transaction logs")
+TRANSACTIONS = metrics.counter("mangodb_transactions_total", "Finished transactions by outcome", ("outcome",))
+ACTIVE_TRANSACTIONS = metrics.gauge("mangodb_transactions_active", "Transactions begun and not finished")
+LOCK_OUTCOMES = {
+    "Lock acquired": "granted",
+    "Lock upgraded": "upgraded",
+    "Lock already held": "held",
+    "Lock acquisition failed - waiting": "waiting",
+    "Deadlock detected": "deadlock",
+}
 
 class LockType(Enum):
     READ = "read"
@@ -31,6 +57,8 @@ class LockManager:
         self.lock_timeout = lock_timeout
         self.wait_for_graph = defaultdict(set)  # For deadlock detection
         self.lock_waiters = defaultdict(list)  # Track waiting transactions
+        self.waiting_on = defaultdict(set)  # transaction_id -> keys it is queued on
+        self.request_counts = defaultdict(int)  # (lock type, result message) -> requests
 
     def detect_deadlock(self, transaction_id):
         """Detect deadlocks using wait-for graph"""
@@ -46,7 +74,7 @@ class LockManager:
             visited.add(node)
             path.add(node)
             
-            for neighbor in self.wait_for_graph[node]:
+            for neighbor in self.wait_for_graph.get(node, ()):
                 if dfs(neighbor):
                     return True
             
@@ -57,53 +85,76 @@ class LockManager:
 
     def acquire_lock(self, db_name, collection, doc_id, lock_type, transaction_id, isolation_level):
         with self.lock_manager_lock:
-            # Initialize nested structure if not exists
-            if db_name not in self.locks:
-                self.locks[db_name] = {}
-            if collection not in self.locks[db_name]:
-                self.locks[db_name][collection] = {}
-            if doc_id not in self.locks[db_name][collection]:
-                self.locks[db_name][collection][doc_id] = None
-
-            current_lock = self.locks[db_name][collection][doc_id]
-            
-            # Check if lock can be acquired
-            if current_lock is None:
-                # No existing lock, can acquire
+            success, message = self._acquire_lock(db_name, collection, doc_id, lock_type, transaction_id,
+                                                  isolation_level)
+            self.request_counts[(lock_type.value, message)] += 1
+            return success, message
+
+    def request_outcomes(self):
+        """{(lock type, outcome): requests} since the lock manager was created"""
+        with self.lock_manager_lock:
+            counts = list(self.request_counts.items())
+        outcomes = defaultdict(int)
+        for (lock_type, message), count in counts:
+            outcomes[(lock_type, LOCK_OUTCOMES.get(message, "other"))] += count
+        return dict(outcomes)
+
+    def waiting_count(self):
+        with self.lock_manager_lock:
+            return sum(len(waiters) for waiters in self.lock_waiters.values())
+
+    def _acquire_lock(self, db_name, collection, doc_id, lock_type, transaction_id, isolation_level):
+        """acquire_lock() with lock_manager_lock held"""
+        # Initialize nested structure if not exists
+        if db_name not in self.locks:
+            self.locks[db_name] = {}
+        if collection not in self.locks[db_name]:
+            self.locks[db_name][collection] = {}
+        if doc_id not in self.locks[db_name][collection]:
+            self.locks[db_name][collection][doc_id] = None
+
+        current_lock = self.locks[db_name][collection][doc_id]
+        
+        # Check if lock can be acquired
+        if current_lock is None:
+            # No existing lock, can acquire
+            self.locks[db_name][collection][doc_id] = {
+                "lock_type": lock_type.value,  # Store enum value
+                "transaction_id": transaction_id,
+                "timestamp": time.time(),
+                "isolation_level": isolation_level.value  # Store enum value
+            }
+            return True, "Lock acquired"
+        
+        # If same transaction, can upgrade lock
+        if current_lock["transaction_id"] == transaction_id:
+            if (lock_type == LockType.WRITE or 
+                (lock_type == LockType.READ and LockType(current_lock["lock_type"]) == LockType.READ)):
                 self.locks[db_name][collection][doc_id] = {
                     "lock_type": lock_type.value,  # Store enum value
                     "transaction_id": transaction_id,
                     "timestamp": time.time(),
                     "isolation_level": isolation_level.value  # Store enum value
                 }
-                return True, "Lock acquired"
-            
-            # If same transaction, can upgrade lock
-            if current_lock["transaction_id"] == transaction_id:
-                if (lock_type == LockType.WRITE or 
-                    (lock_type == LockType.READ and LockType(current_lock["lock_type"]) == LockType.READ)):
-                    self.locks[db_name][collection][doc_id] = {
-                        "lock_type": lock_type.value,  # Store enum value
-                        "transaction_id": transaction_id,
-                        "timestamp": time.time(),
-                        "isolation_level": isolation_level.value  # Store enum value
-                    }
-                    return True, "Lock upgraded"
-            
-            # Check for deadlock
-            self.wait_for_graph[transaction_id].add(current_lock["transaction_id"])
-            if self.detect_deadlock(transaction_id):
-                self.wait_for_graph[transaction_id].remove(current_lock["transaction_id"])
-                return False, "Deadlock detected"
-            
-            # Add to waiters
-            self.lock_waiters[(db_name, collection, doc_id)].append({
-                "transaction_id": transaction_id,
-                "lock_type": lock_type.value,  # Store enum value
-                "timestamp": time.time()
-            })
-            
-            return False, "Lock acquisition failed - waiting"
+                return True, "Lock upgraded"
+            # A write lock already covers reads by the same transaction
+            return True, "Lock already held"
+
+        # Check for deadlock
+        self.wait_for_graph[transaction_id].add(current_lock["transaction_id"])
+        if self.detect_deadlock(transaction_id):
+            self.wait_for_graph[transaction_id].remove(current_lock["transaction_id"])
+            return False, "Deadlock detected"
+        
+        # Add to waiters
+        self.waiting_on[transaction_id].add((db_name, collection, doc_id))
+        self.lock_waiters[(db_name, collection, doc_id)].append({
+            "transaction_id": transaction_id,
+            "lock_type": lock_type.value,  # Store enum value
+            "timestamp": time.time()
+        })
+        
+        return False, "Lock acquisition failed - waiting"
 
     def release_lock(self, db_name, collection, doc_id, transaction_id):
         with self.lock_manager_lock:
@@ -135,80 +186,230 @@ class LockManager:
                     return True
             return False
 
-    def release_transaction_locks(self, transaction_id):
+    def release_transaction_locks(self, transaction_id, lock_keys=None):
+        """Release a transaction's locks; lock_keys avoids scanning the whole lock table"""
         with self.lock_manager_lock:
-            for db_name in self.locks:
-                for collection in self.locks[db_name]:
-                    for doc_id in list(self.locks[db_name][collection].keys()):
-                        if (self.locks[db_name][collection][doc_id] and 
-                            self.locks[db_name][collection][doc_id]["transaction_id"] == transaction_id):
-                            self.locks[db_name][collection][doc_id] = None
+            if lock_keys is None:
+                lock_keys = [
+                    (db_name, collection, doc_id)
+                    for db_name in self.locks
+                    for collection in self.locks[db_name]
+                    for doc_id in self.locks[db_name][collection]
+                ]
+            for db_name, collection, doc_id in lock_keys:
+                collection_locks = self.locks.get(db_name, {}).get(collection)
+                if collection_locks is None:
+                    continue
+                current_lock = collection_locks.get(doc_id)
+                if current_lock is None or current_lock["transaction_id"] == transaction_id:
+                    # Drop the entry so the lock table only holds live locks
+                    collection_locks.pop(doc_id, None)
+                    if not collection_locks:
+                        del self.locks[db_name][collection]
+
+            # Forget the requests this transaction was queued for
+            for key in self.waiting_on.pop(transaction_id, ()):
+                waiters = [w for w in self.lock_waiters.get(key, ()) if w["transaction_id"] != transaction_id]
+                if waiters:
+                    self.lock_waiters[key] = waiters
+                else:
+                    self.lock_waiters.pop(key, None)
             
             # Clean up wait-for graph
             if transaction_id in self.wait_for_graph:
                 del self.wait_for_graph[transaction_id]
-            for node in self.wait_for_graph:
-                if transaction_id in self.wait_for_graph[node]:
-                    self.wait_for_graph[node].remove(transaction_id)
+            for node in list(self.wait_for_graph):
+                self.wait_for_graph[node].discard(transaction_id)
+                if not self.wait_for_graph[node]:
+                    del self.wait_for_graph[node]
+
+class Transaction:
+    """Bookkeeping for one transaction; __slots__ keeps each record small"""
+    __slots__ = ("transaction_id", "state", "start_time", "end_time", "isolation_level",
+                 "locks", "logged_dbs", "first_lsn", "dirty_pages")
+
+    def __init__(self, transaction_id, isolation_level):
+        self.transaction_id = transaction_id
+        self.state = TransactionState.ACTIVE.value
+        self.start_time = time.time()
+        self.end_time = None
+        self.isolation_level = isolation_level
+        self.locks = set()  # (db_name, collection, doc_id)
+        self.logged_dbs = set()  # Databases whose log needs the commit/abort record
+        self.first_lsn = None
+        self.dirty_pages = set()  # Collection pages this transaction has changed
+
+    def to_dict(self):
+        return {
+            "transaction_id": self.transaction_id,
+            "state": self.state,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "isolation_level": self.isolation_level,
+            "first_lsn": self.first_lsn,
+            "locks": list(self.locks),  # Convert set to list for JSON serialization
+            "logged_dbs": list(self.logged_dbs)
+        }
 
 class TransactionManager:
-    def __init__(self, base_dir, isolation_level=IsolationLevel.READ_COMMITTED):
+    # Transaction ids are integers that must stay unique across restarts since
+    # the logs refer to them; they are reserved on disk in blocks of this size
+    TRANSACTION_ID_BLOCK = 1 << 16
+
+    def __init__(self, base_dir, isolation_level=IsolationLevel.READ_COMMITTED, finished_history=1024):
         self.base_dir = base_dir
         self.lock_manager = LockManager()
-        self.transactions = {}  # transaction_id -> transaction_info
+        self.transactions = {}  # transaction_id -> Transaction, active transactions only
+        # Recently finished transactions, kept for diagnostics only
+        self.finished_transactions = deque(maxlen=finished_history)
         self.transaction_lock = Lock()
         self.log_dir = os.path.join(base_dir, "transaction_logs")
         self.checkpoint_dir = os.path.join(base_dir, "checkpoints")
         self.default_isolation_level = isolation_level
         self.last_checkpoint_time = time.time()
         self.checkpoint_interval = 60  # 60 seconds
+        self.checkpoint_log_bytes = 64 * 1024 * 1024  # Also checkpoint after this much log
+        self.checkpoint_event = threading.Event()
+        self.log_lock = Lock()
+        self.log_writers = {}  # db_name -> SegmentedWALWriter
+        # fsync the log at every flush point (a commit or a write group); with
+        # False a commit survives a process crash but not an OS crash
+        self.sync_log = True
+        self.log_bytes_since_checkpoint = 0
+        self.log_bytes_written = 0
+        # Notified whenever log records reach the OS, for readers tailing the logs
+        self.log_flushed = threading.Condition(self.log_lock)
+        self.log_flushes = 0
+        # Readers of the logs (e.g. replication followers) -> LSN they still need records from
+        self.log_retention = {}
+        # Dirty page table: (db_name, kind, name) -> {owner: rec_lsn}. Collection
+        # pages are owned by the transaction that changed them and are forced
+        # to disk before it commits; index pages (owner None) are written back
+        # by the checkpointer.
+        self.dirty_pages = {}
+        self.dirty_lock = Lock()
+        self.flushers = {}  # kind -> flush(db_name, name)
+        self.recovery_stats = None
         os.makedirs(self.log_dir, exist_ok=True)
         os.makedirs(self.checkpoint_dir, exist_ok=True)
+        self._migrate_flat_logs()
+        self.next_lsn = self._find_last_lsn() + 1
+        self.transaction_id_file = os.path.join(self.log_dir, "transaction_id")
+        self.next_transaction_id = self._read_transaction_id_reservation()
+        self.transaction_id_limit = self.next_transaction_id
+
+        ACTIVE_TRANSACTIONS.set_function(lambda: len(self.transactions))
+        LOCK_WAITERS.set_function(self.lock_manager.waiting_count)
+        LOCK_REQUESTS.set_function(self.lock_manager.request_outcomes)
+        WAL_BYTES.set_function(lambda: self.log_bytes_written)
+
         # Start periodic checkpoint thread
         self.checkpoint_thread = threading.Thread(target=self._periodic_checkpoint, daemon=True)
         self.checkpoint_thread.start()
 
     def _periodic_checkpoint(self):
-        """Create checkpoints periodically"""
+        """Checkpoint every checkpoint_interval seconds, or earlier when enough log was written"""
         while True:
-            time.sleep(1)  # Check every second
-            current_time = time.time()
-            if current_time - self.last_checkpoint_time >= self.checkpoint_interval:
+            timeout = self.last_checkpoint_time + self.checkpoint_interval - time.time()
+            self.checkpoint_event.wait(max(timeout, 0))
+            self.checkpoint_event.clear()
+            try:
+                self._flush_dirty_pages()
                 self._create_checkpoint()
-                self.last_checkpoint_time = current_time
                 # Clean up old transaction logs
                 self._cleanup_old_logs()
+            except Exception as e:
+                print(f"Error creating checkpoint: {str(e)}")
+            self.last_checkpoint_time = time.time()
+
+    def register_flusher(self, kind, flusher):
+        """Register flusher(db_name, name) used to write back dirty pages of a kind"""
+        self.flushers[kind] = flusher
+
+    def mark_dirty(self, db_name, kind, name, lsn=None, owner=None):
+        """Record that a page has changes that are not on disk yet"""
+        page = (db_name, kind, name)
+        with self.dirty_lock:
+            owners = self.dirty_pages.setdefault(page, {})
+            if owner not in owners:
+                owners[owner] = self.next_lsn if lsn is None else lsn
+
+    def mark_clean(self, db_name, kind, name, owner=None):
+        page = (db_name, kind, name)
+        with self.dirty_lock:
+            owners = self.dirty_pages.get(page)
+            if owners is not None:
+                owners.pop(owner, None)
+                if not owners:
+                    del self.dirty_pages[page]
+
+    def _flush_dirty_pages(self):
+        """Write back dirty unowned pages one at a time, without blocking writers"""
+        with self.dirty_lock:
+            pages = [page for page, owners in self.dirty_pages.items()
+                     if None in owners and page[1] in self.flushers]
+        for db_name, kind, name in pages:
+            # Clean before writing: a change made while flushing marks it dirty again
+            self.mark_clean(db_name, kind, name)
+            try:
+                self.flushers[kind](db_name, name)
+            except Exception as e:
+                self.mark_dirty(db_name, kind, name)
+                print(f"Error flushing {kind} {db_name}/{name}: {str(e)}")
 
     def _create_checkpoint(self, transaction_id=None):
-        """Create a checkpoint of the current state"""
+        """Write a fuzzy checkpoint; writers keep running while it is taken"""
         checkpoint_time = datetime.now().strftime("%Y%m%d_%H%M%S")
         checkpoint_file = os.path.join(self.checkpoint_dir, f"checkpoint_{checkpoint_time}.json")
-        
+        begin_lsn = self.next_lsn
+
         # Get all active transactions
-        active_transactions = {
-            tid: {
-                **info,
-                "locks": list(info["locks"])  # Convert set to list for JSON serialization
+        with self.transaction_lock:
+            active_transactions = {
+                str(tid): transaction.to_dict()
+                for tid, transaction in self.transactions.items()
+                if transaction.state == TransactionState.ACTIVE.value
             }
-            for tid, info in self.transactions.items()
-            if info["state"] == TransactionState.ACTIVE.value
-        }
-        
+
+        with self.dirty_lock:
+            dirty_pages = {
+                "/".join(page): min(owners.values())
+                for page, owners in self.dirty_pages.items()
+            }
+
+        # Recovery starts at the oldest change that may be missing from disk
+        # (redo) or that belongs to a transaction still active (undo)
+        checkpoint_lsn = min(
+            [begin_lsn]
+            + list(dirty_pages.values())
+            + [info["first_lsn"] for info in active_transactions.values() if info["first_lsn"] is not None]
+        )
+
         checkpoint_data = {
             "timestamp": datetime.now().isoformat(),
+            "lsn": checkpoint_lsn,
+            "begin_lsn": begin_lsn,
+            "end_lsn": self.next_lsn,
+            "dirty_pages": dirty_pages,
             "active_transactions": active_transactions,
             "last_checkpoint_time": self.last_checkpoint_time
         }
         
-        with open(checkpoint_file, "w") as f:
+        temp_file = temp_path(checkpoint_file)
+        with open(temp_file, "w") as f:
             json.dump(checkpoint_data, f)
+            fsync_file(f)
+        replace_file(temp_file, checkpoint_file)
+        with self.log_lock:
+            self.log_bytes_since_checkpoint = 0
         
         # Clean up old checkpoints
         self._cleanup_old_checkpoints()
 
     def _cleanup_old_checkpoints(self):
         """Keep only the last 5 checkpoints"""
-        checkpoints = [f for f in os.listdir(self.checkpoint_dir) if f.startswith("checkpoint_")]
+        checkpoints = [f for f in os.listdir(self.checkpoint_dir)
+                       if f.startswith("checkpoint_") and f.endswith(".json")]
         if len(checkpoints) > 5:
             # Sort by timestamp and remove oldest
             checkpoints.sort()
@@ -216,93 +417,137 @@ class TransactionManager:
                 os.remove(os.path.join(self.checkpoint_dir, old_checkpoint))
 
     def _cleanup_old_logs(self):
-        """Clean up transaction logs that have been checkpointed"""
+        """Drop whole log segments that the latest checkpoint no longer needs"""
         latest_checkpoint = self._get_latest_checkpoint()
-        if not latest_checkpoint:
+        if not latest_checkpoint or "lsn" not in latest_checkpoint:
             return
 
-        checkpoint_time = datetime.fromisoformat(latest_checkpoint["timestamp"])
-        
-        # For each database's transaction log
-        for log_file in os.listdir(self.log_dir):
-            if not log_file.endswith("_transactions.log"):
-                continue
-                
-            log_path = os.path.join(self.log_dir, log_file)
-            temp_path = log_path + ".temp"
-            
-            # Read and filter logs
-            with open(log_path, "r") as f_in, open(temp_path, "w") as f_out:
-                for line in f_in:
-                    try:
-                        log_entry = json.loads(line)
-                        log_time = datetime.fromisoformat(log_entry["timestamp"])
-                        # Keep only logs after the last checkpoint
-                        if log_time > checkpoint_time:
-                            f_out.write(line)
-                    except json.JSONDecodeError:
-                        continue
-            
-            # Replace old log with filtered log
-            os.replace(temp_path, log_path)
+        with self.log_lock:
+            lsn = min([latest_checkpoint["lsn"]] + list(self.log_retention.values()))
+            for db_name in self._log_paths():
+                writer = self._get_log_writer(db_name)
+                writer.truncate(lsn)
+
+    def retain_log(self, holder, lsn):
+        """Keep the records from `lsn` on in every log until release_log(holder)"""
+        with self.log_lock:
+            self.log_retention[holder] = lsn
+
+    def release_log(self, holder):
+        with self.log_lock:
+            self.log_retention.pop(holder, None)
+
+    def log_restart_lsn(self):
+        """LSN from which the logs hold every record of the running transactions and all later ones"""
+        return self.log_position()[1]
+
+    def log_position(self):
+        """(last LSN logged, restart LSN), taken together.
+
+        A log reader starting from both returns exactly the transactions
+        that commit from now on.
+        """
+        with self.transaction_lock, self.log_lock:
+            return self.next_lsn - 1, min([self.next_lsn] + [transaction.first_lsn for transaction
+                                                             in self.transactions.values()
+                                                             if transaction.first_lsn is not None])
+
+    def wait_for_log(self, seen, timeout):
+        """Wait until the logs were flushed since flush count `seen`; returns the current count"""
+        with self.log_lock:
+            if self.log_flushes == seen:
+                self.log_flushed.wait(timeout)
+            return self.log_flushes
+
+    def _read_transaction_id_reservation(self):
+        """First transaction id that is safe to use: the end of the last reserved block"""
+        try:
+            with open(self.transaction_id_file, "r") as f:
+                return int(f.read().strip() or 1)
+        except (OSError, ValueError):
+            return 1
+
+    def _reserve_transaction_ids(self):
+        """Persist the end of a new block of ids; call with transaction_lock held"""
+        self.transaction_id_limit = self.next_transaction_id + self.TRANSACTION_ID_BLOCK
+        temp_file = self.transaction_id_file + ".temp"
+        with open(temp_file, "w") as f:
+            f.write(str(self.transaction_id_limit))
+            fsync_file(f)
+        replace_file(temp_file, self.transaction_id_file)
 
     def begin_transaction(self, isolation_level=None):
         with self.transaction_lock:
-            transaction_id = str(uuid.uuid4())
-            try:
-                last_checkpoint = self._get_latest_checkpoint()
-            except:
-                last_checkpoint = None
-                
-            self.transactions[transaction_id] = {
-                "state": TransactionState.ACTIVE.value,
-                "start_time": time.time(),
-                "locks": set(),
-                "isolation_level": (isolation_level or self.default_isolation_level).value,
-                "last_checkpoint": last_checkpoint
-            }
+            if self.next_transaction_id >= self.transaction_id_limit:
+                self._reserve_transaction_ids()
+            transaction_id = self.next_transaction_id
+            self.next_transaction_id += 1
+            self.transactions[transaction_id] = Transaction(
+                transaction_id, (isolation_level or self.default_isolation_level).value
+            )
             return transaction_id
 
-    def commit_transaction(self, transaction_id):
+    def _find_finished(self, transaction_id):
+        for transaction in self.finished_transactions:
+            if transaction.transaction_id == transaction_id:
+                return transaction
+        return None
+
+    def _finish(self, transaction_id, transaction, state):
+        """Release everything a transaction holds and move it to the history"""
+        # Release all locks
+        self.lock_manager.release_transaction_locks(transaction_id, transaction.locks)
+        self._release_dirty_pages(transaction_id, transaction)
+        
+        # Update transaction state
+        transaction.state = state.value
+        transaction.end_time = time.time()
+        transaction.locks.clear()
+        del self.transactions[transaction_id]
+        self.finished_transactions.append(transaction)
+
+    def commit_transaction(self, transaction_id, flush=True):
         with self.transaction_lock:
-            if transaction_id not in self.transactions:
+            transaction = self.transactions.get(transaction_id)
+            if transaction is None:
+                finished = self._find_finished(transaction_id)
+                if finished:
+                    return False, f"Transaction is {finished.state}"
                 return False, "Transaction not found"
             
-            transaction = self.transactions[transaction_id]
-            if transaction["state"] != TransactionState.ACTIVE.value:
-                return False, f"Transaction is {transaction['state']}"
-            
-            # Release all locks
-            self.lock_manager.release_transaction_locks(transaction_id)
+            if transaction.state != TransactionState.ACTIVE.value:
+                return False, f"Transaction is {transaction.state}"
             
-            # Update transaction state
-            transaction["state"] = TransactionState.COMMITTED.value
-            transaction["end_time"] = time.time()
+            # The commit record must reach the log before locks are released
+            self._log_outcome(transaction_id, transaction, "commit", flush)
+            self._finish(transaction_id, transaction, TransactionState.COMMITTED)
+            TRANSACTIONS.labels("committed").inc()
             
             return True, "Transaction committed successfully"
 
     def abort_transaction(self, transaction_id):
         with self.transaction_lock:
-            if transaction_id not in self.transactions:
+            transaction = self.transactions.get(transaction_id)
+            if transaction is None:
+                finished = self._find_finished(transaction_id)
+                if finished:
+                    return False, f"Transaction is {finished.state}"
                 return False, "Transaction not found"
             
-            transaction = self.transactions[transaction_id]
-            if transaction["state"] != TransactionState.ACTIVE.value:
-                return False, f"Transaction is {transaction['state']}"
-            
-            # Release all locks
-            self.lock_manager.release_transaction_locks(transaction_id)
+            if transaction.state != TransactionState.ACTIVE.value:
+                return False, f"Transaction is {transaction.state}"
             
-            # Update transaction state
-            transaction["state"] = TransactionState.ABORTED.value
-            transaction["end_time"] = time.time()
+            self._log_outcome(transaction_id, transaction, "abort")
+            self._finish(transaction_id, transaction, TransactionState.ABORTED)
+            TRANSACTIONS.labels("aborted").inc()
             
             return True, "Transaction aborted successfully"
 
     def _get_latest_checkpoint(self):
         """Get the latest checkpoint information"""
         try:
-            checkpoints = [f for f in os.listdir(self.checkpoint_dir) if f.startswith("checkpoint_")]
+            checkpoints = [f for f in os.listdir(self.checkpoint_dir)
+                           if f.startswith("checkpoint_") and f.endswith(".json")]
             if not checkpoints:
                 return None
             
@@ -327,56 +572,189 @@ class TransactionManager:
             print(f"Error reading checkpoint: {str(e)}")
             return None
 
-    def recover_from_checkpoint(self):
-        """Recover the system state from the latest checkpoint"""
-        latest_checkpoint = self._get_latest_checkpoint()
-        if not latest_checkpoint:
-            return False, "No checkpoint found"
-        
-        # Implement recovery logic here
-        # This would involve:
-        # 1. Reading the checkpoint
-        # 2. Replaying logs since the checkpoint
-        # 3. Restoring the system state
-        
-        return True, "Recovery completed"
-
-    def log_operation(self, transaction_id, operation, db_name, collection, doc_id, before_state, after_state):
-        log_entry = {
-            "transaction_id": transaction_id,
-            "timestamp": datetime.now().isoformat(),
-            "operation": operation,
-            "db_name": db_name,
-            "collection": collection,
-            "document_id": doc_id,
-            "before_state": before_state,
-            "after_state": after_state,
-            "isolation_level": self.transactions[transaction_id]["isolation_level"]
+    def _log_paths(self):
+        """Map each database to its log segments in LSN order"""
+        return {
+            db_name: [path for _, path in list_segments(os.path.join(self.log_dir, db_name))]
+            for db_name in os.listdir(self.log_dir)
+            if os.path.isdir(os.path.join(self.log_dir, db_name))
         }
-        
-        # Create log file for the database if it doesn't exist
-        log_file = os.path.join(self.log_dir, f"{db_name}_transactions.log")
-        with open(log_file, "a") as f:
-            f.write(json.dumps(log_entry) + "\n")
+
+    def recover_from_checkpoint(self, max_workers=None):
+        """Recover the system state from the latest checkpoint and the logs.
+
+        Committed work found in the logs is redone and work of transactions
+        that were still in flight at the crash is undone, one collection per
+        worker process. Losers get an abort record so they are not undone
+        again on the next restart.
+        """
+        latest_checkpoint = self._get_latest_checkpoint() or {}
+        try:
+            with self.log_lock:
+                for writer in self.log_writers.values():
+                    writer.close()
+                self.log_writers.clear()
+                analysis, stats = recover(
+                    self.base_dir, self._log_paths(),
+                    start_lsn=latest_checkpoint.get("lsn", 0), max_workers=max_workers
+                )
+                self.next_lsn = max(self.next_lsn, stats["last_lsn"] + 1)
+        except Exception as e:
+            return False, f"Recovery failed: {str(e)}"
+
+        legacy_losers = False
+        for transaction_id, db_names in analysis["losers"].items():
+            if not isinstance(transaction_id, int):
+                # Version 1 logs used string ids, which current records cannot carry
+                legacy_losers = True
+                continue
+            for db_name in db_names:
+                self._append_log(transaction_id, None, "abort", db_name, None, None, None, None)
+        if legacy_losers:
+            # Move the redo point past them instead so they are not undone twice
+            self._create_checkpoint()
+
+        self.recovery_stats = stats
+        return True, (
+            f"Recovery completed in {stats['duration']:.3f}s: "
+            f"{stats['records_analyzed']} records analyzed, "
+            f"{stats['records_redone']} redone, {stats['records_undone']} undone "
+            f"across {stats['collections']} collections"
+        )
+
+    def _get_log_writer(self, db_name):
+        """Get or open the segment writer of a database; call with log_lock held"""
+        writer = self.log_writers.get(db_name)
+        if writer is None:
+            writer = SegmentedWALWriter(os.path.join(self.log_dir, db_name))
+            self.log_writers[db_name] = writer
+        return writer
+
+    def _migrate_flat_logs(self):
+        """Move single-file binary logs (<db>_transactions.wal) to segment directories"""
+        suffix = "_transactions" + WAL_EXTENSION
+        for log_file in os.listdir(self.log_dir):
+            if not log_file.endswith(suffix):
+                continue
+            segment_dir = os.path.join(self.log_dir, log_file[:-len(suffix)])
+            if list_segments(segment_dir):
+                continue
+            os.makedirs(segment_dir, exist_ok=True)
+            os.replace(os.path.join(self.log_dir, log_file), os.path.join(segment_dir, f"{1:08d}{WAL_EXTENSION}"))
+
+    def _find_last_lsn(self):
+        """Find the highest LSN written to any log; only last segments are scanned"""
+        last_lsn = 0
+        for db_name, paths in self._log_paths().items():
+            if not paths:
+                continue
+            try:
+                last_lsn = max(last_lsn, scan_segment(paths[-1])[0])
+            except Exception as e:
+                print(f"Error reading transaction log of {db_name}: {str(e)}")
+        return last_lsn
+
+    def log_operation(self, transaction_id, operation, db_name, collection, doc_id, before_state, after_state,
+                      flush=True):
+        """Append an operation to the database's binary log and return its LSN.
+
+        flush=False leaves the record buffered until flush_log(), for callers
+        that log a group of operations at once.
+        """
+        transaction = self.transactions[transaction_id]
+        transaction.logged_dbs.add(db_name)
+        lsn = self._append_log(
+            transaction_id, transaction.isolation_level, operation,
+            db_name, collection, doc_id, before_state, after_state, flush
+        )
+        if collection is not None and doc_id is not None:
+            # The writer forces the collection file before committing
+            self.mark_dirty(db_name, "collection", collection, lsn, owner=transaction_id)
+            transaction.dirty_pages.add((db_name, "collection", collection))
+        return lsn
+
+    def _release_dirty_pages(self, transaction_id, transaction):
+        """Collection files are on disk once their transaction ends"""
+        for db_name, kind, name in transaction.dirty_pages:
+            self.mark_clean(db_name, kind, name, owner=transaction_id)
+        transaction.dirty_pages.clear()
+
+    def _log_outcome(self, transaction_id, transaction, outcome, flush=True):
+        """Write a commit or abort record to every log the transaction used"""
+        for db_name in transaction.logged_dbs:
+            self._append_log(
+                transaction_id, transaction.isolation_level, outcome,
+                db_name, None, None, None, None, flush
+            )
+
+    @traced("wal_flush")
+    def flush_log(self, db_name):
+        """Write buffered records of a database's log in one write and, with sync_log, fsync them"""
+        with self.log_lock:
+            writer = self.log_writers.get(db_name)
+            if writer:
+                start = time.perf_counter()
+                self._flush_writer(writer)
+                WAL_FLUSH_SECONDS.observe(time.perf_counter() - start)
+                self.log_flushes += 1
+                self.log_flushed.notify_all()
+
+    def _flush_writer(self, writer):
+        if self.sync_log:
+            writer.sync()
+        else:
+            writer.flush()
+
+    @traced("wal_append")
+    def _append_log(self, transaction_id, isolation_level, operation, db_name, collection,
+                    doc_id, before_state, after_state, flush=True):
+        with self.log_lock:
+            writer = self._get_log_writer(db_name)
+            lsn = self.next_lsn
+            self.next_lsn += 1
+            transaction = self.transactions.get(transaction_id)
+            if transaction is not None and transaction.first_lsn is None:
+                # Set under log_lock so log_restart_lsn() never misses it
+                transaction.first_lsn = lsn
+            start = time.perf_counter()
+            written = writer.append(
+                lsn, time.time(), transaction_id, isolation_level, operation,
+                db_name, collection, doc_id, before_state, after_state, flush=False
+            )
+            appended = time.perf_counter()
+            WAL_APPEND_SECONDS.observe(appended - start)
+            if flush:
+                self._flush_writer(writer)
+                WAL_FLUSH_SECONDS.observe(time.perf_counter() - appended)
+                self.log_flushes += 1
+                self.log_flushed.notify_all()
+            self.log_bytes_since_checkpoint += written
+            self.log_bytes_written += written
+            if self.log_bytes_since_checkpoint >= self.checkpoint_log_bytes:
+                self.checkpoint_event.set()
+            return lsn
 
     def get_transaction_state(self, transaction_id):
         with self.transaction_lock:
-            if transaction_id not in self.transactions:
+            transaction = self.transactions.get(transaction_id) or self._find_finished(transaction_id)
+            if transaction is None:
                 return None
-            return TransactionState(self.transactions[transaction_id]["state"])
+            return TransactionState(transaction.state)
 
+    @traced("lock")
     def acquire_document_lock(self, db_name, collection, doc_id, lock_type, transaction_id):
-        if self.get_transaction_state(transaction_id) != TransactionState.ACTIVE:
+        transaction = self.transactions.get(transaction_id)
+        if transaction is None or transaction.state != TransactionState.ACTIVE.value:
             return False, "Transaction is not active"
         
-        isolation_level = IsolationLevel(self.transactions[transaction_id]["isolation_level"])
+        isolation_level = IsolationLevel(transaction.isolation_level)
         success, message = self.lock_manager.acquire_lock(
             db_name, collection, doc_id, lock_type, transaction_id, isolation_level
         )
         
         if success:
-            self.transactions[transaction_id]["locks"].add((db_name, collection, doc_id))
+            transaction.locks.add((db_name, collection, doc_id))
             if message == "Lock acquisition failed - waiting":
-                self.transactions[transaction_id]["state"] = TransactionState.BLOCKED.value
+                transaction.state = TransactionState.BLOCKED.value
             return True, message
         return False, message 
\ No newline at end of file
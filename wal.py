@@ -0,0 +1,468 @@
+import json
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+from file_sync import fsync_directory, fsync_file
+
+# Each database logs to a directory of numbered, preallocated segments.
+# A segment is a 16 byte header followed by length prefixed records.
+#
+#   header  := magic(4) version(u16) flags(u16) base_lsn(u64)
+#   record  := length(u32) crc32(u32) body
+#   body    := lsn(u64) type(u8) ...type specific fields
+#
+# `length` covers the body only and `crc32` is computed over the body, so a
+# torn or corrupted tail is detected and treated as the end of the log.
+# `base_lsn` is the first LSN of the segment; records are never split
+# across segments.
+
+WAL_MAGIC = b"MWAL"
+WAL_VERSION = 2
+_READABLE_VERSIONS = (1, 2)
+WAL_EXTENSION = ".wal"
+SEGMENT_SIZE = 16 * 1024 * 1024
+MAX_SPARE_SEGMENTS = 2
+
+_HEADER = struct.Struct("<4sHHQ")
+_RECORD_PREFIX = struct.Struct("<II")
+_BODY_PREFIX = struct.Struct("<QB")
+_DEFINE = struct.Struct("<I")
+# timestamp(f64) isolation(u8) flags(u8) db_ref(u32) collection_ref(u32) transaction_id(u64)
+_OPERATION = struct.Struct("<dBBIIQ")
+# Version 1 stored the transaction id as a string: ...collection_ref(u32) txn_len(u8) txn
+_OPERATION_V1 = struct.Struct("<dBBIIB")
+_LENGTH = struct.Struct("<I")
+
+# Record types
+RECORD_DEFINE = 0  # Interns a name (database or collection) for this file
+RECORD_OPERATION = 1
+
+# Operation record flags
+FLAG_DELTA = 0x01  # Payload is a field level delta instead of before/after images
+
+OPERATIONS = (
+    "insert",
+    "update",
+    "delete",
+    "create_collection",
+    "create_database",
+    "delete_database",
+    "create_index",
+    "drop_index",
+    "commit",
+    "abort",
+)
+_OPERATION_CODES = {name: code for code, name in enumerate(OPERATIONS, start=1)}
+
+ISOLATION_LEVELS = (
+    None,
+    "read_uncommitted",
+    "read_committed",
+    "repeatable_read",
+    "serializable",
+)
+_ISOLATION_CODES = {name: code for code, name in enumerate(ISOLATION_LEVELS)}
+
+
+class WALError(Exception):
+    pass
+
+
+def _dump_json(value):
+    if value is None:
+        return b""
+    return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+
+def _load_json(data):
+    if not data:
+        return None
+    return json.loads(data)
+
+
+def compute_delta(before_state, after_state):
+    """Field level difference between two documents, with the undo image"""
+    delta = {"set": {}, "unset": [], "undo_set": {}, "undo_unset": []}
+    for key, value in after_state.items():
+        if key not in before_state:
+            delta["set"][key] = value
+            delta["undo_unset"].append(key)
+        elif before_state[key] != value:
+            delta["set"][key] = value
+            delta["undo_set"][key] = before_state[key]
+    for key, value in before_state.items():
+        if key not in after_state:
+            delta["unset"].append(key)
+            delta["undo_set"][key] = value
+    return delta
+
+
+def apply_delta(document, delta, undo=False):
+    """Apply a delta (or its undo image) to a document in place"""
+    if undo:
+        document.update(delta["undo_set"])
+        for key in delta["undo_unset"]:
+            document.pop(key, None)
+    else:
+        document.update(delta["set"])
+        for key in delta["unset"]:
+            document.pop(key, None)
+    return document
+
+
+def encode_header(base_lsn=0, flags=0):
+    return _HEADER.pack(WAL_MAGIC, WAL_VERSION, flags, base_lsn)
+
+
+def decode_header(data):
+    magic, version, flags, base_lsn = _HEADER.unpack_from(data)
+    if magic != WAL_MAGIC:
+        raise WALError("Not a WAL file")
+    if version not in _READABLE_VERSIONS:
+        raise WALError(f"Unsupported WAL version {version}")
+    return {"version": version, "flags": flags, "base_lsn": base_lsn}
+
+
+def _frame(body):
+    return _RECORD_PREFIX.pack(len(body), zlib.crc32(body)) + body
+
+
+def encode_define(lsn, ref, name):
+    body = _BODY_PREFIX.pack(lsn, RECORD_DEFINE) + _DEFINE.pack(ref) + name.encode("utf-8")
+    return _frame(body)
+
+
+def encode_operation(lsn, timestamp, transaction_id, isolation_level, operation,
+                     db_ref, collection_ref, doc_id, before_state, after_state):
+    """Encode one logged operation; updates carry a field level delta"""
+    code = _OPERATION_CODES.get(operation)
+    if code is None:
+        raise WALError(f"Unknown operation '{operation}'")
+
+    flags = 0
+    if operation == "update" and before_state is not None and after_state is not None:
+        flags |= FLAG_DELTA
+        payload = _dump_json(compute_delta(before_state, after_state))
+        after = b""
+    else:
+        payload = _dump_json(before_state)
+        after = _dump_json(after_state)
+    key = _dump_json(doc_id)
+
+    body = b"".join((
+        _BODY_PREFIX.pack(lsn, RECORD_OPERATION + code),
+        _OPERATION.pack(timestamp, _ISOLATION_CODES.get(isolation_level, 0), flags,
+                        db_ref, collection_ref, transaction_id),
+        _LENGTH.pack(len(key)), key,
+        _LENGTH.pack(len(payload)), payload,
+        after,
+    ))
+    return _frame(body)
+
+
+def decode_body(body, names, collection=None, with_payload=True, version=WAL_VERSION):
+    """Decode a record body; DEFINE records update `names` and return None.
+
+    When `collection` is given, operation records for other collections are
+    skipped (None is returned) before their payload is decoded.
+    """
+    lsn, record_type = _BODY_PREFIX.unpack_from(body)
+    offset = _BODY_PREFIX.size
+    if record_type == RECORD_DEFINE:
+        (ref,) = _DEFINE.unpack_from(body, offset)
+        names[ref] = body[offset + _DEFINE.size:].decode("utf-8")
+        return None
+
+    operation = OPERATIONS[record_type - RECORD_OPERATION - 1]
+    if version == 1:
+        timestamp, isolation, flags, db_ref, collection_ref, txn_len = _OPERATION_V1.unpack_from(body, offset)
+        offset += _OPERATION_V1.size
+        transaction_id = body[offset:offset + txn_len].decode("utf-8")
+        offset += txn_len
+    else:
+        timestamp, isolation, flags, db_ref, collection_ref, transaction_id = _OPERATION.unpack_from(body, offset)
+        offset += _OPERATION.size
+    if collection is not None and names.get(collection_ref) != collection:
+        return None
+    (key_len,) = _LENGTH.unpack_from(body, offset)
+    offset += _LENGTH.size
+    doc_id = _load_json(body[offset:offset + key_len])
+    offset += key_len
+    (payload_len,) = _LENGTH.unpack_from(body, offset)
+    offset += _LENGTH.size
+    payload = body[offset:offset + payload_len]
+    after = body[offset + payload_len:]
+
+    record = {
+        "lsn": lsn,
+        "transaction_id": transaction_id,
+        "timestamp": timestamp,
+        "operation": operation,
+        "db_name": names.get(db_ref),
+        "collection": names.get(collection_ref),
+        "document_id": doc_id,
+        "isolation_level": ISOLATION_LEVELS[isolation],
+        "before_state": None,
+        "after_state": None,
+        "delta": None,
+    }
+    if not with_payload:
+        return record
+    if flags & FLAG_DELTA:
+        record["delta"] = _load_json(payload)
+    else:
+        record["before_state"] = _load_json(payload)
+        record["after_state"] = _load_json(after)
+    return record
+
+
+def _iter_bodies(data, base_lsn, offset=_HEADER.size):
+    """Yield (end_offset, body) for every intact record of a mapped segment from `offset` on.
+
+    Stops at the first zero length (preallocated space), torn or corrupt
+    record, or at a record older than the segment's base LSN, which is stale
+    content left in a recycled segment.
+    """
+    last_lsn = base_lsn
+    while offset + _RECORD_PREFIX.size <= len(data):
+        length, crc = _RECORD_PREFIX.unpack_from(data, offset)
+        start = offset + _RECORD_PREFIX.size
+        if length < _BODY_PREFIX.size or start + length > len(data):
+            break
+        body = data[start:start + length]
+        if zlib.crc32(body) != crc:
+            break
+        (lsn,) = struct.unpack_from("<Q", body)
+        if lsn < last_lsn:
+            break
+        last_lsn = lsn
+        offset = start + length
+        yield offset, body
+
+
+def _segment_name(seq):
+    return f"{seq:08d}{WAL_EXTENSION}"
+
+
+def list_segments(directory):
+    """Sorted (seq, path) pairs of the segments in a log directory"""
+    if not os.path.isdir(directory):
+        return []
+    segments = []
+    for name in os.listdir(directory):
+        stem, ext = os.path.splitext(name)
+        if ext == WAL_EXTENSION and stem.isdigit():
+            segments.append((int(stem), os.path.join(directory, name)))
+    return sorted(segments)
+
+
+def read_segment_header(path):
+    with open(path, "rb") as f:
+        return decode_header(f.read(_HEADER.size))
+
+
+def scan_segment(path):
+    """Return (last_lsn, end_offset) of the valid records in a segment"""
+    with open(path, "rb") as f:
+        header = decode_header(f.read(_HEADER.size))
+        last_lsn, end = header["base_lsn"] - 1, _HEADER.size
+        if os.fstat(f.fileno()).st_size > _HEADER.size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for end, body in _iter_bodies(data, header["base_lsn"]):
+                    (last_lsn,) = struct.unpack_from("<Q", body)
+    return last_lsn, end
+
+
+def _preallocate(f, size):
+    """Reserve the whole segment up front so appends never extend the file"""
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except (AttributeError, OSError):
+        f.truncate(size)
+
+
+class SegmentedWALWriter:
+    """Appends binary records to a directory of fixed-size numbered segments.
+
+    Segments are preallocated, so appends overwrite reserved space instead of
+    growing the file, and truncation is a matter of removing whole segments.
+    Removed segments are kept as spares (up to `max_spares`) and recycled as
+    the next segment, which avoids creating and allocating files at all.
+    Names are interned per segment.
+    """
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE, max_spares=MAX_SPARE_SEGMENTS):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_spares = max_spares
+        os.makedirs(directory, exist_ok=True)
+        self.segments = [(seq, path, read_segment_header(path)["base_lsn"])
+                         for seq, path in list_segments(directory)]
+        self.file = None
+        self.names = {}  # name -> ref, for the current segment
+        self.offset = 0
+        if self.segments:
+            _, path, _ = self.segments[-1]
+            if read_segment_header(path)["version"] == WAL_VERSION:
+                _, self.offset = scan_segment(path)
+                self.file = open(path, "r+b")
+                self.file.seek(self.offset)
+            # Otherwise the first append starts a segment in the current format
+
+    def _spare_paths(self):
+        return sorted(
+            os.path.join(self.directory, name) for name in os.listdir(self.directory)
+            if name.startswith("spare_") and name.endswith(WAL_EXTENSION)
+        )
+
+    def _roll(self, base_lsn):
+        """Start a new segment whose first record will have `base_lsn`"""
+        if self.file:
+            # Records of the finished segment are not synced by later flushes
+            fsync_file(self.file)
+            self.file.close()
+        seq = self.segments[-1][0] + 1 if self.segments else 1
+        path = os.path.join(self.directory, _segment_name(seq))
+        spares = self._spare_paths()
+        if spares:
+            os.replace(spares[0], path)
+            self.file = open(path, "r+b")
+        else:
+            self.file = open(path, "w+b")
+            _preallocate(self.file, self.segment_size)
+        self.file.write(encode_header(base_lsn))
+        fsync_directory(self.directory)
+        self.offset = _HEADER.size
+        self.names = {}
+        self.segments.append((seq, path, base_lsn))
+
+    def _ref(self, name, lsn, chunks):
+        if name is None:
+            return 0
+        ref = self.names.get(name)
+        if ref is None:
+            ref = len(self.names) + 1
+            self.names[name] = ref
+            chunks.append(encode_define(lsn, ref, name))
+        return ref
+
+    def append(self, lsn, timestamp, transaction_id, isolation_level, operation,
+               db_name, collection, doc_id, before_state, after_state, flush=True):
+        """Write one operation record and return the number of bytes written.
+
+        With flush=False the record stays in the file buffer until flush(),
+        so a group of records reaches the OS in one write.
+        """
+        if self.file is None:
+            self._roll(lsn)
+        for _ in range(2):
+            chunks = []
+            db_ref = self._ref(db_name, lsn, chunks)
+            collection_ref = self._ref(collection, lsn, chunks)
+            chunks.append(encode_operation(
+                lsn, timestamp, transaction_id, isolation_level, operation,
+                db_ref, collection_ref, doc_id, before_state, after_state
+            ))
+            data = b"".join(chunks)
+            # Records never span segments; an oversized record gets a segment of its own
+            if self.offset + len(data) <= self.segment_size or self.offset == _HEADER.size:
+                break
+            self._roll(lsn)
+        self.file.write(data)
+        if flush:
+            self.file.flush()
+        self.offset += len(data)
+        return len(data)
+
+    def paths(self):
+        return [path for _, path, _ in self.segments]
+
+    def truncate(self, lsn):
+        """Drop every segment whose records all precede `lsn`; O(segments)"""
+        removed = 0
+        # A segment is obsolete once the next segment starts at or before lsn
+        while len(self.segments) > 1 and self.segments[1][2] <= lsn:
+            seq, path, _ = self.segments.pop(0)
+            if len(self._spare_paths()) < self.max_spares:
+                os.replace(path, os.path.join(self.directory, f"spare_{seq:08d}{WAL_EXTENSION}"))
+            else:
+                os.remove(path)
+            removed += 1
+        return removed
+
+    def flush(self):
+        if self.file:
+            self.file.flush()
+
+    def sync(self):
+        """Force the records appended so far to disk (flush() only hands them to the OS)"""
+        if self.file:
+            fsync_file(self.file)
+
+    def close(self):
+        if self.file and not self.file.closed:
+            self.file.close()
+
+
+def read_records(path, collection=None, with_payload=True):
+    """Yield decoded operation records, stopping at a torn or corrupt tail.
+
+    `collection` restricts the output to one collection and `with_payload`
+    set to False skips decoding document images, which is most of the cost.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < _HEADER.size:
+            return
+        # Map the file instead of reading it so large logs stay in the page cache
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            header = decode_header(data)
+            names = {}
+            for _, body in _iter_bodies(data, header["base_lsn"]):
+                record = decode_body(body, names, collection, with_payload, header["version"])
+                if record is not None:
+                    yield record
+
+
+def tail_records(path, offset=None, names=None):
+    """Yield (end_offset, record) for the intact records of a segment after `offset`.
+
+    For reading a segment while it is being written: passing the last
+    end_offset and the same `names` dict back continues where the previous
+    call stopped. offset None starts at the first record.
+    """
+    names = {} if names is None else names
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < _HEADER.size:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            header = decode_header(data)
+            for end, body in _iter_bodies(data, header["base_lsn"], offset or _HEADER.size):
+                record = decode_body(body, names, version=header["version"])
+                if record is not None:
+                    yield end, record
+
+
+def dump(path, out=sys.stdout):
+    """Print every record of a segment, or a log directory, one JSON object per line"""
+    paths = [p for _, p in list_segments(path)] if os.path.isdir(path) else [path]
+    count = 0
+    for segment_path in paths:
+        for record in read_records(segment_path):
+            out.write(json.dumps(record) + "\n")
+            count += 1
+    return count
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python wal.py <log directory or segment> [...]")
+        sys.exit(1)
+    for log_path in sys.argv[1:]:
+        try:
+            dump(log_path)
+        except (OSError, WALError) as e:
+            print(f"{log_path}: {e}", file=sys.stderr)
+            sys.exit(1)
@@ -0,0 +1,97 @@
+import threading
+
+import profiling
+
+
+class _PendingWrite:
+    __slots__ = ("request", "result", "error", "lead", "done", "profile", "span")
+
+    def __init__(self, request):
+        self.request = request
+        self.result = None
+        self.error = None
+        self.lead = False  # woken to apply the next group rather than with a result
+        self.done = threading.Event()
+        # A profiled caller gets the spans of the whole group it was applied in
+        self.profile = profiling.current()
+        self.span = profiling.current_span() if self.profile else None
+
+
+class WriteQueue:
+    """Coalesces concurrent writes to one collection.
+
+    Callers submit a request and block until it is applied. Whichever caller
+    finds the queue idle becomes the leader: it takes everything queued so
+    far and hands the group to `apply_group` (one load, persist and log
+    flush for the lot). Requests that arrive meanwhile form the next group,
+    led by the oldest of their callers.
+
+    `apply_lock` is held while a group is applied. Writers of the collection
+    that bypass the queue (batches, replication) hold it from loading the
+    collection to persisting it, or one would overwrite the other's changes.
+    """
+
+    def __init__(self, apply_group):
+        self.apply_group = apply_group  # list of requests -> list of results
+        self.lock = threading.Lock()
+        self.apply_lock = threading.Lock()
+        self.pending = []
+        self.busy = False
+        self.groups = 0
+        self.writes = 0
+
+    def submit(self, request):
+        pending = _PendingWrite(request)
+        with self.lock:
+            self.pending.append(pending)
+            if self.busy:
+                leader = False
+            else:
+                self.busy = leader = True
+
+        if leader:
+            self._apply_next()
+        while True:
+            pending.done.wait()
+            if not pending.lead:
+                break
+            pending.lead = False
+            pending.done.clear()
+            self._apply_next()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _apply_next(self):
+        with self.lock:
+            group, self.pending = self.pending, []
+            self.groups += 1
+            self.writes += len(group)
+        requests = [pending.request for pending in group]
+        profiled = [pending for pending in group if pending.profile is not None]
+        try:
+            with self.apply_lock:
+                if profiled:
+                    group_profile = profiling.Profile(f"write_group ({len(group)} writes)")
+                    try:
+                        results = profiling.run_in(group_profile, self.apply_group, requests)
+                    finally:
+                        for pending in profiled:
+                            pending.profile.graft(group_profile.root, pending.span)
+                else:
+                    results = self.apply_group(requests)
+            for pending, result in zip(group, results):
+                pending.result = result
+        except Exception as e:
+            for pending in group:
+                pending.error = e
+        for pending in group:
+            pending.done.set()
+
+        with self.lock:
+            if self.pending:
+                # Hand leadership to the oldest waiter
+                self.pending[0].lead = True
+                self.pending[0].done.set()
+            else:
+                self.busy = False
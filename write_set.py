@@ -0,0 +1,362 @@
+import json
+import os
+import threading
+import time
+
+from collection_file import (
+    CollectionFile, StagedCollection, collection_exists, collection_files, collection_path, legacy_path,
+    partition_count, partition_of, swap_lock, write_collection
+)
+from block_compression import NO_COMPRESSION
+from document_codec import DEFAULT_CODEC, get_codec
+from indexing import PrimaryIndex
+import metrics
+from profiling import traced
+
+QUERY_PLANS = metrics.counter(
+    "mangodb_query_plans_total", "Matched queries by plan: primary_index lookups or collection_scan",
+    ("database", "collection", "plan")
+)
+DOCUMENTS_SCANNED = metrics.counter(
+    "mangodb_documents_scanned_total", "Documents examined to match queries", ("database", "collection")
+)
+
+
+def query_plan(query):
+    """(plan, index) a filter is matched with: ("primary_index", "_id") or ("collection_scan", None)"""
+    if "_id" in query:
+        return "primary_index", "_id"
+    return "collection_scan", None
+
+
+class _CollectionState:
+    """One collection file (a whole collection or one partition) as seen by a write set.
+
+    slots[i] is the file position of a document not decoded yet, the
+    decoded (or inserted) document itself, or None once deleted. The
+    file is written back with the codec and compression it was stored
+    with, and only if `changed` is set.
+    """
+    __slots__ = ("path", "file", "codec", "compression", "slots", "index", "changed")
+
+    def __init__(self, path, legacy=None):
+        self.path = path
+        self.changed = False
+        if os.path.exists(path):
+            self.file = CollectionFile(path)
+            self.codec = self.file.codec
+            self.compression = self.file.compression
+            self.slots = list(range(len(self.file)))
+            ids = self.file.ids
+        else:
+            # Previous format: a JSON array, decoded up front
+            self.file = None
+            self.codec = get_codec(DEFAULT_CODEC)()
+            self.compression = NO_COMPRESSION
+            with open(legacy, 'r') as f:
+                self.slots = json.load(f)
+            ids = [doc.get('_id') for doc in self.slots]
+        self.index = PrimaryIndex(ids)
+
+    @classmethod
+    def from_documents(cls, documents, codec, compression):
+        """State for documents that are not stored in this layout yet"""
+        state = cls.__new__(cls)
+        state.path = None
+        state.file = None
+        state.codec = codec
+        state.compression = compression
+        state.slots = list(documents)
+        state.index = PrimaryIndex(doc.get('_id') for doc in state.slots)
+        state.changed = True
+        return state
+
+    def document(self, slot):
+        entry = self.slots[slot]
+        if type(entry) is int:
+            entry = self.slots[slot] = self.file.document(entry)
+        return entry
+
+    def documents(self):
+        return [self.document(slot) for slot, entry in enumerate(self.slots) if entry is not None]
+
+    def records(self):
+        """(doc_id, encoded document) pairs for writing the collection back"""
+        for entry in self.slots:
+            if entry is None:
+                continue
+            if type(entry) is int:
+                if self.codec is self.file.codec:
+                    # Untouched documents are copied without decoding them
+                    yield self.file.ids[entry], self.file.raw(entry)
+                    continue
+                entry = self.file.document(entry)
+            yield entry.get('_id'), self.codec.encode(entry)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+class WriteSet:
+    """Collections a transaction has touched, kept in memory until commit.
+
+    Each collection file is opened at most once per transaction; statements
+    work on the in-memory copy and see each other's changes. persist()
+    writes every changed collection file once, aborting just drops the
+    object. Documents are decoded from the memory-mapped file only when a
+    statement touches them, and lookups by _id go through a primary index
+    built from the file's directory. A partitioned collection has one state
+    per partition, and documents are routed to theirs by _id.
+
+    `version_of(collection)`, if given, is called just before a collection
+    is opened; opened_version() returns what it gave, the query cache
+    version the loaded data is at least as new as.
+    """
+
+    def __init__(self, db_path, version_of=None):
+        self.db_path = db_path
+        self.db_name = os.path.basename(db_path)
+        self.states = {}  # collection -> [_CollectionState per partition]
+        self.states_lock = threading.Lock()  # batch statements open collections concurrently
+        self.changed = set()
+        self.relayout = {}  # collection -> new partition count, applied by persist()
+        self.version_of = version_of
+        self.opened_versions = {}
+
+    def exists(self, collection):
+        return collection in self.states or collection_exists(self.db_path, collection)
+
+    def _parts(self, collection):
+        parts = self.states.get(collection)
+        if parts is None:
+            with self.states_lock:
+                parts = self.states.get(collection)
+                if parts is None:
+                    if self.version_of:
+                        self.opened_versions[collection] = self.version_of(collection)
+                    parts = self.states[collection] = self._open(collection)
+        return parts
+
+    def opened_version(self, collection):
+        """Version recorded when the collection was opened, None if it is not open"""
+        if collection not in self.states:
+            return None
+        return self.opened_versions.get(collection)
+
+    @traced("open_collection")
+    def _open(self, collection):
+        # Every partition from the same generation
+        with swap_lock:
+            if partition_count(self.db_path, collection):
+                return [_CollectionState(path) for path in collection_files(self.db_path, collection)]
+            return [_CollectionState(collection_path(self.db_path, collection),
+                                     legacy_path(self.db_path, collection))]
+
+    @staticmethod
+    def _part(parts, doc_id):
+        return parts[0] if len(parts) == 1 else parts[partition_of(doc_id, len(parts))]
+
+    @traced("load_collection")
+    def load(self, collection):
+        """Every live document of a collection, decoding the ones not decoded yet"""
+        documents = []
+        for part in self._parts(collection):
+            documents.extend(part.documents())
+        return documents
+
+    @traced("index_lookup")
+    def get(self, collection, doc_id):
+        """The document with this _id, or None; decodes only that document"""
+        part = self._part(self._parts(collection), doc_id)
+        slot = part.index.get(doc_id)
+        return None if slot is None else part.document(slot)
+
+    def contains(self, collection, doc_id):
+        return doc_id in self._part(self._parts(collection), doc_id).index
+
+    def match(self, collection, query, scan_pool, stats=None):
+        """Documents matching an equality query.
+
+        A query on _id is answered from the primary index. Otherwise the
+        partitions this write set has not changed are scanned straight from
+        their files by `scan_pool` workers, one per partition; the rest are
+        filtered here. `stats`, if given, is filled with the plan (see
+        query_plan), keys and documents examined, and the time spent opening
+        the collection and matching.
+        """
+        start = time.perf_counter()
+        parts = self._parts(collection)
+        opened = time.perf_counter()
+        plan, index = query_plan(query)
+        keys_examined = 0
+        if plan == "primary_index":
+            keys_examined = 1
+            doc = self.get(collection, query["_id"])
+            scanned = 0 if doc is None else 1
+            results = [doc] if doc is not None and all(doc.get(k) == v for k, v in query.items()) else []
+        elif len(parts) == 1:
+            documents = self.load(collection)
+            scanned = len(documents)
+            results = scan_pool.filter(documents, query)
+        else:
+            positions = scan_pool.scan_files(
+                [None if part.changed or part.file is None else part.file for part in parts], query
+            )
+            results = []
+            scanned = 0
+            for part, part_positions in zip(parts, positions):
+                if part_positions is None:
+                    documents = part.documents()
+                    scanned += len(documents)
+                    results.extend(scan_pool.filter(documents, query))
+                else:
+                    scanned += len(part.file)
+                    results.extend(part.document(position) for position in part_positions)
+        QUERY_PLANS.labels(self.db_name, collection, plan).inc()
+        if scanned:
+            DOCUMENTS_SCANNED.labels(self.db_name, collection).inc(scanned)
+        if stats is not None:
+            stats.update(
+                plan=plan, index=index, partitions=len(parts), keys_examined=keys_examined,
+                documents_examined=scanned, documents_matched=len(results),
+                open_ms=(opened - start) * 1000, match_ms=(time.perf_counter() - opened) * 1000,
+            )
+        return results
+
+    def insert(self, collection, doc):
+        part = self._part(self._parts(collection), doc.get('_id'))
+        part.slots.append(doc)
+        if "_id" in doc:
+            part.index.add(doc["_id"], len(part.slots) - 1)
+        part.changed = True
+        self.changed.add(collection)
+
+    def delete(self, collection, docs):
+        """Remove documents; O(1) each when they can be found by _id"""
+        if not docs:
+            return
+        parts = self._parts(collection)
+        unindexed = set()
+        for doc in docs:
+            part = self._part(parts, doc.get('_id'))
+            slot = part.index.get(doc["_id"]) if "_id" in doc else None
+            if slot is not None and part.slots[slot] is doc:
+                part.slots[slot] = None
+                part.index.remove(doc["_id"])
+                part.changed = True
+            else:
+                unindexed.add(id(doc))
+        if unindexed:
+            for part in parts:
+                for slot, entry in enumerate(part.slots):
+                    if entry is not None and id(entry) in unindexed:
+                        part.slots[slot] = None
+                        part.changed = True
+        self.changed.add(collection)
+
+    def set_codec(self, collection, codec_name):
+        """Store the collection with another codec when it is persisted"""
+        for part in self._parts(collection):
+            if part.codec.name != codec_name:
+                part.codec = get_codec(codec_name)()
+                part.changed = True
+                self.changed.add(collection)
+
+    def set_compression(self, collection, compression):
+        """Store the collection with another Compression when it is persisted"""
+        for part in self._parts(collection):
+            if part.compression != compression:
+                part.compression = compression
+                part.changed = True
+                self.changed.add(collection)
+
+    def set_partitions(self, collection, partitions):
+        """Split the collection into `partitions` files by _id (1 for a single file)"""
+        parts = self._parts(collection)
+        partitions = max(partitions, 1)
+        if len(parts) == partitions:
+            return
+        documents = self.load(collection)
+        codec, compression = parts[0].codec, parts[0].compression
+        buckets = [[] for _ in range(partitions)]
+        for doc in documents:
+            buckets[partition_of(doc.get('_id'), partitions)].append(doc)
+        for part in parts:
+            part.close()
+        # Later statements are routed by the new partition count
+        self.states[collection] = [
+            _CollectionState.from_documents(bucket, get_codec(codec.name)(), compression) for bucket in buckets
+        ]
+        self.relayout[collection] = partitions
+        self.changed.add(collection)
+
+    def mark_changed(self, collection, docs=None):
+        """Record in-place changes to documents (to every partition if docs is None)"""
+        parts = self._parts(collection)
+        if docs is None:
+            for part in parts:
+                part.changed = True
+        else:
+            for doc in docs:
+                self._part(parts, doc.get('_id')).changed = True
+        self.changed.add(collection)
+
+    @traced("persist")
+    def persist(self):
+        """Write each changed collection once and swap its new files in.
+
+        The new files of every changed collection are written first (a
+        partitioned collection gets a new generation, with links to its
+        unchanged partitions), so a failure while writing leaves every
+        collection untouched; each collection is then swapped with one
+        rename. Collections whose partition count changed are written in
+        their new layout.
+        """
+        stages = []
+        try:
+            for collection in sorted(self.changed | set(self.relayout)):
+                stages.append((collection, self._stage(collection)))
+        except BaseException:
+            for _, stage in stages:
+                stage.discard()
+            raise
+        with swap_lock:
+            for _, stage in stages:
+                stage.publish()
+        for collection, stage in stages:
+            stage.finish()
+            for partition, part in enumerate(self.states[collection]):
+                # Unchanged partitions are linked from here by a later persist
+                part.path = stage.published_path(partition)
+                part.changed = False
+        persisted = len(stages)
+        self.changed.clear()
+        self.relayout.clear()
+        return persisted
+
+    def _stage(self, collection):
+        """The new files of a collection, written and sealed (see StagedCollection)"""
+        parts = self.states[collection]
+        # After set_partitions() the states are already in the new layout
+        stage = StagedCollection(self.db_path, collection, len(parts) if len(parts) > 1 else 0)
+        try:
+            for partition, part in enumerate(parts):
+                if part.changed or part.file is None:
+                    write_collection(stage.path(partition), part.records(), part.codec, part.compression)
+                else:
+                    stage.link(partition, part.path)
+            stage.seal()
+        except BaseException:
+            stage.discard()
+            raise
+        return stage
+
+    def discard(self):
+        for parts in self.states.values():
+            for part in parts:
+                part.close()
+        self.states.clear()
+        self.opened_versions.clear()
+        self.changed.clear()
+        self.relayout.clear()